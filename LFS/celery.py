@@ -16,6 +16,81 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load tasks from all registered Django app configs.
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+
+# Task Queues
+# Work is split by what it spends its time on so that a nightly expiry run never holds up thumbnails for fresh uploads
+#   thumbnails   - CPU heavy rendering (preview_generator, LibreOffice, Pillow)
+#   transcodes   - video transcoding into HLS renditions (ffmpeg), each task keeps every core busy for minutes
+#   transfers    - long running SFTP transfers to and from the NAS, these mostly wait on the network
+#   housekeeping - periodic maintenance and admin jobs
+# Anything not routed below goes to the default queue, which the housekeeping workers also consume
+
+THUMBNAIL_QUEUE = "thumbnails"
+TRANSCODE_QUEUE = "transcodes"
+TRANSFER_QUEUE = "transfers"
+HOUSEKEEPING_QUEUE = "housekeeping"
+DEFAULT_QUEUE = "celery"
+
+# Message priorities, with the redis broker 0 is taken first and 9 last.
+# Messages sent without a priority would otherwise be treated as 0, so everything gets PRIORITY_NORMAL unless routed otherwise
+PRIORITY_USER = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BULK = 9
+
+app.conf.task_default_queue = DEFAULT_QUEUE
+app.conf.task_default_priority = PRIORITY_NORMAL
+app.conf.broker_transport_options = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+}
+# Tasks on these queues run for minutes at a time, a worker should only hold the task it is running
+# so that a user triggered de-archive is not stuck behind bulk work it has already reserved
+app.conf.worker_prefetch_multiplier = 1
+
+app.conf.task_routes = {
+    "filehost.tasks.create_thumbnail": {"queue": THUMBNAIL_QUEUE},
+    "filehost.tasks.create_image_variant": {"queue": THUMBNAIL_QUEUE},
+    "filehost.tasks.create_hls_renditions": {"queue": TRANSCODE_QUEUE},
+
+    # De-archiving a file someone is waiting for jumps ahead of bulk archival on the same workers
+    "filehost.tasks.localise_file": {"queue": TRANSFER_QUEUE, "priority": PRIORITY_USER},
+    "filehost.tasks.localise_files": {"queue": TRANSFER_QUEUE},
+    "filehost.tasks.archive_files": {"queue": TRANSFER_QUEUE, "priority": PRIORITY_BULK},
+    "filehost.tasks.expire_file_batch": {"queue": TRANSFER_QUEUE, "priority": PRIORITY_BULK},
+    "filehost.tasks.reap_deleted_files": {"queue": TRANSFER_QUEUE, "priority": PRIORITY_BULK},
+    "filehost.tasks.remove_archived_files": {"queue": TRANSFER_QUEUE, "priority": PRIORITY_BULK},
+    "filehost.tasks.compact_archive_segments": {"queue": TRANSFER_QUEUE, "priority": PRIORITY_BULK},
+    "filehost.tasks.cleanup_orpahaned_files_archived": {"queue": TRANSFER_QUEUE, "priority": PRIORITY_BULK},
+
+    "filehost.tasks.expire_files": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.maintain_oembed_cache": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.cleanup_orphaned_files_async": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.cleanup_orphaned_files_local": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.reconcile_storage_manifest": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.scrub_local_files": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.recalculate_storage_usage": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.refresh_admin_facets": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.bulk_update_files": {"queue": HOUSEKEEPING_QUEUE},
+    "filehost.tasks.delete_archived_file": {"queue": HOUSEKEEPING_QUEUE},
+}
+
+# Worker Profiles
+# Each queue is served by its own worker so that the pool type, concurrency and prefetch suit its workload, start one worker per profile:
+#   celery -A LFS worker <arguments>
+# CPU heavy rendering uses the prefork pool with a process per core (celery's default concurrency),
+# SFTP transfers use the threads pool as paramiko releases the GIL while it waits on the NAS.
+# Transcodes run one at a time per worker as ffmpeg already spreads a single transcode over every core.
+# Thumbnail worker processes are replaced once their resident memory passes THUMBNAIL_WORKER_MAX_MEMORY (KiB) after a task,
+# so that memory Pillow and preview_generator hold on to in the worker itself does not build up
+THUMBNAIL_WORKER_MAX_MEMORY = 524288
+WORKER_PROFILES = {
+    "thumbnails": ["-Q", THUMBNAIL_QUEUE, "-P", "prefork", "--prefetch-multiplier", "1", "--max-memory-per-child", str(THUMBNAIL_WORKER_MAX_MEMORY), "-n", "thumbnails@%h"],
+    "transcodes": ["-Q", TRANSCODE_QUEUE, "-P", "prefork", "-c", "1", "--prefetch-multiplier", "1", "-n", "transcodes@%h"],
+    "transfers": ["-Q", TRANSFER_QUEUE, "-P", "threads", "-c", "8", "--prefetch-multiplier", "1", "-n", "transfers@%h"],
+    "housekeeping": ["-Q", f"{HOUSEKEEPING_QUEUE},{DEFAULT_QUEUE}", "-P", "prefork", "-c", "2", "--prefetch-multiplier", "1", "-n", "housekeeping@%h"],
+}
+
 #TODO Test periodic tasks are actually running
 
 @app.on_after_finalize.connect
@@ -24,15 +99,45 @@ def setup_periodic_tasks(sender, **kwargs):
 
     sender.add_periodic_task(
         crontab(minute=0, hour=0),
-        tasks.expire_files(),
+        tasks.expire_files.s(),
     )
     
     sender.add_periodic_task(
         crontab(minute=0, hour=0, day_of_week="Monday"),
-        tasks.cleanup_orphaned_files_async(),
+        tasks.cleanup_orphaned_files_async.s(),
     )
 
     sender.add_periodic_task(
         crontab(minute=0),
-        tasks.maintain_oembed_cache,
+        tasks.maintain_oembed_cache.s(),
     )    
+
+    sender.add_periodic_task(
+        crontab(minute=0, hour=3),
+        tasks.compact_archive_segments.s(),
+    )
+
+    sender.add_periodic_task(
+        crontab(minute=30),
+        tasks.reconcile_storage_manifest.s(),
+    )
+
+    sender.add_periodic_task(
+        crontab(minute=0, hour=4),
+        tasks.scrub_local_files.s(),
+    )
+
+    sender.add_periodic_task(
+        crontab(minute=0, hour=5, day_of_week="Sunday"),
+        tasks.recalculate_storage_usage.s(),
+    )
+
+    sender.add_periodic_task(
+        crontab(minute=15),
+        tasks.refresh_admin_facets.s(),
+    )
+
+    sender.add_periodic_task(
+        crontab(minute="*/10"),
+        tasks.reap_deleted_files.s(),
+    )
@@ -81,6 +81,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'filehost.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -186,4 +187,118 @@ CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND')
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TIMEZONE = 'Pacific/Auckland'
\ No newline at end of file
+CELERY_TIMEZONE = 'Pacific/Auckland'
+
+# Negotiated Image Delivery
+# When enabled, raw requests for IMAGE files are served in the best format the client accepts (see filehost/negotiation.py)
+
+NEGOTIATE_IMAGE_FORMATS = env.bool('NEGOTIATE_IMAGE_FORMATS', default=False)
+# Formats to offer in order of preference, only formats that Pillow can encode should be listed here.
+# Variants are converted in the thumbnail sandbox, with the THUMBNAIL_* limits below
+NEGOTIATION_FORMATS = env.list('NEGOTIATION_FORMATS', default=['image/avif', 'image/webp'])
+
+
+# Thumbnails
+# Previews are rendered in a sandboxed child process (see filehost/sandbox.py), files that pass these limits get the SVG placeholder
+
+# Address space the renderer (and any converter it starts, eg: LibreOffice) may use in bytes, this includes what the worker had mapped when it forked
+THUMBNAIL_MEMORY_LIMIT = env.int('THUMBNAIL_MEMORY_LIMIT', default=2147483648)
+# CPU seconds and wall-clock seconds a preview may take
+THUMBNAIL_CPU_LIMIT = env.int('THUMBNAIL_CPU_LIMIT', default=60)
+THUMBNAIL_TIMEOUT = env.int('THUMBNAIL_TIMEOUT', default=120)
+# Images with more pixels than this are not decoded (Pillow's decompression bomb check)
+THUMBNAIL_MAX_IMAGE_PIXELS = env.int('THUMBNAIL_MAX_IMAGE_PIXELS', default=50000000)
+
+
+# Video Renditions
+# Videos are transcoded into an HLS ladder (see filehost/renditions.py) by ffmpeg in a sandboxed child process limited by these.
+# Off by default as it needs ffmpeg on the workers and a transcodes queue to be consumed
+
+HLS_RENDITIONS = env.bool('HLS_RENDITIONS', default=False)
+# Address space ffmpeg may use in bytes, CPU seconds it may use and wall-clock seconds a transcode may take
+HLS_MEMORY_LIMIT = env.int('HLS_MEMORY_LIMIT', default=4294967296)
+HLS_CPU_LIMIT = env.int('HLS_CPU_LIMIT', default=14400)
+HLS_TIMEOUT = env.int('HLS_TIMEOUT', default=7200)
+# Browsers without native HLS play the ladder with hls.js from HLS_JS_URL. It is only loaded once HLS_JS_INTEGRITY is set to its
+# Subresource Integrity hash, so that a copy changed on the CDN is refused, until then those browsers play the original. To generate it:
+# curl -sL <HLS_JS_URL> | openssl dgst -sha384 -binary | openssl base64 -A  (then prefix the output with sha384-)
+HLS_JS_URL = env('HLS_JS_URL', default='https://cdn.jsdelivr.net/npm/hls.js@1.5.8/dist/hls.min.js')
+HLS_JS_INTEGRITY = env('HLS_JS_INTEGRITY', default='')
+
+
+# File Expiry
+# Expired files are streamed in chunks and handed to sub-tasks, at most EXPIRY_MAX_CONCURRENT_BATCHES chunks are processed at once
+
+EXPIRY_CHUNK_SIZE = env.int('EXPIRY_CHUNK_SIZE', default=200)
+EXPIRY_MAX_CONCURRENT_BATCHES = env.int('EXPIRY_MAX_CONCURRENT_BATCHES', default=4)
+# Files left moving for longer than this (seconds) are assumed to have been interrupted and are resumed by the next expiry run
+EXPIRY_STALE_MOVING_AFTER = env.int('EXPIRY_STALE_MOVING_AFTER', default=21600)
+
+
+# Read-through De-archiving
+# When enabled, raw requests for ARCHIVED files are streamed from the NAS while the file is de-archived (see filehost/readthrough.py)
+
+READ_THROUGH_ARCHIVE = env.bool('READ_THROUGH_ARCHIVE', default=True)
+# Longest time (seconds) a request to a file's status endpoint is held open waiting for the file to be de-archived, clients poll
+# again once it passes. Each waiting request holds a web worker, only raise this with an async or gevent worker class (see README.md)
+FILE_STATUS_MAX_WAIT = env.int('FILE_STATUS_MAX_WAIT', default=5)
+
+
+# Metrics
+# Prometheus metrics are served at /metrics to these addresses (and to superusers), see filehost/metrics.py.
+# Addresses are matched against the connecting address (REMOTE_ADDR), X-Forwarded-For is ignored as any client can set it.
+# Set PROMETHEUS_MULTIPROC_DIR in the environment of every gunicorn and celery worker to aggregate their metrics
+
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=['127.0.0.1'])
+
+
+# Request Profiling
+# Superusers can profile a single request with the X-Profile header or ?_profile=1, see filehost/profiling.py
+
+PROFILE_REPORT_ROOT = env('PROFILE_REPORT_ROOT', default=os.path.join(BASE_DIR, '../profiles/'))
+# Number of reports kept, the oldest are removed as new ones are saved
+PROFILE_REPORTS_KEPT = env.int('PROFILE_REPORTS_KEPT', default=100)
+
+
+# NAS Archive
+# Connection details and tuning for the SFTP archive (see filehost/nas.py and filehost/segments.py)
+
+NAS_HOST = env('NAS_HOST')
+NAS_SFTP_PORT = env('NAS_SFTP_PORT')
+NAS_USERNAME = env('NAS_USERNAME')
+NAS_PATH = env('NAS_PATH')
+NAS_PRIVATE_KEY_PATH = env('NAS_PRIVATE_KEY_PATH')
+
+# Maximum number of idle authenticated sessions kept per worker process
+NAS_POOL_SIZE = env.int('NAS_POOL_SIZE', default=4)
+# Idle sessions older than this (seconds) are closed instead of reused
+NAS_POOL_IDLE_TIMEOUT = env.int('NAS_POOL_IDLE_TIMEOUT', default=300)
+# Sessions idle for longer than this (seconds) get a round trip liveness check before being reused
+NAS_POOL_CHECK_AFTER = env.int('NAS_POOL_CHECK_AFTER', default=30)
+
+# Number of files transferred concurrently, each over its own pooled session
+NAS_TRANSFER_WORKERS = env.int('NAS_TRANSFER_WORKERS', default=4)
+# Number of outstanding read requests paramiko keeps in flight while prefetching a get
+NAS_PREFETCH_REQUESTS = env.int('NAS_PREFETCH_REQUESTS', default=64)
+
+# Uncompressed files at least this size (bytes) are split into chunks that are transferred over several sessions at once
+NAS_CHUNKED_TRANSFER_THRESHOLD = env.int('NAS_CHUNKED_TRANSFER_THRESHOLD', default=268435456)
+NAS_CHUNK_SIZE = env.int('NAS_CHUNK_SIZE', default=67108864)
+# Number of chunks of a single file transferred concurrently, each over its own pooled session. Only sessions that would not take
+# the process past NAS_POOL_SIZE are used, chunks of files transferred while the pool is busy are sent one at a time
+NAS_CHUNK_WORKERS = env.int('NAS_CHUNK_WORKERS', default=4)
+
+# Whether compressible files are compressed with zstd while being archived
+NAS_COMPRESSION = env.bool('NAS_COMPRESSION', default=True)
+NAS_COMPRESSION_LEVEL = env.int('NAS_COMPRESSION_LEVEL', default=3)
+# Files are only compressed when a sample of them compresses to less than this fraction of its size
+NAS_COMPRESSION_MAX_RATIO = env.float('NAS_COMPRESSION_MAX_RATIO', default=0.9)
+
+# Whether small files are packed into segments when they are archived
+NAS_SEGMENT_PACKING = env.bool('NAS_SEGMENT_PACKING', default=False)
+# Files up to this size (bytes) are packed, larger files are archived as their own file
+NAS_SEGMENT_MAX_FILE_SIZE = env.int('NAS_SEGMENT_MAX_FILE_SIZE', default=1048576)
+# Segments are sealed once they reach this size (bytes)
+NAS_SEGMENT_TARGET_SIZE = env.int('NAS_SEGMENT_TARGET_SIZE', default=268435456)
+# Sealed segments are compacted once this fraction of their bytes are dead
+NAS_SEGMENT_COMPACT_RATIO = env.float('NAS_SEGMENT_COMPACT_RATIO', default=0.5)
@@ -20,15 +20,16 @@ class LifecycleFileStorage(FileSystemStorage):
         url = super().url(name) # API/IMAGE/THUMBNAIL/gZ8tMsnP.png
         slug = os.path.basename(url).split('.')[0]
         domain = settings.ALLOWED_HOSTS[0]
-        uploaded_file = UploadedFile.objects.get(slug=slug)
 
-        if uploaded_file.state == UploadedFile.State.MOVING or uploaded_file.state == UploadedFile.State.ARCHIVED:
-            return f"https://{domain}/{slug}/thmb/" # We are unable to provide the raw file anyway so link to the thumbnail
-        
+        # Thumbnails are always served by the thumbnail view whatever state the file is in, so listings (which ask for
+        # the url of every file's thumbnail) do not need to look up each file
         if "THUMBNAIL" in url:
             return f"https://{domain}/{slug}/thmb/"
-        else:
-            return f"https://{domain}/{slug}/raw/"
+
+        state = UploadedFile.objects.filter(slug=slug).values_list('state', flat=True).first()
+        if state == UploadedFile.State.MOVING or state == UploadedFile.State.ARCHIVED:
+            return f"https://{domain}/{slug}/thmb/" # We are unable to provide the raw file anyway so link to the thumbnail
+        return f"https://{domain}/{slug}/raw/"
 
     def open(self, name: str, mode: str = ...) -> File:
         return super().open(name, mode)
@@ -0,0 +1,3 @@
+# Benchmarks for LFS, run with python -m benchmarks (see __main__.py).
+# Everything runs in-process against a throwaway database, a temporary MEDIA_ROOT and an SFTP server standing in for
+# the NAS, nothing is sent to the configured database, NAS or Celery broker.
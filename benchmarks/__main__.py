@@ -0,0 +1,110 @@
+import argparse, sys
+
+# python -m benchmarks run --mix default --requests 1000 --files 200
+# python -m benchmarks thumbnails --scales 1,4,16 --repeat 5
+# python -m benchmarks compare benchmark-results/base.json benchmark-results/head.json
+
+
+def run(args) -> int:
+    import random
+    from benchmarks.environment import benchmark_environment
+    from benchmarks.results import build_report, write_report, default_report_path
+
+    if args.database == "sqlite" and args.concurrency > 1:
+        print("Warning: sqlite only allows one writer at a time, concurrent uploads and expiry runs will wait on each other")
+    with benchmark_environment(database=args.database, keep=args.keep) as environment:
+        # Django has to be set up by the environment before anything that uses models is imported
+        from benchmarks import workloads
+        mix = workloads.parse_mix(args.mix)
+        extensions = [extension.strip().lower() for extension in args.samples.split(",")] if args.samples else None
+        rng = random.Random(args.seed)
+        workload = workloads.Workload(environment, workloads.load_corpus(extensions), rng, expire_batch=args.expire_batch)
+
+        print(f"Seeding {args.files} files")
+        seed = workload.seed(args.files)
+        if args.warmup:
+            print(f"Warming up with {args.warmup} operations")
+            workloads.run(workload, workloads.plan(mix, args.warmup, rng))
+
+        print(f"Running {args.requests} operations with a concurrency of {args.concurrency}")
+        nas_before, tasks_before = workloads.nas_transfers(), workloads.task_times()
+        samples, elapsed = workloads.run(workload, workloads.plan(mix, args.requests, rng), concurrency=args.concurrency)
+        extra = {
+            "seed": seed,
+            "nas_bytes": workloads.difference(nas_before, workloads.nas_transfers()),
+            "tasks": workloads.difference(tasks_before, workloads.task_times()),
+        }
+
+        from django.db import connection
+        config = {"mix": mix, "requests": args.requests, "files": args.files, "concurrency": args.concurrency, "warmup": args.warmup,
+                  "samples": extensions, "seed": args.seed, "expire_batch": args.expire_batch, "database": connection.vendor}
+        report = build_report(samples, elapsed, config, extra)
+
+    path = write_report(report, args.output or default_report_path("load"))
+    total = report["total"]
+    print(f"{total['count']} operations in {elapsed:.2f}s ({total['throughput_per_second']:.1f}/s), "
+          f"p50 {total['latency_ms']['p50']:.1f}ms, p99 {total['latency_ms']['p99']:.1f}ms, {total['errors']} errors")
+    print(f"Results written to {path}")
+    return 0
+
+def thumbnails(args) -> int:
+    from benchmarks.environment import benchmark_environment
+    from benchmarks.results import write_report, default_report_path
+
+    with benchmark_environment(database=args.database, keep=args.keep) as environment:
+        from benchmarks import thumbnails
+        extensions = [extension.strip().lower() for extension in args.samples.split(",")] if args.samples else None
+        scales = [int(scale) for scale in args.scales.split(",")]
+        report = thumbnails.run(environment, extensions, scales, repeat=args.repeat)
+
+    thumbnails.print_summary(report)
+    path = write_report(report, args.output or default_report_path("thumbnails"))
+    print(f"Results written to {path}")
+    return 0
+
+def compare(args) -> int:
+    from benchmarks.results import compare, load_report
+    compare(load_report(args.base), load_report(args.head))
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="LFS benchmarks against a throwaway database and a stand-in NAS")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run a load benchmark and write the results as JSON")
+    run_parser.add_argument("--mix", default="default", help="Named mix (default, read, upload, archive) or weights such as raw=40,thumbnail=20,upload=5")
+    run_parser.add_argument("--requests", type=int, default=500, help="Number of operations to time")
+    run_parser.add_argument("--files", type=int, default=100, help="Number of files uploaded before the run")
+    run_parser.add_argument("--samples", default="", help="Only use test uploads with these extensions, eg: png,txt,mp3")
+    run_parser.add_argument("--concurrency", type=int, default=1, help="Number of threads making requests, use the configured database for more than 1")
+    run_parser.add_argument("--warmup", type=int, default=20, help="Number of untimed operations run first")
+    run_parser.add_argument("--expire-batch", type=int, default=20, help="Number of files expired by each expiry run")
+    run_parser.add_argument("--database", choices=("sqlite", "configured"), default="sqlite",
+                            help="A temporary sqlite database, or a test database created on the configured database server")
+    run_parser.add_argument("--seed", type=int, default=0, help="Random seed for the operations and the files they use")
+    run_parser.add_argument("--output", help="Where to write the results, defaults to benchmark-results/")
+    run_parser.add_argument("--keep", action="store_true", help="Keep the benchmark's database, media and NAS files")
+    run_parser.set_defaults(handler=run)
+
+    thumbnails_parser = commands.add_parser("thumbnails", help="Time each stage of creating thumbnails for every test upload")
+    thumbnails_parser.add_argument("--samples", default="", help="Only use test uploads with these extensions, eg: png,pdf,zip")
+    thumbnails_parser.add_argument("--scales", default="1,4,16", help="Sizes to measure the scalable samples at, as multiples of the original")
+    thumbnails_parser.add_argument("--repeat", type=int, default=5, help="Number of times each thumbnail is created")
+    thumbnails_parser.add_argument("--database", choices=("sqlite", "configured"), default="sqlite",
+                                   help="A temporary sqlite database, or a test database created on the configured database server")
+    thumbnails_parser.add_argument("--output", help="Where to write the results, defaults to benchmark-results/")
+    thumbnails_parser.add_argument("--keep", action="store_true", help="Keep the benchmark's database and media files")
+    thumbnails_parser.set_defaults(handler=thumbnails)
+
+    compare_parser = commands.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+from unittest import mock
+from benchmarks.sftp_server import StandInNAS
+import os, secrets, shutil, tempfile
+
+# Sets up everything a benchmark run talks to without touching any real storage: a throwaway database (a temporary sqlite
+# file, or a test database created on the configured server), a temporary MEDIA_ROOT, the stand-in NAS and eager Celery.
+# The NAS and database settings are read from the environment by LFS/settings.py, so they are set before Django is set up.
+
+NAS_PATH = "/archive/"
+APP_ID = "benchmark"
+
+
+class BenchmarkEnvironment():
+    '''
+        Everything a run needs once the environment is up, see benchmark_environment
+    '''
+
+    def __init__(self, workdir: str, nas: StandInNAS, user, app_id: str, api_secret: str):
+        self.workdir = workdir
+        self.nas = nas
+        self.user = user
+        self.app_id = app_id
+        self.api_secret = api_secret
+
+    @property
+    def media_root(self) -> str:
+        return os.path.join(self.workdir, "media")
+
+
+def configure_environment(workdir: str, nas: StandInNAS, database: str):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'LFS.settings')
+    # The .env file does not override values that are already set
+    os.environ["NAS_HOST"] = "127.0.0.1"
+    os.environ["NAS_SFTP_PORT"] = str(nas.port)
+    os.environ["NAS_USERNAME"] = "benchmark"
+    os.environ["NAS_PATH"] = NAS_PATH
+    os.environ["NAS_PRIVATE_KEY_PATH"] = nas.client_key_path
+    if database == "sqlite":
+        os.environ["DB_ENGINE"] = "django.db.backends.sqlite3"
+        os.environ["DB_NAME"] = os.path.join(workdir, "benchmark.sqlite3")
+        for name in ("DB_USER", "DB_PASSWORD", "DB_HOST", "DB_PORT"):
+            os.environ[name] = ""
+
+def create_archive_directories(nas: StandInNAS):
+    '''
+        Creates the upload type and file type directories on the stand-in NAS, the real NAS already has these
+    '''
+    from filehost.models import UploadedFile
+    for upload_type, label in UploadedFile.UploadType.CHOICES:
+        for file_type, label in UploadedFile.FileType.CHOICES:
+            os.makedirs(os.path.join(nas.root, NAS_PATH.strip("/"), upload_type, file_type, "THUMBNAIL"), exist_ok=True)
+
+def create_api_user(api_secret: str):
+    '''
+        Creates the user and api key that benchmark uploads are made with.\n
+        Api secrets are hashed by i54m_apiuser, so the secret check is replaced for the run while the key lookup and
+        last accessed update still run against the database as they would in production
+    '''
+    from i54m_apiuser.models import ApiKey, ApiUser
+    user = ApiUser.objects.create(username="benchmark", password="benchmark")
+    ApiKey.objects.create(api_user=user, app_id=APP_ID)
+    secret_check = mock.patch.object(ApiKey, "has_valid_api_secret", lambda self, secret_key: secret_key == api_secret)
+    return user, secret_check
+
+
+@contextmanager
+def benchmark_environment(database="sqlite", keep=False):
+    '''
+        Starts the stand-in NAS, sets up Django against a throwaway database and yields a BenchmarkEnvironment.\n
+        database is "sqlite" for a temporary sqlite file or "configured" for a test database on the configured server.\n
+        The work directory (database, media, NAS files and keys) is removed afterwards unless keep is True
+    '''
+    workdir = tempfile.mkdtemp(prefix="lfs-benchmark-")
+    nas = StandInNAS(os.path.join(workdir, "nas"))
+    nas.start()
+    configure_environment(workdir, nas, database)
+
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test.utils import override_settings
+    from LFS.celery import app
+
+    # Tasks run in the process that queued them, their results are kept in memory as there is no broker or result backend
+    app.conf.task_always_eager = True
+    app.conf.task_store_eager_result = False
+    app.conf.result_backend = "cache+memory://"
+
+    old_database_name = None
+    if database == "sqlite":
+        call_command("migrate", verbosity=0, interactive=False)
+    else:
+        old_database_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    create_archive_directories(nas)
+    media_root = os.path.join(workdir, "media")
+    os.makedirs(media_root, exist_ok=True)
+    # Requests are made by the test client, which uses testserver as its host
+    settings_override = override_settings(MEDIA_ROOT=media_root, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"], DEBUG=False)
+    api_secret = secrets.token_urlsafe(32)
+    try:
+        with settings_override:
+            user, secret_check = create_api_user(api_secret)
+            with secret_check:
+                yield BenchmarkEnvironment(workdir, nas, user, APP_ID, api_secret)
+    finally:
+        from filehost import nas as filehost_nas
+        filehost_nas.pool.close_all()
+        nas.stop()
+        if old_database_name is not None:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+        connection.close()
+        if keep:
+            print(f"Benchmark files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,141 @@
+import json, math, os, platform, subprocess, sys, time
+
+# Benchmark results are written as JSON so that runs from different commits can be compared, see compare().
+# Latencies are in milliseconds, byte counts cover request and response bodies as well as SFTP transfers to the stand-in NAS.
+
+RESULTS_VERSION = 1
+
+
+class Sample():
+    '''
+        One timed operation
+    '''
+    __slots__ = ("operation", "seconds", "status", "queries", "query_seconds", "request_bytes", "response_bytes", "nas_bytes", "error")
+
+    def __init__(self, operation: str, seconds: float, status=None, queries=0, query_seconds=0.0, request_bytes=0, response_bytes=0, nas_bytes=0, error=None):
+        self.operation = operation
+        self.seconds = seconds
+        self.status = status
+        self.queries = queries
+        self.query_seconds = query_seconds
+        self.request_bytes = request_bytes
+        self.response_bytes = response_bytes
+        self.nas_bytes = nas_bytes
+        self.error = error
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None or (self.status is not None and self.status >= 500)
+
+
+def percentile(values, fraction: float) -> float:
+    '''
+        Nearest rank percentile of values, fraction is between 0 and 1.\n
+        returns: the percentile, or 0 if there are no values
+    '''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+def summarise(samples, elapsed: float) -> dict:
+    '''
+        Latency percentiles, throughput, queries and bytes moved for a set of samples of the same operation
+    '''
+    latencies = [sample.seconds * 1000 for sample in samples]
+    count = len(samples)
+    return {
+        "count": count,
+        "errors": sum(1 for sample in samples if sample.failed),
+        "statuses": {str(status): sum(1 for sample in samples if sample.status == status) for status in sorted({sample.status for sample in samples if sample.status is not None})},
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p90": percentile(latencies, 0.90),
+            "p99": percentile(latencies, 0.99),
+            "mean": sum(latencies) / count if count else 0.0,
+            "max": max(latencies, default=0.0),
+        },
+        "throughput_per_second": count / elapsed if elapsed > 0 else 0.0,
+        "queries_per_request": sum(sample.queries for sample in samples) / count if count else 0.0,
+        "query_ms_per_request": sum(sample.query_seconds for sample in samples) * 1000 / count if count else 0.0,
+        "bytes": {
+            "request": sum(sample.request_bytes for sample in samples),
+            "response": sum(sample.response_bytes for sample in samples),
+            "nas": sum(sample.nas_bytes for sample in samples),
+        },
+    }
+
+def build_report(samples, elapsed: float, config: dict, extra=None) -> dict:
+    operations = {}
+    for sample in samples:
+        operations.setdefault(sample.operation, []).append(sample)
+    report = {
+        "version": RESULTS_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "elapsed_seconds": elapsed,
+        "total": summarise(samples, elapsed),
+        "operations": {operation: summarise(operation_samples, elapsed) for operation, operation_samples in sorted(operations.items())},
+    }
+    report.update(extra or {})
+    return report
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_report(report: dict, path: str) -> str:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
+
+def default_report_path(kind: str) -> str:
+    return os.path.join("benchmark-results", f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{current_commit() or 'unknown'}.json")
+
+
+# (label, path into each operation's summary)
+COMPARED_FIELDS = (
+    ("p50 ms", ("latency_ms", "p50")),
+    ("p99 ms", ("latency_ms", "p99")),
+    ("ops/s", ("throughput_per_second",)),
+    ("queries", ("queries_per_request",)),
+)
+
+def field(summary: dict, path):
+    for key in path:
+        summary = summary.get(key, {}) if isinstance(summary, dict) else {}
+    return summary if isinstance(summary, (int, float)) else None
+
+def compare(base: dict, head: dict, out=sys.stdout):
+    '''
+        Prints each operation's latency, throughput and queries per request in base and head and the change between them
+    '''
+    out.write(f"base: {base.get('commit')} ({base.get('created_at')})  head: {head.get('commit')} ({head.get('created_at')})\n")
+    operations = sorted(set(base["operations"]) | set(head["operations"]))
+    for operation in ["total", *operations]:
+        base_summary = base["total"] if operation == "total" else base["operations"].get(operation)
+        head_summary = head["total"] if operation == "total" else head["operations"].get(operation)
+        if base_summary is None or head_summary is None:
+            out.write(f"{operation:<12} only in {'head' if base_summary is None else 'base'}\n")
+            continue
+        columns = []
+        for label, path in COMPARED_FIELDS:
+            before, after = field(base_summary, path), field(head_summary, path)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+            columns.append(f"{label} {before:.2f} -> {after:.2f} ({change})")
+        out.write(f"{operation:<12} " + "  ".join(columns) + "\n")
+
+def load_report(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,186 @@
+import paramiko
+import os, socket, threading
+
+# An SFTP server run in a background thread that stands in for the NAS during benchmarks. Remote paths are mapped into a
+# local directory and any public key is accepted, so the real nas.py code paths (session pool, handshakes, prefetching,
+# chunked transfers, posix-rename) are exercised over a real SSH transport without any network or NAS involved.
+
+
+class AcceptingServer(paramiko.ServerInterface):
+    '''
+        Accepts any public key and only allows SFTP sessions
+    '''
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class LocalSFTPInterface(paramiko.SFTPServerInterface):
+    '''
+        Serves the files under root, the remote path /archive/API/IMAGE/abc.png is root/archive/API/IMAGE/abc.png
+    '''
+
+    def __init__(self, server, root: str, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def list_folder(self, path):
+        local_path = self.local_path(path)
+        try:
+            entries = []
+            for name in os.listdir(local_path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        local_path = self.local_path(path)
+        try:
+            fd = os.open(local_path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = LocalHandle(flags)
+        handle.filename = local_path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self.local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        local_newpath = self.local_path(newpath)
+        # Plain SFTP renames refuse to overwrite, posix_rename below does not
+        if os.path.exists(local_newpath):
+            return paramiko.SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.replace(self.local_path(oldpath), self.local_path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.local_path(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class StandInNAS():
+    '''
+        SFTP server on 127.0.0.1 serving root, use client_key_path as the NAS private key.\n
+        Each connection gets its own transport thread, as the NAS would
+    '''
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key_path = os.path.join(os.path.dirname(os.path.abspath(root)), "nas_client_key")
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.client_key_path)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(32)
+        self.port = self.listener.getsockname()[1]
+        self.transports = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._accept_connections, name="stand-in-nas", daemon=True)
+        self._thread.start()
+
+    def _accept_connections(self):
+        while not self._stopped.is_set():
+            try:
+                client, address = self.listener.accept()
+            except OSError:
+                break # listener closed by stop()
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client: socket.socket):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSFTPInterface, self.root)
+        self.transports.append(transport)
+        try:
+            transport.start_server(server=AcceptingServer())
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            print(f"Stand-in NAS failed to negotiate a connection: {e}")
+            transport.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,203 @@
+from django.core.files.base import ContentFile
+from django.db import connection, connections
+from benchmarks.results import Sample, build_report, percentile
+from benchmarks.workloads import load_corpus
+from filehost.models import UploadedFile
+from filehost.profiling import QueryTimer
+import io, math, multiprocessing, os, resource, time, zipfile
+
+# Micro-benchmarks of create_thumbnail for each test upload, and for larger synthetic copies of the ones that can be scaled.
+# Every sample is measured in its own forked process so that its peak RSS (and that of the sandboxed renderer, including
+# any LibreOffice or ffmpeg process it starts) is not hidden by earlier samples. Each run gets an empty preview cache, as preview_generator
+# would otherwise return the preview it made on the first run. The stages are those recorded by create_thumbnail.
+
+
+def scale_image(name: str, content: bytes, factor: int) -> bytes:
+    from PIL import Image
+    with Image.open(io.BytesIO(content)) as img:
+        side = math.sqrt(factor)
+        scaled = img.resize((int(img.width * side), int(img.height * side)))
+        output = io.BytesIO()
+        scaled.save(output, format=img.format)
+    return output.getvalue()
+
+def repeat_text(name: str, content: bytes, factor: int) -> bytes:
+    if not content.endswith(b"\n"):
+        content += b"\n"
+    return content * factor
+
+def repeat_json(name: str, content: bytes, factor: int) -> bytes:
+    return b"[" + b",".join([content] * factor) + b"]"
+
+def repeat_zip_entries(name: str, content: bytes, factor: int) -> bytes:
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(content)) as source, zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as scaled:
+        for copy in range(factor):
+            for entry in source.infolist():
+                scaled.writestr(f"copy{copy}/{entry.filename}", source.read(entry))
+    return output.getvalue()
+
+# How each kind of sample is made factor times larger, samples of any other type are only measured as they are
+SCALERS = {
+    "png": scale_image,
+    "jpg": scale_image,
+    "jpeg": scale_image,
+    "txt": repeat_text,
+    "csv": repeat_text,
+    "obj": repeat_text,
+    "json": repeat_json,
+    "zip": repeat_zip_entries,
+}
+
+
+def variants(corpus: list, scales: list) -> list:
+    '''
+        The samples to measure, each original and its scaled copies.\n
+        returns: a list of (label, file name, content)
+    '''
+    found = []
+    for name, content in corpus:
+        extension = name.rsplit(".", 1)[-1].lower()
+        for factor in scales:
+            if factor == 1:
+                found.append((name, name, content))
+            elif extension in SCALERS:
+                found.append((f"{name} x{factor}", name, SCALERS[extension](name, content, factor)))
+    return found
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def reset_peak_rss() -> bool:
+    '''
+        Resets the peak RSS reported in /proc/self/status (Linux 4.0+) so it only covers what happens next
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss(reset: bool) -> int:
+    if reset:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    # Without a reset the peak includes whatever the parent used before forking
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def thumbnail_runs(slug: str, repeat: int, cache_root: str, sender):
+    '''
+        Runs in the forked process, creates the thumbnail repeat times and sends back the timings and memory use
+    '''
+    from preview_generator.manager import PreviewManager
+    from filehost.tasks import create_thumbnail
+    try:
+        rss_before = current_rss()
+        reset = reset_peak_rss()
+        runs = []
+        for index in range(repeat):
+            manager = PreviewManager(os.path.join(cache_root, f"{slug}-{index}"), create_folder=True)
+            timings = {}
+            query_timer = QueryTimer()
+            start = time.perf_counter()
+            with connection.execute_wrapper(query_timer):
+                thumbnail = create_thumbnail(slug, manager=manager, timings=timings)
+            runs.append({
+                "seconds": time.perf_counter() - start,
+                "stages": timings,
+                "queries": len(query_timer.queries),
+                "query_seconds": sum(duration for duration, sql in query_timer.queries),
+                "thumbnail": thumbnail,
+            })
+        sender.send({
+            "runs": runs,
+            "rss_before_bytes": rss_before,
+            "peak_rss_bytes": peak_rss(reset),
+            "subprocess_peak_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        })
+    except Exception as e:
+        sender.send({"error": repr(e)})
+    finally:
+        sender.close()
+        connection.close()
+
+def measure(slug: str, repeat: int, cache_root: str) -> dict:
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    # The child opens its own database connections rather than sharing the parent's
+    connections.close_all()
+    process = context.Process(target=thumbnail_runs, args=(slug, repeat, cache_root, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": "the thumbnail process exited without a result"}
+    process.join()
+    if process.exitcode:
+        result.setdefault("error", f"the thumbnail process exited with code {process.exitcode}")
+    return result
+
+
+def run(environment, extensions=None, scales=(1,), repeat=5) -> dict:
+    '''
+        Measures create_thumbnail for every sample and scaled variant.\n
+        returns: the report, in the same layout as the load benchmark so that results can be compared the same way
+    '''
+    cache_root = os.path.join(environment.workdir, "preview-cache")
+    samples = []
+    details = {}
+    start = time.perf_counter()
+    for label, name, content in variants(load_corpus(extensions), scales):
+        # Saving makes the first thumbnail with the default preview manager, which also loads everything the pipeline
+        # imports before the measured processes are forked
+        uploaded_file = UploadedFile(file=ContentFile(content, name=name), upload_type=UploadedFile.UploadType.API, uploader=environment.user,
+                                     persistent=False, featured=False, access=UploadedFile.Access.PUBLIC)
+        uploaded_file.set_expiration(months=3)
+        uploaded_file.save()
+        print(f"Measuring {label} ({len(content)} bytes, {uploaded_file.mime_type})")
+
+        result = measure(uploaded_file.slug, repeat, cache_root)
+        details[label] = {
+            "size_bytes": len(content),
+            "mime_type": uploaded_file.mime_type,
+            "file_type": uploaded_file.file_type,
+            "error": result.get("error"),
+        }
+        runs = result.get("runs", [])
+        for measured in runs:
+            samples.append(Sample(label, measured["seconds"], queries=measured["queries"], query_seconds=measured["query_seconds"], error=result.get("error")))
+        if not runs:
+            samples.append(Sample(label, 0.0, error=result.get("error")))
+            continue
+
+        stages = sorted({stage for measured in runs for stage in measured["stages"]})
+        details[label].update({
+            "thumbnail": runs[-1]["thumbnail"],
+            "stages_ms": {stage: {
+                "p50": percentile([measured["stages"].get(stage, 0.0) * 1000 for measured in runs], 0.50),
+                "mean": sum(measured["stages"].get(stage, 0.0) for measured in runs) * 1000 / len(runs),
+            } for stage in stages},
+            "rss_before_bytes": result["rss_before_bytes"],
+            "peak_rss_bytes": result["peak_rss_bytes"],
+            "subprocess_peak_rss_bytes": result["subprocess_peak_rss_bytes"],
+        })
+
+    report = build_report(samples, time.perf_counter() - start, {"samples": extensions, "scales": list(scales), "repeat": repeat, "database": connection.vendor})
+    for label, detail in details.items():
+        report["operations"][label].update(detail)
+    return report
+
+def print_summary(report: dict):
+    for label, summary in report["operations"].items():
+        if summary.get("error"):
+            print(f"{label:<40} failed: {summary['error']}")
+            continue
+        stages = ", ".join(f"{stage} {timing['p50']:.1f}" for stage, timing in summary.get("stages_ms", {}).items())
+        print(f"{label:<40} p50 {summary['latency_ms']['p50']:8.1f}ms  peak rss {summary['peak_rss_bytes'] / 1048576:7.1f}MiB  "
+              f"subprocess {summary['subprocess_peak_rss_bytes'] / 1048576:7.1f}MiB  {summary.get('thumbnail')}  ({stages})")
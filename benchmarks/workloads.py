@@ -0,0 +1,242 @@
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from benchmarks.results import Sample
+from filehost.models import UploadedFile
+from filehost.profiling import QueryTimer
+from filehost import metrics
+from pathlib import Path
+import os, random, threading, time
+
+# Operations are drawn at random from a weighted mix and driven through the Django test client, so each request runs the
+# whole middleware stack and view against the benchmark database and the stand-in NAS. Celery is eager so any tasks a
+# request queues (thumbnails for uploads, de-archiving for archived files) are included in that request's latency.
+# Queries are counted on the connection of the thread making the request, queries made by NAS transfer threads are not.
+
+CORPUS_ROOT = Path(__file__).resolve().parent.parent / "filehost" / "test_file_uploads"
+
+OPERATIONS = ("upload", "raw", "thumbnail", "formatted", "oembed", "expiry")
+MIXES = {
+    "default": {"raw": 35, "thumbnail": 25, "formatted": 10, "oembed": 10, "upload": 18, "expiry": 2},
+    "read": {"raw": 50, "thumbnail": 30, "formatted": 10, "oembed": 10},
+    "upload": {"upload": 80, "thumbnail": 20},
+    "archive": {"expiry": 10, "raw": 60, "thumbnail": 30},
+}
+# Accept header sent with raw fetches, images are then served in a negotiated format when that is enabled
+RAW_ACCEPT = "image/avif,image/webp,image/*,*/*;q=0.8"
+
+
+def parse_mix(value: str) -> dict:
+    '''
+        Parses a named mix or weights such as "raw=40,thumbnail=20,upload=5".\n
+        returns: the weight of each operation
+    '''
+    if value in MIXES:
+        return dict(MIXES[value])
+    mix = {}
+    for part in value.split(","):
+        name, separator, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS or not separator:
+            raise ValueError(f"Unknown operation weight: {part!r}, operations are {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError("The mix must have at least one operation with a positive weight")
+    return mix
+
+def load_corpus(extensions=None) -> list:
+    '''
+        Reads the test uploads used for seeding and uploading, optionally only those with the given extensions.\n
+        returns: a list of (file name, content)
+    '''
+    corpus = []
+    for path in sorted(CORPUS_ROOT.iterdir()):
+        if not path.is_file():
+            continue
+        if extensions and path.suffix.lstrip(".").lower() not in extensions:
+            continue
+        corpus.append((path.name, path.read_bytes()))
+    if not corpus:
+        raise ValueError(f"No files in {CORPUS_ROOT} match the extensions: {', '.join(extensions)}")
+    return corpus
+
+def nas_bytes() -> float:
+    return sum(REGISTRY.get_sample_value("lfs_sftp_transfer_bytes_total", {"direction": direction}) or 0 for direction in (metrics.UPLOAD, metrics.DOWNLOAD))
+
+def nas_transfers() -> dict:
+    return {direction: REGISTRY.get_sample_value("lfs_sftp_transfer_bytes_total", {"direction": direction}) or 0 for direction in (metrics.UPLOAD, metrics.DOWNLOAD)}
+
+def task_times() -> dict:
+    '''
+        Number of runs and total run time of each task so far, from the task metrics
+    '''
+    times = {}
+    for family in REGISTRY.collect():
+        if family.name != "lfs_task_seconds":
+            continue
+        for sample in family.samples:
+            if sample.name.endswith("_count"):
+                times.setdefault(sample.labels["task"], {"count": 0, "seconds": 0.0})["count"] += int(sample.value)
+            elif sample.name.endswith("_sum"):
+                times.setdefault(sample.labels["task"], {"count": 0, "seconds": 0.0})["seconds"] += sample.value
+    return times
+
+def difference(before: dict, after: dict) -> dict:
+    changed = {}
+    for key, value in after.items():
+        if isinstance(value, dict):
+            changed[key] = {name: amount - before.get(key, {}).get(name, 0) for name, amount in value.items()}
+        else:
+            changed[key] = value - before.get(key, 0)
+    return changed
+
+def consume(response) -> int:
+    '''
+        Reads the whole response body, as a client would.\n
+        returns: the size of the body
+    '''
+    try:
+        if response.streaming:
+            return sum(len(chunk) for chunk in response.streaming_content)
+        return len(response.content)
+    finally:
+        response.close()
+
+
+class Workload():
+    '''
+        Builds each operation's request against the files uploaded so far
+    '''
+
+    def __init__(self, environment, corpus: list, rng: random.Random, expire_batch=20):
+        self.environment = environment
+        self.corpus = corpus
+        self.rng = rng
+        self.expire_batch = expire_batch
+        self.slugs = []
+        self.lock = threading.Lock()
+
+    def add_slug(self, slug: str):
+        with self.lock:
+            self.slugs.append(slug)
+
+    def random_slug(self) -> str:
+        with self.lock:
+            return self.rng.choice(self.slugs)
+
+    def seed(self, count: int) -> dict:
+        '''
+            Uploads count files from the corpus straight through the model, thumbnails are created as they are saved
+        '''
+        start = time.perf_counter()
+        for index in range(count):
+            name, content = self.corpus[index % len(self.corpus)]
+            uploaded_file = UploadedFile(file=ContentFile(content, name=name), upload_type=UploadedFile.UploadType.API, uploader=self.environment.user,
+                                         persistent=False, featured=False, access=UploadedFile.Access.PUBLIC)
+            uploaded_file.set_expiration(months=3)
+            uploaded_file.save()
+            self.add_slug(uploaded_file.slug)
+            if (index + 1) % 50 == 0:
+                print(f"Seeded {index + 1} of {count} files")
+        return {"files": count, "seconds": time.perf_counter() - start}
+
+    # Each operation returns the size of the request body and a function that makes the request with a client
+
+    def upload(self):
+        name, content = self.rng.choice(self.corpus)
+        upload = SimpleUploadedFile(name, content)
+        headers = {"HTTP_APP_ID": self.environment.app_id, "HTTP_API_SECRET": self.environment.api_secret, "HTTP_PERSISTENT": "false", "HTTP_FEATURED": "false"}
+
+        def send(client: Client):
+            response = client.post(reverse("filehost:api-upload"), {"file": upload}, **headers)
+            if response.status_code == 200:
+                self.add_slug(os.path.basename(response.json()["data"]["url"]))
+            return response
+        return len(content), send
+
+    def raw(self):
+        url = reverse("filehost:fetch-file-raw", kwargs={"slug": self.random_slug()})
+        return 0, lambda client: client.get(url, HTTP_ACCEPT=RAW_ACCEPT)
+
+    def thumbnail(self):
+        url = reverse("filehost:fetch-file-thumbnail", kwargs={"slug": self.random_slug()})
+        return 0, lambda client: client.get(url)
+
+    def formatted(self):
+        url = reverse("filehost:fetch-file-formatted", kwargs={"slug": self.random_slug()})
+        return 0, lambda client: client.get(url)
+
+    def oembed(self):
+        params = {"url": f"https://testserver/{self.random_slug()}", "format": self.rng.choice(("json", "xml")), "maxwidth": 640, "maxheight": 480}
+        return 0, lambda client: client.get(reverse("filehost:oembed"), params)
+
+    def expiry(self):
+        # Expire a random batch of local files before the run so that marking them is not timed
+        with self.lock:
+            slugs = self.rng.sample(self.slugs, min(self.expire_batch, len(self.slugs)))
+        UploadedFile.objects.filter(slug__in=slugs, state=UploadedFile.State.LOCAL).update(expiration_date=timezone.localdate() - timezone.timedelta(days=1))
+
+        def send(client: Client):
+            from filehost.tasks import expire_files # the batches run eagerly inside this call
+            return expire_files()
+        return 0, send
+
+
+def measure(workload: Workload, client: Client, operation: str) -> Sample:
+    request_bytes, send = getattr(workload, operation)()
+    nas_before = nas_bytes()
+    query_timer = QueryTimer()
+    status = None
+    response_bytes = 0
+    error = None
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(query_timer):
+            response = send(client)
+            if hasattr(response, "status_code"):
+                status = response.status_code
+                response_bytes = consume(response)
+    except Exception as e:
+        error = repr(e)
+    seconds = time.perf_counter() - start
+    return Sample(operation, seconds, status=status, queries=len(query_timer.queries), query_seconds=sum(duration for duration, sql in query_timer.queries),
+                  request_bytes=request_bytes, response_bytes=response_bytes, nas_bytes=int(nas_bytes() - nas_before), error=error)
+
+def plan(mix: dict, count: int, rng: random.Random) -> list:
+    operations = [operation for operation in mix if mix[operation] > 0]
+    return rng.choices(operations, weights=[mix[operation] for operation in operations], k=count)
+
+def run(workload: Workload, operations: list, concurrency=1) -> tuple:
+    '''
+        Runs the operations split across concurrency threads, each with its own client and database connection.\n
+        NAS bytes are attributed to the operation that was running when they moved, this is only exact with a concurrency of 1.\n
+        returns: the samples and the time taken to run them all
+    '''
+    samples = []
+    samples_lock = threading.Lock()
+
+    def run_operations(assigned, close_connection):
+        client = Client(raise_request_exception=False)
+        try:
+            for operation in assigned:
+                sample = measure(workload, client, operation)
+                with samples_lock:
+                    samples.append(sample)
+        finally:
+            if close_connection:
+                connection.close()
+
+    start = time.perf_counter()
+    if concurrency <= 1:
+        run_operations(operations, close_connection=False)
+    else:
+        threads = [threading.Thread(target=run_operations, args=(operations[index::concurrency], True)) for index in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return samples, time.perf_counter() - start
@@ -1,15 +1,25 @@
 from django.contrib import admin, messages
+from django.http import JsonResponse, HttpResponseNotAllowed, HttpResponseRedirect
+from django.urls import path, reverse
+from django.utils.html import format_html
+from celery.result import AsyncResult
 from django.contrib.admin import actions
+from django.core.exceptions import PermissionDenied
 from django.utils import timezone
-from .models import UploadedFile
-from filehost import tasks
+from .models import UploadedFile, StorageUsage, UserQuota
+from filehost import tasks, usage, bulk, deletion
+from filehost.changelist import EstimatedCountPaginator, MimeTypeFilter
 
 class UploadedFileAdmin(admin.ModelAdmin):
     list_display = ("slug", "uploaded_at", "expiration_date", "state", "upload_type", "file_type", "mime_type", "has_thumbnail_image", "persistent", "featured", "uploader", "access")
-    readonly_fields = ("file", "slug", "uploaded_at", "state", "upload_type", "file_type", "mime_type", "thumbnail")
+    readonly_fields = ("file", "slug", "uploaded_at", "state", "upload_type", "file_type", "mime_type", "thumbnail", "size")
     ordering = ("-uploaded_at", "slug",)
-    list_filter = ['upload_type', 'state', 'access', 'persistent', 'featured', 'file_type', 'mime_type']
+    list_filter = ['upload_type', 'state', 'access', 'persistent', 'featured', 'file_type', MimeTypeFilter]
     search_fields = ['slug']
+    list_select_related = ('uploader',)
+    # Avoid exact counts over the whole table, see filehost/changelist.py
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def has_delete_permission(self, request, obj=None, *args, **kwargs):
         if obj is not None and obj.persistent:
@@ -33,6 +43,13 @@ class UploadedFileAdmin(admin.ModelAdmin):
 
         return actions.delete_selected(self, request, queryset)
 
+    def delete_queryset(self, request, queryset):
+        # Files are hidden straight away and removed by the reaper in the background, see filehost/deletion.py
+        deletion.mark_for_deletion(list(queryset.values_list('pk', flat=True)))
+
+    def delete_model(self, request, obj):
+        obj.mark_for_deletion()
+
     def expire_today(self, request, queryset):
         if queryset.filter(persistent=True).count() > 0:
             messages.error(request, (
@@ -42,22 +59,16 @@ class UploadedFileAdmin(admin.ModelAdmin):
             return
         
         else:
-            for uploaded_file in queryset:
-                uploaded_file.expiration_date = timezone.localdate()
-                uploaded_file.save()
-            messages.success(request, (
+            self.run_bulk_action(request, queryset, bulk.EXPIRE_TODAY, (
                     "The selected files have been set to expire today! "
                     "They will be expired and moved once the task runs."
                 ))
             return
             
     def take_ownership(self, request, queryset):
-        for uploaded_file in queryset:
-            uploaded_file.uploader = request.user
-            uploaded_file.save()
-        messages.success(request, (
+        self.run_bulk_action(request, queryset, bulk.TAKE_OWNERSHIP, (
                 "You are now the uploader/owner of the selected files!"
-            ))
+            ), params={'uploader_id': request.user.pk})
     
     def archive_selected(self, request, queryset):
         if queryset.filter(persistent=True).count() > 0:
@@ -101,30 +112,103 @@ class UploadedFileAdmin(admin.ModelAdmin):
     
 
     def private_selected(self, request, queryset):
-        for uf in queryset:
-            uf.access = UploadedFile.Access.PRIVATE
-            uf.save()
-        messages.success(request, (
+        self.run_bulk_action(request, queryset, bulk.PRIVATE, (
                     "The selected files are now set to private! "
                 ))
         
     def members_only_selected(self, request, queryset):
-        for uf in queryset:
-            uf.access = UploadedFile.Access.MEMBERS_ONLY
-            uf.save()
-        messages.success(request, (
+        self.run_bulk_action(request, queryset, bulk.MEMBERS_ONLY, (
                     "The selected files are now set to members only! "
                 ))
     
     def public_selected(self, request, queryset):
-        for uf in queryset:
-            uf.access = UploadedFile.Access.PUBLIC
-            uf.save()
-        messages.success(request, (
+        self.run_bulk_action(request, queryset, bulk.PUBLIC, (
                     "The selected files are now set to public! "
                 ))
 
+    def run_bulk_action(self, request, queryset, action, success_message, params=None):
+        """
+        Applies a bulk action with chunked updates, large selections are handed to a background task so the admin request does not time out
+        """
+        slugs = list(queryset.values_list('pk', flat=True))
+        if len(slugs) > bulk.BACKGROUND_THRESHOLD:
+            result = tasks.bulk_update_files.delay(slugs, action, params)
+            progress_url = reverse('admin:filehost_uploadedfile_bulk_progress', kwargs={'task_id': result.id})
+            messages.success(request, format_html(
+                    "{} files are being updated in the background! "
+                    "<a href=\"{}\">Check progress</a>", len(slugs), progress_url
+                ))
+            return
+        bulk.apply(slugs, action, params)
+        messages.success(request, success_message)
+
+    def bulk_progress(self, request, task_id):
+        result = AsyncResult(task_id)
+        info = result.info if isinstance(result.info, dict) else None
+        return JsonResponse({"state": result.state, "progress": info})
+
+    def get_urls(self):
+        return [
+            path("bulk-progress/<str:task_id>/", self.admin_site.admin_view(self.bulk_progress), name="filehost_uploadedfile_bulk_progress"),
+        ] + super().get_urls()
+
     actions = [delete_selected, expire_today, take_ownership, archive_selected, localise_selected, private_selected, members_only_selected, public_selected]
 
 
-admin.site.register(UploadedFile, UploadedFileAdmin)
\ No newline at end of file
+admin.site.register(UploadedFile, UploadedFileAdmin)
+
+
+class StorageUsageAdmin(admin.ModelAdmin):
+    """
+    Storage usage dashboard, the counters are maintained as files are saved so the page never has to stat files
+    """
+    list_display = ("uploader", "upload_type", "file_type", "state", "files", "bytes")
+    list_filter = ["state", "upload_type", "file_type"]
+    search_fields = ["uploader__username"]
+    ordering = ("-bytes",)
+    change_list_template = "admin/filehost/storageusage/change_list.html"
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        # The counters are only ever rebuilt by recalculating them, deleting rows would just leave them wrong
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['usage_summary'] = usage.site_summary()
+        return super().changelist_view(request, extra_context=extra_context)
+
+    def recalculate_usage(self, request):
+        '''
+            Queues a full recalculation of the counters, it is a button on the changelist rather than an action as it
+            always rebuilds every row and has to work when the changelist is empty
+        '''
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        if request.method != "POST":
+            return HttpResponseNotAllowed(["POST"])
+        tasks.recalculate_storage_usage.delay()
+        messages.success(request, (
+                "Storage usage is being recalculated! "
+                "Refresh this page in a few minutes to see the updated counters."
+            ))
+        return HttpResponseRedirect(reverse("admin:filehost_storageusage_changelist"))
+
+    def get_urls(self):
+        return [
+            path("recalculate/", self.admin_site.admin_view(self.recalculate_usage), name="filehost_storageusage_recalculate"),
+        ] + super().get_urls()
+
+
+class UserQuotaAdmin(admin.ModelAdmin):
+    list_display = ("uploader", "max_bytes", "max_files")
+    search_fields = ["uploader__username"]
+
+
+admin.site.register(StorageUsage, StorageUsageAdmin)
+admin.site.register(UserQuota, UserQuotaAdmin)
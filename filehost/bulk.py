@@ -0,0 +1,70 @@
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from filehost.models import UploadedFile, StorageUsage
+
+# Bulk admin actions are applied as chunked queryset.update() calls rather than saving each file, so pre_save and post_save
+# are not sent. The rules from pre_save_hook that apply to these fields are applied in the update itself, and files moving
+# between storage usage counters are moved per chunk in the same transaction as the update.
+
+# Number of files updated by each UPDATE statement
+UPDATE_CHUNK_SIZE = 1000
+# Selections larger than this are updated by a background task rather than in the admin request
+BACKGROUND_THRESHOLD = 2000
+
+PRIVATE = "PRIVATE"
+MEMBERS_ONLY = "MEMBERS_ONLY"
+PUBLIC = "PUBLIC"
+TAKE_OWNERSHIP = "TAKE_OWNERSHIP"
+EXPIRE_TODAY = "EXPIRE_TODAY"
+
+
+def changes_for(action: str, params: dict) -> dict:
+    '''
+        Fields to update for a bulk action, params carries anything the action needs from the admin request, eg: the new uploader
+    '''
+    match action:
+        # Files that are not publicly accessible cannot be featured, see pre_save_hook
+        case "PRIVATE":
+            return {'access': UploadedFile.Access.PRIVATE, 'featured': False}
+        case "MEMBERS_ONLY":
+            return {'access': UploadedFile.Access.MEMBERS_ONLY, 'featured': False}
+        case "PUBLIC":
+            return {'access': UploadedFile.Access.PUBLIC}
+        case "TAKE_OWNERSHIP":
+            return {'uploader_id': params['uploader_id']}
+        case "EXPIRE_TODAY":
+            return {'expiration_date': timezone.localdate()}
+    raise ValueError(f"Unknown bulk action: {action}")
+
+def update_chunk(slugs, changes: dict) -> int:
+    '''
+        Updates one chunk of files, moving them between storage usage counters if a counter key field is changed
+    '''
+    moved_fields = [field for field in StorageUsage.KEY_FIELDS if field in changes]
+    with transaction.atomic():
+        files = UploadedFile.objects.filter(pk__in=slugs)
+        moved = []
+        if moved_fields:
+            # Lock the rows before totalling them so the totals are what the update actually changes
+            list(files.select_for_update().values_list('pk', flat=True))
+            moved = list(files.values(*StorageUsage.KEY_FIELDS).annotate(total_files=Count('pk'), total_bytes=Sum('size')).order_by())
+        updated = files.update(**changes)
+        for counters in moved:
+            previous = {field: counters[field] for field in StorageUsage.KEY_FIELDS}
+            StorageUsage.adjust(previous, -counters['total_files'], -(counters['total_bytes'] or 0))
+            StorageUsage.adjust({**previous, **{field: changes[field] for field in moved_fields}}, counters['total_files'], counters['total_bytes'] or 0)
+    return updated
+
+def apply(slugs, action: str, params=None, progress=None) -> int:
+    '''
+        Applies a bulk action to the files UPDATE_CHUNK_SIZE at a time, progress(done, total) is called after each chunk.\n
+        returns: the number of files updated
+    '''
+    changes = changes_for(action, params or {})
+    updated = 0
+    for offset in range(0, len(slugs), UPDATE_CHUNK_SIZE):
+        updated += update_chunk(slugs[offset:offset + UPDATE_CHUNK_SIZE], changes)
+        if progress is not None:
+            progress(min(offset + UPDATE_CHUNK_SIZE, len(slugs)), len(slugs))
+    return updated
@@ -0,0 +1,85 @@
+from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.functional import cached_property
+from filehost.models import UploadedFile, MimeTypeFacet
+
+# The uploaded files changelist has to stay quick as the table grows into the millions, so it avoids anything that
+# scales with the size of the table: exact counts are replaced by the database's own row estimate, the mime type
+# filter reads its choices from MimeTypeFacet rather than a DISTINCT scan, and the thumbnail column reads a stored flag.
+
+# Unfiltered tables with more rows than this are counted from the database's row estimate rather than COUNT(*)
+ESTIMATED_COUNT_THRESHOLD = 100000
+# Filtered results are counted up to this many rows, beyond that the page count is capped
+FILTERED_COUNT_LIMIT = 100000
+
+
+def estimated_row_count(table: str):
+    '''
+        Row estimate the database keeps for a table in its statistics, this can be off by a few percent.\n
+        returns: the estimate, or None if the database does not provide one
+    '''
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+        Paginator that does not run an exact COUNT(*) over large tables.\n
+        Unfiltered listings use the table's row estimate once it is past ESTIMATED_COUNT_THRESHOLD,
+        filtered listings are counted but stop at FILTERED_COUNT_LIMIT rows
+    '''
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        # The default manager always filters out files pending deletion, anything beyond that is a filter from the changelist
+        if queryset.query.where == queryset.model._default_manager.all().query.where:
+            estimate = estimated_row_count(queryset.model._meta.db_table)
+            if estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+            return queryset.count()
+        # Counting a limited subquery stops the database once it has found enough rows
+        return queryset.order_by()[:FILTERED_COUNT_LIMIT].count()
+
+
+class MimeTypeFilter(admin.SimpleListFilter):
+    '''
+        Mime type filter whose choices come from MimeTypeFacet, see refresh_mime_type_facets
+    '''
+    title = "mime type"
+    parameter_name = "mime_type"
+
+    def lookups(self, request, model_admin):
+        return [(facet.mime_type, f"{facet.mime_type} ({facet.files})") for facet in MimeTypeFacet.objects.order_by('mime_type')]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(mime_type=self.value())
+        return queryset
+
+
+def refresh_mime_type_facets() -> int:
+    '''
+        Recounts the uploaded files with each mime type and replaces the facets with the new counts.\n
+        returns: the number of mime types found
+    '''
+    now = timezone.now()
+    counts = UploadedFile.objects.values('mime_type').annotate(files=Count('pk')).order_by()
+    facets = [MimeTypeFacet(mime_type=row['mime_type'], files=row['files'], refreshed_at=now) for row in counts]
+    # There are only ever a few hundred mime types so the facets are simply replaced in one transaction
+    with transaction.atomic():
+        MimeTypeFacet.objects.all().delete()
+        MimeTypeFacet.objects.bulk_create(facets)
+    return len(facets)
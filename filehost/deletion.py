@@ -0,0 +1,135 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from filehost.models import UploadedFile, StorageUsage, StoredFile, ArchiveSegmentEntry
+from filehost import nas, negotiation, waveforms, renditions
+import os
+
+# Deleting an uploaded file only marks it as pending deletion, which hides it straight away (see UploadedFile.objects)
+# and takes it out of the storage usage counters. The reaper (tasks.reap_deleted_files) then removes the files in batches,
+# unlinking local files and removing archived copies with one pooled NAS session per batch, before deleting the rows.
+
+# Number of files marked, and then reaped, at a time
+DELETION_BATCH_SIZE = 500
+
+
+def mark_for_deletion(slugs, reap=True) -> int:
+    '''
+        Marks files as pending deletion and removes them from the storage usage counters, DELETION_BATCH_SIZE at a time.\n
+        Unless reap is False the reaper is queued once the marks have been committed.\n
+        returns: the number of files marked
+    '''
+    marked = 0
+    for offset in range(0, len(slugs), DELETION_BATCH_SIZE):
+        with transaction.atomic():
+            files = UploadedFile.objects.filter(pk__in=slugs[offset:offset + DELETION_BATCH_SIZE])
+            # Lock the rows before totalling them so the totals are what the update actually removes
+            list(files.select_for_update().values_list('pk', flat=True))
+            removed = list(files.values(*StorageUsage.KEY_FIELDS).annotate(total_files=Count('pk'), total_bytes=Sum('size')).order_by())
+            marked += files.update(pending_deletion=True, featured=False)
+            for counters in removed:
+                StorageUsage.adjust({field: counters[field] for field in StorageUsage.KEY_FIELDS}, -counters['total_files'], -(counters['total_bytes'] or 0))
+    if marked and reap:
+        queue_reaper()
+    return marked
+
+def queue_reaper():
+    from filehost.tasks import reap_deleted_files # import moved into function due to circular import
+    transaction.on_commit(lambda: reap_deleted_files.delay())
+
+
+def reapable_files():
+    '''
+        Files pending deletion that can be reaped now, files that are still being moved are left until the move finishes or goes stale
+    '''
+    stale_moving = timezone.now() - timezone.timedelta(seconds=settings.EXPIRY_STALE_MOVING_AFTER)
+    return UploadedFile.all_objects.filter(pending_deletion=True).exclude(state=UploadedFile.State.MOVING, moving_since__gt=stale_moving)
+
+def remove_local_files(uploaded_file: UploadedFile):
+    '''
+        Unlinks the local copy of a file, its thumbnail, waveform peaks, HLS renditions and any negotiated format variants, whichever of them exist
+    '''
+    paths = []
+    # file_path is only set to a relative path once the file has been uploaded
+    if uploaded_file.file_path and not os.path.isabs(uploaded_file.file_path):
+        paths.append(os.path.join(settings.MEDIA_ROOT, uploaded_file.file_path))
+    if uploaded_file.thumbnail:
+        paths.append(os.path.join(settings.MEDIA_ROOT, uploaded_file.thumbnail.name))
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    negotiation.delete_image_variants(uploaded_file)
+    waveforms.delete_peaks(uploaded_file)
+    renditions.delete_renditions(uploaded_file)
+
+def remove_archived_copies(uploaded_files) -> set:
+    '''
+        Removes the archived copies of the files, packed files only have their segment entry released.
+        Everything else is removed from the NAS with a single pooled session.\n
+        returns: the slugs whose archived copy is gone, files missing from the result could not be removed and should be retried later
+    '''
+    removed = set()
+    unpacked = []
+    for uploaded_file in uploaded_files:
+        if ArchiveSegmentEntry.release(uploaded_file.slug):
+            removed.add(uploaded_file.slug)
+        else:
+            unpacked.append(uploaded_file)
+    if not unpacked:
+        return removed
+
+    def remove_all(sftp):
+        for uploaded_file in unpacked:
+            # The session is retried on a connection failure, files removed by the first attempt are then already gone
+            if uploaded_file.slug in removed:
+                continue
+            try:
+                nas.remove_file(sftp, nas.archive_path(uploaded_file))
+            except FileNotFoundError:
+                pass
+            removed.add(uploaded_file.slug)
+
+    try:
+        nas.pool.run(remove_all)
+    except Exception as e:
+        print(f"Failed to remove {len(unpacked) - len(removed)} archived files from the NAS, they will be retried by the next reaper run. Error: {e}")
+    return removed
+
+def reap_batch(uploaded_files) -> int:
+    '''
+        Removes the stored files for a batch of files pending deletion then deletes their rows.\n
+        returns: the number of files reaped, files whose archived copy could not be removed are left pending
+    '''
+    # Files that are not local may have an archived copy, including moves that went stale part way through
+    removed_archived = remove_archived_copies([uploaded_file for uploaded_file in uploaded_files if uploaded_file.state != UploadedFile.State.LOCAL])
+    reaped = []
+    for uploaded_file in uploaded_files:
+        if uploaded_file.state != UploadedFile.State.LOCAL and uploaded_file.slug not in removed_archived:
+            continue
+        remove_local_files(uploaded_file)
+        reaped.append(uploaded_file.slug)
+    StoredFile.objects.filter(slug__in=reaped).delete()
+    UploadedFile.all_objects.filter(pk__in=reaped, pending_deletion=True).delete()
+    return len(reaped)
+
+def reap(batch_size=DELETION_BATCH_SIZE) -> dict:
+    '''
+        Reaps every file pending deletion, batch_size at a time, each file is attempted once per run.\n
+        returns: a report of how many files were reaped and how many were left for the next run
+    '''
+    report = {"batches": 0, "reaped": 0, "remaining": 0}
+    last_slug = ""
+    while True:
+        batch = list(reapable_files().filter(slug__gt=last_slug).order_by('slug')[:batch_size])
+        if not batch:
+            break
+        last_slug = batch[-1].slug
+        reaped = reap_batch(batch)
+        report["batches"] += 1
+        report["reaped"] += reaped
+        report["remaining"] += len(batch) - reaped
+        print(f"Reaped {reaped} of {len(batch)} deleted files")
+    return report
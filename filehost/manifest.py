@@ -0,0 +1,208 @@
+from django.conf import settings
+from django.db.models import Sum, Count, F
+from django.utils import timezone
+from filehost.models import UploadedFile, StoredFile, ManifestDirectory
+import hashlib, os
+
+# The storage manifest records every file in local media and on the NAS (see StoredFile). It is kept up to date as files are
+# saved, archived, localised and deleted, and a reconciliation pass catches anything that changed behind its back by only
+# listing directories whose mtime has changed since they were last reconciled.
+# Orphan cleanup, usage reports and scrubbing work from the manifest instead of walking MEDIA_ROOT and the NAS.
+
+# Number of local files checksummed by each scrub run, files that have gone the longest without being checked go first
+SCRUB_BATCH_SIZE = 1000
+# Manifest entries are written and removed this many at a time while reconciling
+RECONCILE_BATCH_SIZE = 1000
+# Size of the reads made while checksumming
+HASH_BLOCK_SIZE = 1048576
+
+
+def local_directories():
+    '''
+        Directories relative to MEDIA_ROOT that uploaded files and their thumbnails are stored in
+    '''
+    for upload_type in UploadedFile.UploadType.TYPES:
+        for file_type in UploadedFile.FileType.TYPES:
+            yield os.path.join(upload_type, file_type)
+            yield os.path.join(upload_type, file_type, "THUMBNAIL")
+
+def archive_directories():
+    '''
+        Directories relative to NAS_PATH that archived files are stored in
+    '''
+    for upload_type in UploadedFile.UploadType.TYPES:
+        for file_type in UploadedFile.FileType.TYPES:
+            yield upload_type + "/" + file_type
+
+def slug_of(name: str) -> str:
+    # Files are named after their slug, eg: gZ8tMsnP.png, gZ8tMsnP.png.webp, gZ8tMsnP.png.jpeg
+    return name.split('.')[0]
+
+
+def record(location: str, relative_path: str, size: int, mtime: float):
+    '''
+        Adds or updates the manifest entry for a file, the checksum is cleared if the file has changed
+    '''
+    directory, name = os.path.split(relative_path)
+    entry, created = StoredFile.objects.get_or_create(location=location, directory=directory, name=name, defaults={'slug': slug_of(name), 'size': size, 'mtime': mtime})
+    if not created and (entry.size != size or entry.mtime != mtime):
+        StoredFile.objects.filter(pk=entry.pk).update(size=size, mtime=mtime, checksum=None, checked_at=None)
+    return entry
+
+def record_local(relative_path: str):
+    '''
+        Records a file in local media from its current size and mtime, or removes its entry if the file no longer exists
+    '''
+    try:
+        stat = os.stat(os.path.join(settings.MEDIA_ROOT, relative_path))
+    except FileNotFoundError:
+        directory, name = os.path.split(relative_path)
+        StoredFile.objects.filter(location=StoredFile.Location.LOCAL, directory=directory, name=name).delete()
+        return None
+    return record(StoredFile.Location.LOCAL, relative_path, stat.st_size, stat.st_mtime)
+
+def record_uploaded_file(uploaded_file: UploadedFile):
+    '''
+        Brings the local entries for an uploaded file and its thumbnail up to date, called whenever the uploaded file is saved or deleted
+    '''
+    # file_path is only set to a relative path once the file has been uploaded
+    if uploaded_file.file_path and not os.path.isabs(uploaded_file.file_path):
+        record_local(uploaded_file.file_path)
+    if uploaded_file.thumbnail:
+        record_local(uploaded_file.thumbnail.name)
+
+def record_archived(relative_path: str, size: int):
+    return record(StoredFile.Location.ARCHIVED, relative_path, size, timezone.now().timestamp())
+
+def forget(location: str, slug: str):
+    '''
+        Removes every entry for a slug at a location, eg: an archived file along with its chunk manifest
+    '''
+    StoredFile.objects.filter(location=location, slug=slug).delete()
+
+
+def reconcile(location: str, directories, stat_directory, list_directory, force=False) -> dict:
+    '''
+        Brings the manifest up to date with storage, only directories whose mtime has changed since they were last reconciled are listed.\n
+        stat_directory(directory) returns the directory's mtime or None if it does not exist,
+        list_directory(directory) yields (name, size, mtime) for every file in it.\n
+        returns: a report of what was changed
+    '''
+    report = {"location": location, "directories": 0, "listed": 0, "added": 0, "updated": 0, "removed": 0}
+    reconciled = {record.directory: record for record in ManifestDirectory.objects.filter(location=location)}
+    for directory in directories:
+        report["directories"] += 1
+        # The mtime is read before listing so that anything that changes while listing is picked up by the next pass
+        mtime = stat_directory(directory)
+        record = reconciled.get(directory)
+        if record is not None and record.mtime == mtime and not force:
+            continue
+        report["listed"] += 1
+
+        known = {name: (pk, size, file_mtime) for pk, name, size, file_mtime in StoredFile.objects.filter(location=location, directory=directory).values_list('pk', 'name', 'size', 'mtime').iterator()}
+        added, updated = [], []
+        if mtime is not None:
+            for name, size, file_mtime in list_directory(directory):
+                existing = known.pop(name, None)
+                if existing is None:
+                    added.append(StoredFile(location=location, directory=directory, name=name, slug=slug_of(name), size=size, mtime=file_mtime))
+                elif existing[1] != size or existing[2] != file_mtime:
+                    updated.append(StoredFile(pk=existing[0], size=size, mtime=file_mtime, checksum=None, checked_at=None))
+                if len(added) >= RECONCILE_BATCH_SIZE:
+                    StoredFile.objects.bulk_create(added, ignore_conflicts=True)
+                    report["added"] += len(added)
+                    added = []
+                if len(updated) >= RECONCILE_BATCH_SIZE:
+                    StoredFile.objects.bulk_update(updated, ['size', 'mtime', 'checksum', 'checked_at'])
+                    report["updated"] += len(updated)
+                    updated = []
+        StoredFile.objects.bulk_create(added, ignore_conflicts=True)
+        report["added"] += len(added)
+        StoredFile.objects.bulk_update(updated, ['size', 'mtime', 'checksum', 'checked_at'])
+        report["updated"] += len(updated)
+
+        # Anything left in known was not found in the listing and no longer exists
+        missing = [pk for pk, size, file_mtime in known.values()]
+        for offset in range(0, len(missing), RECONCILE_BATCH_SIZE):
+            StoredFile.objects.filter(pk__in=missing[offset:offset + RECONCILE_BATCH_SIZE]).delete()
+        report["removed"] += len(missing)
+
+        ManifestDirectory.objects.update_or_create(location=location, directory=directory, defaults={'mtime': mtime, 'reconciled_at': timezone.now()})
+    return report
+
+def reconcile_local(force=False) -> dict:
+    def stat_directory(directory):
+        try:
+            return os.stat(os.path.join(settings.MEDIA_ROOT, directory)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def list_directory(directory):
+        with os.scandir(os.path.join(settings.MEDIA_ROOT, directory)) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    yield entry.name, stat.st_size, stat.st_mtime
+
+    return reconcile(StoredFile.Location.LOCAL, local_directories(), stat_directory, list_directory, force=force)
+
+def reconcile_archive(sftp, nas_path: str, force=False) -> dict:
+    from stat import S_ISREG
+
+    def stat_directory(directory):
+        try:
+            return sftp.stat(nas_path + directory).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def list_directory(directory):
+        for entry in sftp.listdir_iter(nas_path + directory):
+            if S_ISREG(entry.st_mode):
+                yield entry.filename, entry.st_size, entry.st_mtime
+
+    return reconcile(StoredFile.Location.ARCHIVED, archive_directories(), stat_directory, list_directory, force=force)
+
+
+def orphaned_files(location: str):
+    '''
+        Manifest entries whose slug does not belong to any uploaded file
+    '''
+    return StoredFile.objects.filter(location=location).exclude(slug__in=UploadedFile.all_objects.values('slug'))
+
+def usage() -> dict:
+    '''
+        Number of files and bytes at each location according to the manifest
+    '''
+    return {row['location']: {"files": row['files'], "bytes": row['bytes'] or 0} for row in StoredFile.objects.values('location').annotate(files=Count('pk'), bytes=Sum('size'))}
+
+def file_checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while block := file.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+def scrub_local(limit=SCRUB_BATCH_SIZE) -> dict:
+    '''
+        Checksums the local files that have gone the longest without being checked.\n
+        Files without a checksum have it recorded, files whose contents no longer match their checksum are reported as corrupted
+    '''
+    report = {"checked": 0, "recorded": 0, "missing": 0, "corrupted": []}
+    entries = StoredFile.objects.filter(location=StoredFile.Location.LOCAL).order_by(F('checked_at').asc(nulls_first=True))[:limit]
+    for entry in entries:
+        try:
+            checksum = file_checksum(os.path.join(settings.MEDIA_ROOT, entry.path))
+        except FileNotFoundError:
+            report["missing"] += 1
+            entry.delete()
+            continue
+        report["checked"] += 1
+        if entry.checksum is None:
+            report["recorded"] += 1
+        elif entry.checksum != checksum:
+            print(f"Local file: {entry.path} no longer matches its checksum, expected {entry.checksum} but found {checksum}")
+            report["corrupted"].append(entry.path)
+            # Keep the original checksum so the file keeps being reported until it is restored or removed
+            checksum = entry.checksum
+        StoredFile.objects.filter(pk=entry.pk).update(checksum=checksum, checked_at=timezone.now())
+    return report
@@ -0,0 +1,132 @@
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden
+from celery.signals import task_prerun, task_postrun
+from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from contextlib import contextmanager
+from functools import wraps
+import os, time
+
+# Metrics are kept with prometheus_client. When PROMETHEUS_MULTIPROC_DIR is set (it must be set before any worker starts)
+# each gunicorn and celery worker process writes its values to a memory mapped file in that directory and the scrape
+# endpoint adds them all up, otherwise only the process answering the scrape is reported.
+# Recording a value is an in-memory increment, label children are looked up once where possible to keep calls cheap.
+
+VIEW_SECONDS = Histogram(
+    "lfs_view_seconds", "Time spent handling a request, by view",
+    ["view"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+CACHE_LOOKUPS = Counter(
+    "lfs_cache_lookups_total", "Cache lookups by cache and whether they hit",
+    ["cache", "result"],
+)
+TASK_SECONDS = Histogram(
+    "lfs_task_seconds", "Celery task run time by task and outcome",
+    ["task", "outcome"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+)
+SFTP_HANDSHAKE_SECONDS = Histogram(
+    "lfs_sftp_handshake_seconds", "Time taken to open and authenticate an SFTP session to the NAS",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+SFTP_TRANSFER_BYTES = Counter(
+    "lfs_sftp_transfer_bytes_total", "Bytes transferred to and from the NAS",
+    ["direction"],
+)
+SFTP_TRANSFER_SECONDS = Counter(
+    "lfs_sftp_transfer_seconds_total", "Time spent transferring files to and from the NAS, rate(bytes) / rate(seconds) gives bytes/sec",
+    ["direction"],
+)
+SFTP_TRANSFER_THROUGHPUT = Histogram(
+    "lfs_sftp_transfer_bytes_per_second", "Throughput of each file transferred to and from the NAS",
+    ["direction"],
+    buckets=(65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456),
+)
+THUMBNAIL_STAGE_SECONDS = Histogram(
+    "lfs_thumbnail_stage_seconds", "Time spent in each stage of creating a thumbnail, by file type",
+    ["stage", "file_type"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+# Start times of the tasks running in this process, by task id
+TASK_STARTS = {}
+
+
+def timed(view: str):
+    '''
+        Decorator that records how long each call of a view (or any function on a request's hot path) takes
+    '''
+    histogram = VIEW_SECONDS.labels(view)
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+def record_transfer(direction: str, size: int, seconds: float):
+    SFTP_TRANSFER_BYTES.labels(direction).inc(size)
+    SFTP_TRANSFER_SECONDS.labels(direction).inc(seconds)
+    if seconds > 0:
+        SFTP_TRANSFER_THROUGHPUT.labels(direction).observe(size / seconds)
+
+def record_thumbnail_stage(stage: str, file_type: str, seconds: float, timings=None):
+    THUMBNAIL_STAGE_SECONDS.labels(stage, file_type).observe(seconds)
+    # timings is a dict of seconds by stage passed in by callers that want the breakdown of a single thumbnail (eg: benchmarks)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def thumbnail_stage(stage: str, file_type: str, timings=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_thumbnail_stage(stage, file_type, time.perf_counter() - start, timings)
+
+
+@task_prerun.connect
+def task_started(task_id=None, task=None, **kwargs):
+    TASK_STARTS[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, retval=None, state=None, **kwargs):
+    start = TASK_STARTS.pop(task_id, None)
+    if start is None:
+        return
+    # Most tasks catch their own errors and return False rather than raising
+    outcome = "failure" if state != "SUCCESS" or retval is False else "success"
+    TASK_SECONDS.labels(task.name, outcome).observe(time.perf_counter() - start)
+
+
+def client_allowed(request: HttpRequest) -> bool:
+    if request.user.is_authenticated and request.user.is_superuser:
+        return True
+    # The address of the connection itself, forwarded headers are set by whoever sent the request so they are never trusted here.
+    # Behind a proxy the proxy's address is what has to be allowed, and the proxy should only pass /metrics on from the scraper
+    return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+def scrape(request: HttpRequest):
+    '''
+        Prometheus scrape endpoint, only answered for METRICS_ALLOWED_IPS and superusers
+    '''
+    if not client_allowed(request):
+        return HttpResponseForbidden("Metrics are only available to allowed addresses.") # 403 Forbidden
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        from prometheus_client import REGISTRY as registry
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST) # 200 OK
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filehost', '0030_alter_uploadedfile_file_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='moving_since',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
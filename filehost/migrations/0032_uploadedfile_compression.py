@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-19 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filehost', '0031_uploadedfile_moving_since'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='compression',
+            field=models.CharField(choices=[('NONE', 'None'), ('ZSTD', 'Zstandard')], default='NONE', editable=False, max_length=16),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.13 on 2026-10-19 11:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filehost', '0032_uploadedfile_compression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('dead_bytes', models.BigIntegerField(default=0)),
+                ('sealed', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchiveSegmentEntry',
+            fields=[
+                ('slug', models.SlugField(max_length=8, primary_key=True, serialize=False)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.BigIntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('segment', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='entries', to='filehost.archivesegment')),
+            ],
+        ),
+    ]
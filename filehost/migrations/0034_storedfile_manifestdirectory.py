@@ -0,0 +1,45 @@
+# Generated by Django 4.2.13 on 2026-10-19 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filehost', '0033_archivesegment_archivesegmententry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location', models.CharField(choices=[('LOCAL', 'Local'), ('ARCHIVED', 'Archived')], max_length=16)),
+                ('directory', models.CharField(max_length=64)),
+                ('name', models.CharField(max_length=128)),
+                ('slug', models.CharField(db_index=True, max_length=128)),
+                ('size', models.BigIntegerField(default=0)),
+                ('mtime', models.FloatField(default=0)),
+                ('checksum', models.CharField(max_length=64, null=True)),
+                ('checked_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ManifestDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location', models.CharField(choices=[('LOCAL', 'Local'), ('ARCHIVED', 'Archived')], max_length=16)),
+                ('directory', models.CharField(max_length=64)),
+                ('mtime', models.FloatField(null=True)),
+                ('reconciled_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='storedfile',
+            constraint=models.UniqueConstraint(fields=('location', 'directory', 'name'), name='unique_stored_file_path'),
+        ),
+        migrations.AddConstraint(
+            model_name='manifestdirectory',
+            constraint=models.UniqueConstraint(fields=('location', 'directory'), name='unique_manifest_directory'),
+        ),
+    ]
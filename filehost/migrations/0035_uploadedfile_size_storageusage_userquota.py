@@ -0,0 +1,49 @@
+# Generated by Django 4.2.13 on 2026-10-19 12:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('filehost', '0034_storedfile_manifestdirectory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='size',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_type', models.CharField(choices=[('FILE', 'File'), ('IMAGE', 'Image'), ('AUDIO', 'Audio'), ('VIDEO', 'Video'), ('TEXT', 'Text'), ('FONT', 'Font'), ('MODEL', 'Model'), ('APPLICATION', 'Application')], max_length=16)),
+                ('upload_type', models.CharField(choices=[('MANUAL', 'Manual'), ('API', 'Api'), ('EMAIL_ATTACHMENT', 'Email Attachment')], max_length=16)),
+                ('state', models.CharField(max_length=16)),
+                ('files', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('uploader', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='storage_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'storage usage',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('max_files', models.BigIntegerField(blank=True, null=True)),
+                ('uploader', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='storage_quota', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='storageusage',
+            constraint=models.UniqueConstraint(fields=('uploader', 'file_type', 'upload_type', 'state'), name='unique_storage_usage_key'),
+        ),
+    ]
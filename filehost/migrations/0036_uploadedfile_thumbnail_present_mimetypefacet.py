@@ -0,0 +1,44 @@
+# Generated by Django 4.2.13 on 2026-10-19 13:20
+
+from django.db import migrations, models
+
+
+def set_thumbnail_present(apps, schema_editor):
+    # Thumbnails are only pointed to once they have been written, so any file with a thumbnail name has one
+    UploadedFile = apps.get_model('filehost', 'UploadedFile')
+    UploadedFile.objects.exclude(thumbnail__isnull=True).exclude(thumbnail="").update(thumbnail_present=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filehost', '0035_uploadedfile_size_storageusage_userquota'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='thumbnail_present',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='uploaded_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='mime_type',
+            field=models.CharField(db_index=True, default='UNKNOWN', max_length=128),
+        ),
+        migrations.CreateModel(
+            name='MimeTypeFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mime_type', models.CharField(max_length=128, unique=True)),
+                ('files', models.BigIntegerField(default=0)),
+                ('refreshed_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.RunPython(set_thumbnail_present, migrations.RunPython.noop),
+    ]
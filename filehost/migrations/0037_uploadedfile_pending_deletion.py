@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-19 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filehost', '0036_uploadedfile_thumbnail_present_mimetypefacet'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='pending_deletion',
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+    ]
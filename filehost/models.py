@@ -1,6 +1,6 @@
 from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 from django.conf import settings
 from django.contrib import admin
@@ -17,7 +17,7 @@ SLUG_LENGTH = 8
 
 def random_slug():
     randomstring = ''.join(random.choices(string.ascii_letters + string.digits, k=SLUG_LENGTH))
-    if (UploadedFile.objects.filter(slug=randomstring).count() > 0):
+    if UploadedFile.all_objects.filter(slug=randomstring).exists():
         # In the unlikely event that the slug is already taken we regenerate a new slug until we have one that is not taken
         randomstring = random_slug()
     return randomstring
@@ -42,6 +42,14 @@ def file_path(self, filename):
     self.file_path = path
     return path
 
+class UploadedFileManager(models.Manager):
+    """
+    Default manager for uploaded files, files pending deletion are hidden as soon as they are marked, see filehost/deletion.py
+    """
+    def get_queryset(self):
+        return super().get_queryset().filter(pending_deletion=False)
+
+
 class UploadedFile(models.Model):
     class State():
         LOCAL = "LOCAL"
@@ -109,25 +117,47 @@ class UploadedFile(models.Model):
             (MEMBERS_ONLY, "Members Only"),
             (PRIVATE, "Private"),
         )
+    class Compression():
+        NONE = "NONE"
+        ZSTD = "ZSTD"
+
+        CHOICES = (
+            (NONE, "None"),
+            (ZSTD, "Zstandard"),
+        )
 
 
     slug = models.SlugField(primary_key=True, unique=True, null=False, max_length=8, default=random_slug)
     file = models.FileField(null=True, upload_to=file_path)
     file_path = models.CharField(null=False, editable=False, max_length=64, default="/MANUAL/FILE/UNKNOWN.TXT")
-    uploaded_at = models.DateTimeField(null=True)
+    uploaded_at = models.DateTimeField(null=True, db_index=True)
     expiration_date = models.DateField()
     state = models.CharField(max_length=16, choices=State.CHOICES, default=State.LOCAL)
     upload_type = models.CharField(max_length=16, choices=UploadType.CHOICES, default=UploadType.MANUAL)
     file_type = models.CharField(max_length=16, choices=FileType.CHOICES, default=FileType.FILE)
     persistent = models.BooleanField(default=False)
-    mime_type = models.CharField(max_length=128, default="UNKNOWN")
+    mime_type = models.CharField(max_length=128, default="UNKNOWN", db_index=True)
     # Resized image thumbnail for images. This does not get archived and is presented while de-archiving file. This is also used in the oembed integration
     thumbnail = models.ImageField(null=True)
     thumbnail_path = models.CharField(null=True, editable=False, max_length=64)
+    # Whether a thumbnail has been generated, stored so that listings do not need to check the filesystem for every file
+    thumbnail_present = models.BooleanField(default=False, editable=False)
     uploader = models.ForeignKey(ApiUser, null=True, on_delete=models.SET_NULL)
     # Whether to feature this file on the filehost homepage
     featured = models.BooleanField(default=True)
     access = models.CharField(max_length=16, choices=Access.CHOICES, default=Access.PUBLIC) 
+    # When the file was last set to moving, used to detect moves that were interrupted and need resuming
+    moving_since = models.DateTimeField(null=True, editable=False)
+    # Codec the archived copy of the file is compressed with on the NAS, local files are never compressed
+    compression = models.CharField(max_length=16, choices=Compression.CHOICES, default=Compression.NONE, editable=False)
+    # Size of the original file in bytes, recorded at upload
+    size = models.BigIntegerField(default=0, editable=False)
+    # Set when the file is deleted, the reaper then removes its stored files and the row in the background
+    pending_deletion = models.BooleanField(default=False, editable=False, db_index=True)
+
+    objects = UploadedFileManager()
+    # Includes files pending deletion
+    all_objects = models.Manager()
 
     @property
     def raw_file_url(self):
@@ -164,7 +194,7 @@ class UploadedFile(models.Model):
 			description='Thumbnail Image?',
 	)
     def has_thumbnail_image(self):
-        return self.has_thumbnail
+        return self.thumbnail_present
 
     def set_expiration(self, days=0, weeks=0, months=0, years=0):
         if years > 0:
@@ -189,8 +219,76 @@ class UploadedFile(models.Model):
         if self.persistent:
            return ValueError("Error: trying to move a persistent file! This defeats the purpose of persistent files!")
         self.state = UploadedFile.State.MOVING
+        self.moving_since = timezone.now()
         self.save()
 
+    def save(self, *args, **kwargs):
+        '''
+            Saves the file and moves it between storage usage counters in the same transaction
+        '''
+        with transaction.atomic():
+            # Lock the row so that the counters are moved from what is actually stored, not what this instance was loaded with
+            previous = None if self._state.adding else UploadedFile.all_objects.select_for_update().filter(pk=self.pk).values(*StorageUsage.KEY_FIELDS, 'size', 'pending_deletion').first()
+            if previous is not None and previous.pop('pending_deletion'):
+                # Deletion wins over saves from anything that loaded the file before it was deleted, eg: a move that was in progress
+                self.pending_deletion = True
+                previous = None
+            super().save(*args, **kwargs)
+            StorageUsage.record_change(previous, StorageUsage.usage_of(self))
+
+    def claim_moving(self) -> bool:
+        '''
+            Atomically sets the file to moving if its state has not been changed by anyone else since it was loaded.\n
+            returns: True if this caller now owns the move, False if another worker got there first
+        '''
+        if self.persistent:
+            return False
+        now = timezone.now()
+        with transaction.atomic():
+            claimed = UploadedFile.objects.filter(slug=self.slug, state=self.state, moving_since=self.moving_since).update(state=UploadedFile.State.MOVING, moving_since=now)
+            if claimed:
+                StorageUsage.record_change(StorageUsage.usage_of(self), StorageUsage.usage_of(self, state=UploadedFile.State.MOVING))
+        if claimed:
+            self.state = UploadedFile.State.MOVING
+            self.moving_since = now
+        return claimed == 1
+
+    def request_localisation(self) -> bool:
+        '''
+            Claims an archived file for de-archiving and queues the localise task, the claim is what stops other requests queueing it again.\n
+            A claim left by a move that has been running for longer than EXPIRY_STALE_MOVING_AFTER is assumed to have died and is taken over,
+            unless the local copy still exists as then it was an archive that was interrupted and the next expiry run will resume it.\n
+            returns: True if this call queued the localise task, False if the file is already being moved
+        '''
+        if self.state == UploadedFile.State.MOVING:
+            if self.moving_since is not None and self.moving_since > timezone.now() - timezone.timedelta(seconds=settings.EXPIRY_STALE_MOVING_AFTER):
+                return False
+            if os.path.isfile(os.path.join(settings.MEDIA_ROOT, self.file_path)):
+                return False
+        elif self.state != UploadedFile.State.ARCHIVED:
+            return False
+        if not self.claim_moving():
+            return False
+        from .tasks import localise_file # import moved into function due to circular import
+        try:
+            localise_file.delay(self.slug, self.moving_since.isoformat())
+        except Exception as e:
+            print(f"Failed to queue de-archiving file: {self.slug}, Error: {e}")
+            self.release_moving(UploadedFile.State.ARCHIVED)
+            return False
+        return True
+
+    def release_moving(self, state):
+        '''
+            Gives up a claimed move and returns the file to the given state, this is done when a move fails and can be retried later
+        '''
+        with transaction.atomic():
+            released = UploadedFile.objects.filter(slug=self.slug, state=UploadedFile.State.MOVING, moving_since=self.moving_since).update(state=state, moving_since=None)
+            if released:
+                StorageUsage.record_change(StorageUsage.usage_of(self, state=UploadedFile.State.MOVING), StorageUsage.usage_of(self, state=state))
+        self.state = state
+        self.moving_since = None
+
     def set_archived(self, days=0, weeks=0, months=0, years=0):
         if self.persistent:
            return ValueError("Error: trying to archive a persistent file! This defeats the purpose of persistent files!")
@@ -198,11 +296,24 @@ class UploadedFile(models.Model):
         self.set_expiration(days, weeks, months, years)
         self.save()
 
+    def mark_for_deletion(self) -> bool:
+        '''
+            Hides the file and queues the reaper to remove it, see filehost/deletion.py.\n
+            returns: False if the file was already pending deletion
+        '''
+        from .deletion import mark_for_deletion # import moved into function due to circular import
+        if not mark_for_deletion([self.slug]):
+            return False
+        self.pending_deletion = True
+        self.featured = False
+        return True
+
     def can_be_managed_by(self, user: ApiUser):
-        if self.uploader is None or user is None: return False
+        # Compared by id so that the uploader does not have to be fetched
+        if self.uploader_id is None or user is None: return False
         if not user.is_authenticated: return False
         if user.is_superuser: return True
-        return self.uploader == user
+        return self.uploader_id == user.pk
 
     def __str__(self):
         return self.slug
@@ -246,6 +357,197 @@ class UploadedFile(models.Model):
     
 
 
+class ArchiveSegment(models.Model):
+    """
+    Append-only file on the NAS that small archived files are packed into, see filehost/segments.py
+    """
+    name = models.CharField(max_length=64, unique=True)
+    # Number of bytes that have been appended to the segment
+    size = models.BigIntegerField(default=0)
+    # Number of bytes belonging to files that have since been localised or deleted, these are reclaimed by compaction
+    dead_bytes = models.BigIntegerField(default=0)
+    # Sealed segments are full and are no longer appended to
+    sealed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ArchiveSegmentEntry(models.Model):
+    """
+    Index entry locating an archived file inside a segment.
+    The slug is not a foreign key so that the entry outlives a deleted UploadedFile until its bytes are marked as dead
+    """
+    slug = models.SlugField(primary_key=True, max_length=8)
+    segment = models.ForeignKey(ArchiveSegment, on_delete=models.PROTECT, related_name="entries")
+    offset = models.BigIntegerField()
+    length = models.BigIntegerField()
+    # sha256 hex digest of the bytes stored in the segment
+    checksum = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f"{self.slug} ({self.segment}@{self.offset})"
+
+    @staticmethod
+    def release(slug):
+        """
+        Removes the entry for a file that is no longer archived and counts its bytes as dead in the segment
+        """
+        entry = ArchiveSegmentEntry.objects.filter(slug=slug).first()
+        if entry is None:
+            return False
+        ArchiveSegment.objects.filter(pk=entry.segment_id).update(dead_bytes=models.F('dead_bytes') + entry.length)
+        entry.delete()
+        return True
+
+
+class StoredFile(models.Model):
+    """
+    Manifest entry for a file in local media or on the NAS, see filehost/manifest.py.
+    The slug is not a foreign key so that files left behind by a deleted UploadedFile can still be found as orphans
+    """
+    class Location():
+        LOCAL = "LOCAL"
+        ARCHIVED = "ARCHIVED"
+
+        CHOICES = (
+            (LOCAL, "Local"),
+            (ARCHIVED, "Archived"),
+        )
+
+    location = models.CharField(max_length=16, choices=Location.CHOICES)
+    # Directory relative to MEDIA_ROOT or NAS_PATH, eg: API/IMAGE/THUMBNAIL
+    directory = models.CharField(max_length=64)
+    name = models.CharField(max_length=128)
+    slug = models.CharField(max_length=128, db_index=True)
+    size = models.BigIntegerField(default=0)
+    mtime = models.FloatField(default=0)
+    # sha256 hex digest, filled in and checked by scrubbing and cleared whenever the size or mtime changes
+    checksum = models.CharField(max_length=64, null=True)
+    checked_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["location", "directory", "name"], name="unique_stored_file_path"),
+        ]
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.name)
+
+    def __str__(self):
+        return f"{self.location}:{self.path}"
+
+
+class ManifestDirectory(models.Model):
+    """
+    Directory covered by the storage manifest and its mtime when it was last reconciled, only directories whose mtime has changed are listed again
+    """
+    location = models.CharField(max_length=16, choices=StoredFile.Location.CHOICES)
+    directory = models.CharField(max_length=64)
+    mtime = models.FloatField(null=True)
+    reconciled_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["location", "directory"], name="unique_manifest_directory"),
+        ]
+
+    def __str__(self):
+        return f"{self.location}:{self.directory}"
+
+
+class MimeTypeFacet(models.Model):
+    """
+    Number of uploaded files with each mime type, refreshed in the background and used for the admin mime type filter
+    so that the changelist does not scan the uploaded files table for distinct values on every page load
+    """
+    mime_type = models.CharField(max_length=128, unique=True)
+    files = models.BigIntegerField(default=0)
+    refreshed_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return self.mime_type
+
+
+class StorageUsage(models.Model):
+    """
+    Number of files and bytes stored for each combination of uploader, file type, upload type and state.
+    Counters are moved in the same transaction as the uploaded file is saved or deleted, see UploadedFile.save
+    """
+    KEY_FIELDS = ('uploader_id', 'file_type', 'upload_type', 'state')
+
+    uploader = models.ForeignKey(ApiUser, null=True, on_delete=models.SET_NULL, related_name="storage_usage")
+    file_type = models.CharField(max_length=16, choices=UploadedFile.FileType.CHOICES)
+    upload_type = models.CharField(max_length=16, choices=UploadedFile.UploadType.CHOICES)
+    state = models.CharField(max_length=16)
+    files = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["uploader", "file_type", "upload_type", "state"], name="unique_storage_usage_key"),
+        ]
+        verbose_name_plural = "storage usage"
+
+    def __str__(self):
+        return f"{self.uploader} {self.upload_type}/{self.file_type} {self.state}: {self.files} files, {self.bytes} bytes"
+
+    @staticmethod
+    def usage_of(uploaded_file: UploadedFile, state=None):
+        # Files pending deletion were removed from the counters when they were marked
+        if uploaded_file.pending_deletion:
+            return None
+        return {
+            'uploader_id': uploaded_file.uploader_id,
+            'file_type': uploaded_file.file_type,
+            'upload_type': uploaded_file.upload_type,
+            'state': state or uploaded_file.state,
+            'size': uploaded_file.size,
+        }
+
+    @staticmethod
+    def adjust(key: dict, files: int, size: int):
+        counters = StorageUsage.objects.filter(**key)
+        if counters.update(files=models.F('files') + files, bytes=models.F('bytes') + size):
+            return
+        try:
+            with transaction.atomic():
+                StorageUsage.objects.create(**key, files=files, bytes=size)
+        except IntegrityError:
+            # Another transaction created the counter first
+            counters.update(files=models.F('files') + files, bytes=models.F('bytes') + size)
+
+    @staticmethod
+    def record_change(previous, current):
+        """
+        Moves a file between counters, previous is None for a new file and current is None for a deleted file.
+        Both are dicts of the KEY_FIELDS and size, see usage_of
+        """
+        if previous == current:
+            return
+        if previous is not None:
+            StorageUsage.adjust({field: previous[field] for field in StorageUsage.KEY_FIELDS}, -1, -previous['size'])
+        if current is not None:
+            StorageUsage.adjust({field: current[field] for field in StorageUsage.KEY_FIELDS}, 1, current['size'])
+
+
+class UserQuota(models.Model):
+    """
+    Optional storage limits for an uploader, uploads that would take the uploader over either limit are refused.
+    Uploaders without a quota are unlimited
+    """
+    uploader = models.OneToOneField(ApiUser, on_delete=models.CASCADE, related_name="storage_quota")
+    # Maximum number of bytes the uploader can have stored, locally and archived, blank for no limit
+    max_bytes = models.BigIntegerField(null=True, blank=True)
+    # Maximum number of files the uploader can have stored, blank for no limit
+    max_files = models.BigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.uploader} quota"
+
+
 @receiver(pre_save, sender=UploadedFile)
 def pre_save_hook(instance: UploadedFile, *args, **kwargs):
     # Set the mime_type, this only needs to be done when the file is first created (mime type is not set)
@@ -256,7 +558,13 @@ def pre_save_hook(instance: UploadedFile, *args, **kwargs):
             instance.file_type = UploadedFile.FileType.FILE
         else:
             instance.file_type = upper_type
+        # Record the size of the original file while it is still being uploaded
+        instance.size = instance.file.size
     
+    # Files that are not being moved should not have a moving timestamp
+    if instance.state != UploadedFile.State.MOVING:
+        instance.moving_since = None
+
     # Ensure that files that are not publically accessible do not get featured on the homepage
     if not instance.access == UploadedFile.Access.PUBLIC:
         instance.featured = False
@@ -271,7 +579,16 @@ def post_save_hook(instance: UploadedFile, created, *args, **kwargs):
         if settings.TEST_ENV:
             create_thumbnail(instance.slug)
         else:
-            create_thumbnail.delay(instance.slug)
+            # Saving happens inside a transaction (see UploadedFile.save) so the task is only queued once the new file has been committed
+            transaction.on_commit(lambda: create_thumbnail.delay(instance.slug))
+        # Videos are transcoded into their HLS ladder in the background on the transcodes queue, once it has been committed
+        if instance.file_type == UploadedFile.FileType.VIDEO and settings.HLS_RENDITIONS:
+            from .renditions import request_renditions # import moved into function due to circular import
+            transaction.on_commit(lambda: request_renditions(instance))
+
+    # Keep the storage manifest up to date with the local file and thumbnail
+    from . import manifest # import moved into function due to circular import
+    manifest.record_uploaded_file(instance)
 
         
 
@@ -279,19 +596,42 @@ def post_save_hook(instance: UploadedFile, created, *args, **kwargs):
 @receiver(post_delete, sender=UploadedFile)
 def post_delete_hook(instance: UploadedFile, *args, **kwargs):
 
+    # Files pending deletion were removed from the counters when they were marked and have had their stored files removed by the reaper,
+    # everything below only applies to files deleted directly rather than through mark_for_deletion
+    if instance.pending_deletion:
+        return
+
+    # Remove the file from the storage usage counters, post_delete is sent inside the deleting transaction
+    StorageUsage.record_change(StorageUsage.usage_of(instance), None)
+
     # Delete Local file
     if instance.state == UploadedFile.State.LOCAL and instance.file and os.path.isfile(instance.file.path):
         os.remove(instance.file.path)
 
-    # Delete Archived file
-    elif instance.state == UploadedFile.State.ARCHIVED:
-        from .tasks import delete_archived_file # import moved into function due to circular import
-        delete_archived_file.delay(instance.slug) 
+    # Delete Archived file, packed files only need their segment entry released which is done here as it does not touch the NAS
+    elif instance.state == UploadedFile.State.ARCHIVED and not ArchiveSegmentEntry.release(instance.slug):
+        from .tasks import remove_archived_files # import moved into function due to circular import
+        from .nas import archive_path # import moved into function due to circular import
+        # Only queued once the delete has been committed, so a rolled back delete never loses its archived copy
+        removal = [(instance.slug, archive_path(instance))]
+        transaction.on_commit(lambda: remove_archived_files.delay(removal))
         
+    # Delete any negotiated format variants of the file
+    from .negotiation import delete_image_variants # import moved into function due to circular import
+    delete_image_variants(instance)
+
+    # Delete the waveform peaks of audio files, they are kept with the thumbnail
+    from .waveforms import delete_peaks # import moved into function due to circular import
+    delete_peaks(instance)
+
+    # Delete the HLS renditions of videos, they are kept next to the original
+    from .renditions import delete_renditions # import moved into function due to circular import
+    delete_renditions(instance)
+
     # Delete Locally saved Thumbnail if it exists
     if instance.thumbnail and os.path.isfile(instance.thumbnail.path):
         os.remove(instance.thumbnail.path)
 
-    # Make sure that the instance itself has actually been deleted, this is done seperately for archived files as they are deleted asynchronically
-    if instance.state != UploadedFile.State.ARCHIVED and UploadedFile.objects.filter(slug=instance.slug).count() > 0:
-        instance.delete()
\ No newline at end of file
+    # Remove the local file and thumbnail from the storage manifest, archived files are removed once they are deleted from the NAS
+    from . import manifest # import moved into function due to circular import
+    manifest.record_uploaded_file(instance)
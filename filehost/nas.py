@@ -0,0 +1,721 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from django.conf import settings
+from django.db import connection
+from filehost.models import UploadedFile
+from filehost import metrics
+import hashlib, json, os, socket, threading, time
+
+# paramiko is only imported once a session to the NAS is actually opened, so that processes which never talk to the NAS
+# (eg: web workers serving local files) do not pay for importing it, the annotations below are not evaluated at runtime
+if TYPE_CHECKING:
+    import paramiko
+
+# NAS connection details, these and the settings below are read from the environment in LFS/settings.py
+NAS_HOST = settings.NAS_HOST
+NAS_SFTP_PORT = settings.NAS_SFTP_PORT
+NAS_USERNAME = settings.NAS_USERNAME
+NAS_PATH = settings.NAS_PATH
+PRIVATE_KEY_PATH = settings.NAS_PRIVATE_KEY_PATH
+
+# Session pool settings
+NAS_POOL_SIZE = settings.NAS_POOL_SIZE
+NAS_POOL_IDLE_TIMEOUT = settings.NAS_POOL_IDLE_TIMEOUT
+NAS_POOL_CHECK_AFTER = settings.NAS_POOL_CHECK_AFTER
+
+# Transfer settings
+NAS_TRANSFER_WORKERS = settings.NAS_TRANSFER_WORKERS
+NAS_PREFETCH_REQUESTS = settings.NAS_PREFETCH_REQUESTS
+# Size of the reads and writes made during transfers, this matches the largest SFTP packet paramiko will send
+TRANSFER_BLOCK_SIZE = 32768
+
+# Chunked transfer settings
+NAS_CHUNKED_TRANSFER_THRESHOLD = settings.NAS_CHUNKED_TRANSFER_THRESHOLD
+NAS_CHUNK_SIZE = settings.NAS_CHUNK_SIZE
+NAS_CHUNK_WORKERS = settings.NAS_CHUNK_WORKERS
+# Chunked files have a manifest of chunk checksums stored next to them on the NAS so restores can verify each chunk
+MANIFEST_EXTENSION = ".manifest"
+
+# Compression settings
+# Whether compressible files are compressed with zstd while being archived
+NAS_COMPRESSION = settings.NAS_COMPRESSION
+NAS_COMPRESSION_LEVEL = settings.NAS_COMPRESSION_LEVEL
+NAS_COMPRESSION_MAX_RATIO = settings.NAS_COMPRESSION_MAX_RATIO
+NAS_COMPRESSION_SAMPLE_SIZE = 131072
+
+# Files of these types are sampled to see if they are worth compressing, everything else (images, audio, video, archives) is already compressed
+COMPRESSIBLE_FILE_TYPES = [UploadedFile.FileType.TEXT, UploadedFile.FileType.MODEL]
+COMPRESSIBLE_MIMETYPES = [
+    'application/json',
+    'application/xml',
+    'application/javascript',
+    'application/x-ndjson',
+    'application/x-sh',
+    'application/x-tar',
+    'application/sql',
+    'image/svg+xml',
+    'image/bmp',
+    'image/x-ms-bmp',
+    'image/tiff',
+    'audio/x-wav',
+    'audio/wav',
+    'font/ttf',
+    'font/otf',
+]
+
+COMPRESSION_EXTENSIONS = {
+    UploadedFile.Compression.NONE: "",
+    UploadedFile.Compression.ZSTD: ".zst",
+}
+
+def connection_errors():
+    '''
+        Errors that indicate the connection itself has failed rather than the operation being performed
+    '''
+    import paramiko
+    return (paramiko.SSHException, EOFError, ConnectionError, socket.timeout)
+
+
+class SFTPSession():
+    '''
+        An authenticated transport to the NAS and the SFTP client opened over it
+    '''
+
+    def __init__(self, transport: paramiko.Transport, sftp: paramiko.SFTPClient, handshake_time: float):
+        self.transport = transport
+        self.sftp = sftp
+        self.handshake_time = handshake_time
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    @property
+    def idle_time(self) -> float:
+        return time.monotonic() - self.last_used
+
+    def is_alive(self, round_trip=False) -> bool:
+        if not self.transport.is_active() or not self.transport.is_authenticated():
+            return False
+        if round_trip:
+            try:
+                self.sftp.normalize('.')
+            except Exception:
+                return False
+        return True
+
+    def close(self):
+        try:
+            self.sftp.close()
+        except Exception:
+            pass
+        try:
+            self.transport.close()
+        except Exception:
+            pass
+
+
+class SFTPSessionPool():
+    '''
+        Per worker process pool of authenticated SFTP sessions to the NAS.\n
+        Sessions are checked for liveness before reuse, closed when idle for too long and replaced when their connection fails.
+    '''
+
+    def __init__(self, max_idle=NAS_POOL_SIZE, idle_timeout=NAS_POOL_IDLE_TIMEOUT, check_after=NAS_POOL_CHECK_AFTER):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Sessions currently handed out and extra sessions promised to chunked transfers, see reserve_lanes
+        self._checked_out = 0
+        self._reserved = 0
+        self.handshakes = 0
+        self.reuses = 0
+
+    def _check_fork(self):
+        # Sessions cannot be shared with a forked child (eg: celery prefork workers), the child starts with an empty pool
+        if self._pid != os.getpid():
+            self._idle = []
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+            self._checked_out = 0
+            self._reserved = 0
+
+    def connect(self) -> SFTPSession:
+        '''
+            Opens a new authenticated session to the NAS without adding it to the pool
+        '''
+        import paramiko
+        start = time.perf_counter()
+        transport = paramiko.Transport((NAS_HOST, int(NAS_SFTP_PORT)))
+        try:
+            private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
+            transport.connect(username=NAS_USERNAME, pkey=private_key)
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except Exception:
+            transport.close()
+            raise
+        handshake_time = time.perf_counter() - start
+        self.handshakes += 1
+        metrics.SFTP_HANDSHAKE_SECONDS.observe(handshake_time)
+        print(f"Opened new SFTP session to the NAS, handshake took {handshake_time:.3f}s")
+        return SFTPSession(transport, sftp, handshake_time)
+
+    def acquire(self) -> SFTPSession:
+        # Only popping and pushing sessions happens under the lock, liveness checks and closing talk to the NAS and
+        # would otherwise hold up every other thread behind one slow round trip
+        with self._lock:
+            self._check_fork()
+            self._checked_out += 1
+        while True:
+            with self._lock:
+                session = self._idle.pop() if self._idle else None
+            if session is None:
+                break
+            if session.idle_time > self.idle_timeout:
+                session.close()
+                continue
+            if session.is_alive(round_trip=session.idle_time > self.check_after):
+                with self._lock:
+                    self.reuses += 1
+                metrics.cache_lookup("sftp_session", hit=True)
+                return session
+            session.close()
+        metrics.cache_lookup("sftp_session", hit=False)
+        try:
+            return self.connect()
+        except Exception:
+            with self._lock:
+                self._checked_out -= 1
+            raise
+
+    def release(self, session: SFTPSession, discard=False):
+        session.last_used = time.monotonic()
+        keep = not discard and session.is_alive()
+        with self._lock:
+            self._check_fork()
+            self._checked_out = max(0, self._checked_out - 1)
+            if keep and len(self._idle) < self.max_idle:
+                self._idle.append(session)
+                session = None
+            expired = self._take_expired()
+        if session is not None:
+            session.close()
+        for expired_session in expired:
+            expired_session.close()
+
+    def _take_expired(self) -> list:
+        '''
+            Removes the idle sessions that have passed idle_timeout, the caller closes them once the lock has been released.\n
+            returns: the expired sessions
+        '''
+        expired = [session for session in self._idle if session.idle_time > self.idle_timeout]
+        for session in expired:
+            self._idle.remove(session)
+        return expired
+
+    def reserve_lanes(self, wanted: int) -> int:
+        '''
+            Promises up to wanted extra sessions to a chunked transfer without blocking, so that sessions checked out by nested
+            transfers (eg: a chunked file inside run_transfers) never add up to more than max_idle between them.\n
+            Sessions the lanes check out are counted as well as the reservation until it is released, which can only grant fewer.\n
+            returns: the number of lanes granted, 0 when every session is already in use
+        '''
+        with self._lock:
+            self._check_fork()
+            granted = max(0, min(wanted, self.max_idle - self._checked_out - self._reserved))
+            self._reserved += granted
+            return granted
+
+    def release_lanes(self, granted: int):
+        with self._lock:
+            self._check_fork()
+            self._reserved = max(0, self._reserved - granted)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+    @contextmanager
+    def session(self):
+        '''
+            Checks out a session for the duration of the with block, sessions whose connection failed are not returned to the pool
+        '''
+        session = self.acquire()
+        discard = False
+        try:
+            yield session.sftp
+        except connection_errors():
+            discard = True
+            raise
+        finally:
+            self.release(session, discard=discard or not session.transport.is_active())
+
+    def run(self, operation, retries=1):
+        '''
+            Runs operation(sftp) with a pooled session, if the connection fails it is retried on a fresh session
+        '''
+        while True:
+            try:
+                with self.session() as sftp:
+                    return operation(sftp)
+            except connection_errors():
+                if retries <= 0:
+                    raise
+                retries -= 1
+                print("SFTP connection to the NAS failed, retrying with a new session...")
+
+    def stats(self) -> dict:
+        return {
+            "idle_sessions": len(self._idle),
+            "checked_out_sessions": self._checked_out,
+            "handshakes": self.handshakes,
+            "reuses": self.reuses,
+        }
+
+
+pool = SFTPSessionPool()
+
+
+def sftp_session():
+    return pool.session()
+
+
+def archive_path(uploaded_file: UploadedFile) -> str:
+    '''
+        Path of the archived copy of the uploaded file on the NAS, compressed copies have the codec's extension added
+    '''
+    return os.path.join(NAS_PATH, uploaded_file.file_path) + COMPRESSION_EXTENSIONS[uploaded_file.compression]
+
+def choose_compression(uploaded_file: UploadedFile, local_path: str) -> str:
+    '''
+        Decides whether a file is worth compressing from its type and how well a sample of it compresses
+    '''
+    if not NAS_COMPRESSION:
+        return UploadedFile.Compression.NONE
+    if uploaded_file.file_type not in COMPRESSIBLE_FILE_TYPES and uploaded_file.mime_type not in COMPRESSIBLE_MIMETYPES:
+        return UploadedFile.Compression.NONE
+    try:
+        import zstandard
+    except ImportError:
+        return UploadedFile.Compression.NONE
+    with open(local_path, 'rb') as local_file:
+        sample = local_file.read(NAS_COMPRESSION_SAMPLE_SIZE)
+    if not sample:
+        return UploadedFile.Compression.NONE
+    compressed_sample = zstandard.ZstdCompressor(level=NAS_COMPRESSION_LEVEL).compress(sample)
+    if len(compressed_sample) / len(sample) <= NAS_COMPRESSION_MAX_RATIO:
+        return UploadedFile.Compression.ZSTD
+    return UploadedFile.Compression.NONE
+
+
+class CountingWriter():
+    '''
+        Wraps a file so that the number of bytes written through it can be checked once the compressor is finished with it
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        return self.file.flush()
+
+
+def put_file(sftp: paramiko.SFTPClient, local_path: str, remote_path: str, compression=UploadedFile.Compression.NONE) -> int:
+    '''
+        Uploads a local file to the NAS with pipelined writes and verifies the size of the remote copy, returns the number of bytes sent.\n
+        When a compression codec is given the file is compressed as it is streamed to the NAS.\n
+        Large uncompressed files are sent in chunks over several sessions at once, see put_file_chunked
+    '''
+    start = time.perf_counter()
+    if should_chunk(os.path.getsize(local_path), compression):
+        size = put_file_chunked(sftp, local_path, remote_path)
+        metrics.record_transfer(metrics.UPLOAD, size, time.perf_counter() - start)
+        return size
+    with open(local_path, 'rb') as local_file, sftp.open(remote_path, 'wb') as remote_file:
+        # Pipelining sends writes without waiting for each one to be acknowledged, errors are raised when the file is closed
+        remote_file.set_pipelined(True)
+        destination = CountingWriter(remote_file)
+        if compression == UploadedFile.Compression.ZSTD:
+            import zstandard
+            compressor = zstandard.ZstdCompressor(level=NAS_COMPRESSION_LEVEL, write_checksum=True)
+            with compressor.stream_writer(destination, size=os.fstat(local_file.fileno()).st_size, closefd=False) as writer:
+                while chunk := local_file.read(TRANSFER_BLOCK_SIZE):
+                    writer.write(chunk)
+        else:
+            while chunk := local_file.read(TRANSFER_BLOCK_SIZE):
+                destination.write(chunk)
+    size = destination.bytes_written
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != size:
+        raise IOError(f"Size mismatch after uploading {local_path} to {remote_path}, sent {size} bytes but the NAS has {remote_size} bytes!")
+    metrics.record_transfer(metrics.UPLOAD, size, time.perf_counter() - start)
+    return size
+
+def get_file(sftp: paramiko.SFTPClient, remote_path: str, local_path: str, compression=UploadedFile.Compression.NONE) -> int:
+    '''
+        Downloads a file from the NAS with prefetching and verifies it as it is received, returns the size of the local copy.\n
+        The file is downloaded to a .part file first so that an interrupted download never leaves a partial file at local_path.\n
+        Large uncompressed files are fetched in chunks over several sessions at once, see get_file_chunked
+    '''
+    start = time.perf_counter()
+    if should_chunk(sftp.stat(remote_path).st_size, compression):
+        size = get_file_chunked(sftp, remote_path, local_path)
+        metrics.record_transfer(metrics.DOWNLOAD, size, time.perf_counter() - start)
+        return size
+    # Unchunked downloads are recorded by iter_file
+    part_path = f"{local_path}.part"
+    try:
+        with open(part_path, 'wb') as local_file:
+            for block in iter_file(sftp, remote_path, compression):
+                local_file.write(block)
+        os.replace(part_path, local_path)
+    finally:
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+    return os.path.getsize(local_path)
+
+def iter_file(sftp: paramiko.SFTPClient, remote_path: str, compression=UploadedFile.Compression.NONE):
+    '''
+        Reads a file from the NAS in order with prefetching, yielding its original contents a block at a time.\n
+        Compressed files are decompressed as they are streamed back, zstd frames carry a checksum so corruption is caught while decompressing.\n
+        Files uploaded in chunks are checked against their manifest as they are read, the size is checked once the whole file has been read
+    '''
+    start = time.perf_counter()
+    with sftp.open(remote_path, 'rb') as remote_file:
+        remote_size = remote_file.stat().st_size
+        manifest = read_manifest(sftp, manifest_path(remote_path)) if should_chunk(remote_size, compression) else None
+        verifier = ChunkVerifier(manifest, remote_path) if manifest is not None else None
+        # Prefetching requests the whole file up front so reads are not bound by the round trip time to the NAS
+        remote_file.prefetch(remote_size, max_concurrent_requests=NAS_PREFETCH_REQUESTS)
+        if compression == UploadedFile.Compression.ZSTD:
+            import zstandard
+            with zstandard.ZstdDecompressor().stream_reader(remote_file, closefd=False) as reader:
+                while block := reader.read(TRANSFER_BLOCK_SIZE):
+                    yield block
+        else:
+            while block := remote_file.read(TRANSFER_BLOCK_SIZE):
+                if verifier is not None:
+                    verifier.update(block)
+                yield block
+        if verifier is not None:
+            verifier.finish()
+        # The compressed size is what is checked against the NAS, the frame checksum covers the decompressed content
+        size = remote_file.tell()
+    if remote_size != size:
+        raise IOError(f"Size mismatch after reading {remote_path}, the NAS has {remote_size} bytes but only {size} bytes were received!")
+    # Includes the time the caller spent handling each block, eg: writing it to disk or sending it to a client
+    metrics.record_transfer(metrics.DOWNLOAD, size, time.perf_counter() - start)
+
+
+class ChunkVerifier():
+    '''
+        Checks a chunked file against its manifest while it is being read in order
+    '''
+
+    def __init__(self, manifest: dict, remote_path: str):
+        self.chunk_size = manifest['chunk_size']
+        self.checksums = manifest['chunks']
+        self.remote_path = remote_path
+        self.index = 0
+        self.filled = 0
+        self.digest = hashlib.sha256()
+
+    def update(self, data: bytes):
+        data = memoryview(data)
+        while data:
+            take = min(len(data), self.chunk_size - self.filled)
+            self.digest.update(data[:take])
+            self.filled += take
+            data = data[take:]
+            if self.filled == self.chunk_size:
+                self._finish_chunk()
+
+    def _finish_chunk(self):
+        if self.index >= len(self.checksums) or self.digest.hexdigest() != self.checksums[self.index]:
+            raise IOError(f"Chunk {self.index} of {self.remote_path} does not match its manifest checksum!")
+        self.index += 1
+        self.filled = 0
+        self.digest = hashlib.sha256()
+
+    def finish(self):
+        if self.filled:
+            self._finish_chunk()
+        if self.index != len(self.checksums):
+            raise IOError(f"{self.remote_path} is missing {len(self.checksums) - self.index} chunks listed in its manifest!")
+
+def remote_exists(sftp: paramiko.SFTPClient, remote_path: str) -> bool:
+    try:
+        sftp.stat(remote_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def remove_file(sftp: paramiko.SFTPClient, remote_path: str):
+    '''
+        Removes a file from the NAS along with its chunk manifest if it was uploaded in chunks
+    '''
+    sftp.remove(remote_path)
+    try:
+        sftp.remove(manifest_path(remote_path))
+    except FileNotFoundError:
+        pass
+
+
+#################################################
+#              Chunked Transfers                #
+#################################################
+
+def should_chunk(size: int, compression=UploadedFile.Compression.NONE) -> bool:
+    # Compressed files are a single zstd stream which cannot be split, so only uncompressed files are chunked
+    return compression == UploadedFile.Compression.NONE and size >= NAS_CHUNKED_TRANSFER_THRESHOLD
+
+def chunk_ranges(size: int, chunk_size: int = NAS_CHUNK_SIZE):
+    '''
+        returns: a list of (index, offset, length) tuples covering a file of the given size
+    '''
+    return [(index, offset, min(chunk_size, size - offset)) for index, offset in enumerate(range(0, size, chunk_size))]
+
+def manifest_path(remote_path: str) -> str:
+    return remote_path + MANIFEST_EXTENSION
+
+def read_manifest(sftp: paramiko.SFTPClient, path: str):
+    '''
+        Reads a chunk manifest from the NAS, returns None if there is no manifest or it cannot be read
+    '''
+    try:
+        with sftp.open(path, 'r') as manifest_file:
+            return json.loads(manifest_file.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_manifest(sftp: paramiko.SFTPClient, path: str, manifest: dict):
+    # The manifest is written to a temporary file and renamed over the old one so a dropped connection never leaves it truncated
+    temporary_path = f"{path}.tmp"
+    with sftp.open(temporary_path, 'w') as manifest_file:
+        manifest_file.write(json.dumps(manifest))
+    sftp.posix_rename(temporary_path, path)
+
+def hash_range(file, offset: int, length: int) -> str:
+    digest = hashlib.sha256()
+    file.seek(offset)
+    while length > 0:
+        block = file.read(min(TRANSFER_BLOCK_SIZE, length))
+        if not block:
+            break
+        digest.update(block)
+        length -= len(block)
+    return digest.hexdigest()
+
+def run_chunks(sftp: paramiko.SFTPClient, chunks, operation, callback, description: str):
+    '''
+        Transfers chunks concurrently over up to NAS_CHUNK_WORKERS sessions the pool can spare, a chunk whose connection drops is retried on a fresh session.\n
+        When every session is already in use, eg: by the other workers of run_transfers, the chunks are sent one at a time over sftp instead.\n
+        Chunks that completed are reported to callback before any failure is raised so the transfer can resume from them
+    '''
+    def chunk_finished(chunk, checksum, error, elapsed):
+        if error is None:
+            callback(chunk, checksum)
+
+    lanes = pool.reserve_lanes(NAS_CHUNK_WORKERS)
+    try:
+        if lanes:
+            results = run_transfers(chunks, operation, max_workers=lanes, callback=chunk_finished)
+        else:
+            results = []
+            for chunk in chunks:
+                start = time.perf_counter()
+                try:
+                    results.append((chunk, operation(sftp, chunk), None, time.perf_counter() - start))
+                except Exception as e:
+                    # The rest are left for the resume rather than tried over a session that may have just failed
+                    results.append((chunk, None, e, time.perf_counter() - start))
+                    break
+                chunk_finished(*results[-1])
+    finally:
+        pool.release_lanes(lanes)
+    errors = [error for chunk, checksum, error, elapsed in results if error is not None]
+    if errors:
+        raise IOError(f"{len(errors)} of {len(results)} chunks failed while {description}, the transfer will resume from the completed chunks") from errors[0]
+
+def put_file_chunked(sftp: paramiko.SFTPClient, local_path: str, remote_path: str) -> int:
+    '''
+        Uploads a large file to the NAS in fixed size chunks sent over several sessions at once, returns the number of bytes sent.\n
+        Chunks are written into a .part file on the NAS and the checksum of each completed chunk is recorded in its manifest,
+        so an interrupted upload resumes from the chunks that already made it. Once every chunk is in place the size is verified,
+        the manifest is stored next to the file for restores to check against and the .part file is renamed into place
+    '''
+    size = os.path.getsize(local_path)
+    part_path = f"{remote_path}.part"
+    part_manifest_path = manifest_path(part_path)
+
+    manifest = read_manifest(sftp, part_manifest_path)
+    if manifest is None or manifest.get('size') != size or manifest.get('chunk_size') != NAS_CHUNK_SIZE or not remote_exists(sftp, part_path):
+        manifest = {'size': size, 'chunk_size': NAS_CHUNK_SIZE, 'chunks': {}}
+        with sftp.open(part_path, 'w'):
+            pass
+        write_manifest(sftp, part_manifest_path, manifest)
+
+    chunks = chunk_ranges(size, NAS_CHUNK_SIZE)
+    remaining = []
+    with open(local_path, 'rb') as local_file:
+        for index, offset, length in chunks:
+            # A completed chunk is only skipped if the local file still has the same contents in that range
+            if manifest['chunks'].get(str(index)) != hash_range(local_file, offset, length):
+                remaining.append((index, offset, length))
+    if len(remaining) < len(chunks):
+        print(f"Resuming chunked upload of {local_path}, {len(chunks) - len(remaining)} of {len(chunks)} chunks are already on the NAS")
+
+    def send_chunk(chunk_sftp: paramiko.SFTPClient, chunk):
+        index, offset, length = chunk
+        digest = hashlib.sha256()
+        with open(local_path, 'rb') as local_file, chunk_sftp.open(part_path, 'r+') as remote_file:
+            remote_file.set_pipelined(True)
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            while length > 0:
+                block = local_file.read(min(TRANSFER_BLOCK_SIZE, length))
+                if not block:
+                    raise IOError(f"{local_path} was truncated while it was being uploaded!")
+                digest.update(block)
+                remote_file.write(block)
+                length -= len(block)
+        return digest.hexdigest()
+
+    def chunk_sent(chunk, checksum):
+        manifest['chunks'][str(chunk[0])] = checksum
+        write_manifest(sftp, part_manifest_path, manifest)
+
+    run_chunks(sftp, remaining, send_chunk, chunk_sent, f"uploading {local_path}")
+
+    remote_size = sftp.stat(part_path).st_size
+    if remote_size != size:
+        raise IOError(f"Size mismatch after uploading {local_path} to {part_path}, sent {size} bytes but the NAS has {remote_size} bytes!")
+    write_manifest(sftp, manifest_path(remote_path), {'size': size, 'chunk_size': NAS_CHUNK_SIZE, 'chunks': [manifest['chunks'][str(index)] for index, offset, length in chunks]})
+    sftp.posix_rename(part_path, remote_path)
+    sftp.remove(part_manifest_path)
+    return size
+
+def get_file_chunked(sftp: paramiko.SFTPClient, remote_path: str, local_path: str) -> int:
+    '''
+        Downloads a large file from the NAS in fixed size chunks fetched over several sessions at once, returns the number of bytes received.\n
+        Each chunk is checked against the manifest stored next to the file, completed chunks are recorded in a local journal so an
+        interrupted download resumes from them. The .part file is only renamed to local_path once every chunk is in place and verified
+    '''
+    size = sftp.stat(remote_path).st_size
+    manifest = read_manifest(sftp, manifest_path(remote_path))
+    if manifest is not None and manifest.get('size') != size:
+        raise IOError(f"The manifest for {remote_path} is for a {manifest.get('size')} byte file but the NAS has {size} bytes!")
+    # Files archived before chunked transfers existed have no manifest, they are still fetched in chunks but only their size is verified
+    checksums = manifest['chunks'] if manifest is not None else None
+    chunk_size = manifest['chunk_size'] if manifest is not None else NAS_CHUNK_SIZE
+
+    part_path = f"{local_path}.part"
+    journal_path = f"{part_path}.journal"
+    journal = None
+    try:
+        with open(journal_path, 'r') as journal_file:
+            journal = json.load(journal_file)
+    except (FileNotFoundError, ValueError):
+        pass
+    if journal is None or journal.get('size') != size or journal.get('chunk_size') != chunk_size or not os.path.isfile(part_path):
+        journal = {'size': size, 'chunk_size': chunk_size, 'chunks': []}
+        with open(part_path, 'wb') as local_file:
+            local_file.truncate(size)
+
+    chunks = chunk_ranges(size, chunk_size)
+    remaining = []
+    with open(part_path, 'rb') as local_file:
+        for index, offset, length in chunks:
+            if index in journal['chunks'] and (checksums is None or checksums[index] == hash_range(local_file, offset, length)):
+                continue
+            remaining.append((index, offset, length))
+    if len(remaining) < len(chunks):
+        print(f"Resuming chunked download of {remote_path}, {len(chunks) - len(remaining)} of {len(chunks)} chunks are already local")
+    journal['chunks'] = [index for index, offset, length in chunks if (index, offset, length) not in remaining]
+
+    def receive_chunk(chunk_sftp: paramiko.SFTPClient, chunk):
+        index, offset, length = chunk
+        digest = hashlib.sha256()
+        with chunk_sftp.open(remote_path, 'rb') as remote_file, open(part_path, 'r+b') as local_file:
+            remote_file.seek(offset)
+            # Prefetching from the current position only requests this chunk's range
+            remote_file.prefetch(offset + length, max_concurrent_requests=NAS_PREFETCH_REQUESTS)
+            local_file.seek(offset)
+            while length > 0:
+                block = remote_file.read(min(TRANSFER_BLOCK_SIZE, length))
+                if not block:
+                    raise IOError(f"{remote_path} was truncated while it was being downloaded!")
+                digest.update(block)
+                local_file.write(block)
+                length -= len(block)
+        checksum = digest.hexdigest()
+        if checksums is not None and checksum != checksums[index]:
+            raise IOError(f"Chunk {index} of {remote_path} does not match its manifest checksum!")
+        return checksum
+
+    def chunk_received(chunk, checksum):
+        journal['chunks'].append(chunk[0])
+        with open(journal_path, 'w') as journal_file:
+            json.dump(journal, journal_file)
+
+    run_chunks(sftp, remaining, receive_chunk, chunk_received, f"downloading {remote_path}")
+
+    local_size = os.path.getsize(part_path)
+    if local_size != size:
+        raise IOError(f"Size mismatch after downloading {remote_path} to {local_path}, the NAS has {size} bytes but the local copy has {local_size} bytes!")
+    os.replace(part_path, local_path)
+    if os.path.isfile(journal_path):
+        os.remove(journal_path)
+    return size
+
+def run_transfers(items, operation, max_workers=NAS_TRANSFER_WORKERS, callback=None):
+    '''
+        Runs operation(sftp, item) for every item using a bounded pool of worker threads, each with its own pooled session.\n
+        Items are consumed lazily so querysets and generators can be passed in directly.\n
+        callback(item, result, error, seconds taken) is called as each item finishes, calls are serialised so it does not need to be thread safe.\n
+        returns: a list of (item, result, error, seconds taken) tuples, error is None when the operation succeeded
+    '''
+    items = iter(items)
+    items_lock = threading.Lock()
+    results_lock = threading.Lock()
+    results = []
+
+    def record(*result):
+        with results_lock:
+            results.append(result)
+            if callback is not None:
+                callback(*result)
+
+    def worker():
+        try:
+            while True:
+                with items_lock:
+                    item = next(items, StopIteration)
+                if item is StopIteration:
+                    return
+                start = time.perf_counter()
+                try:
+                    result = pool.run(lambda sftp: operation(sftp, item))
+                except Exception as e:
+                    record(item, None, e, time.perf_counter() - start)
+                else:
+                    record(item, result, None, time.perf_counter() - start)
+        finally:
+            # Each worker thread gets its own database connection which needs to be closed once it is finished
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        workers = [executor.submit(worker) for i in range(max_workers)]
+        for future in workers:
+            future.result()
+    return results
@@ -0,0 +1,149 @@
+from django.http import HttpRequest
+from django.conf import settings
+from .models import UploadedFile
+from filehost import metrics, sandbox
+import os, time
+
+# Image formats that variants can be created in, mapped to their file extension and Pillow format name
+VARIANT_FORMATS = {
+    'image/avif': ('avif', 'AVIF'),
+    'image/webp': ('webp', 'WEBP'),
+}
+
+# Only still raster images are converted, animated gifs and svgs are always served as the original
+SOURCE_MIMETYPES = ['image/png', 'image/jpeg', 'image/bmp', 'image/tiff', 'image/x-ms-bmp']
+
+# How long a variant can be marked as pending before we assume the task creating it has died and try again
+PENDING_TIMEOUT = 600
+
+
+def parse_accept(accept_header: str):
+    '''
+        Parses an Accept header into a dict of media type -> quality value.\n
+        Media types listed with q=0 are kept with a quality of 0 so that they can be treated as refused.
+    '''
+    accepted = {}
+    for media_range in accept_header.split(','):
+        parts = [part.strip() for part in media_range.split(';')]
+        media_type = parts[0].lower()
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[media_type] = quality
+    return accepted
+
+def choose_format(accept_header: str, source_mime_type: str):
+    '''
+        Picks the best variant format the client has explicitly accepted, or None if the original should be served.\n
+        Wildcards are ignored as browsers send */* even when they cannot display avif or webp.
+    '''
+    if source_mime_type not in SOURCE_MIMETYPES or not accept_header:
+        return None
+    accepted = parse_accept(accept_header)
+    best, best_quality = None, 0.0
+    for mime_type in settings.NEGOTIATION_FORMATS:
+        if mime_type not in VARIANT_FORMATS or mime_type == source_mime_type:
+            continue
+        quality = accepted.get(mime_type, 0.0)
+        # Formats are listed in order of preference so only a strictly higher quality value can replace an earlier format
+        if quality > best_quality:
+            best, best_quality = mime_type, quality
+    return best
+
+def variant_path(uploaded_file: UploadedFile, mime_type: str):
+    '''
+        Variants are cached next to the original, eg: API/IMAGE/gZ8tMsnP.png.webp
+    '''
+    ext = VARIANT_FORMATS[mime_type][0]
+    return os.path.join(settings.MEDIA_ROOT, f"{uploaded_file.file_path}.{ext}")
+
+def negotiated_variant(request: HttpRequest, uploaded_file: UploadedFile):
+    '''
+        Returns the path and mime type of the variant to serve for this request or (None, None) to serve the original.\n
+        If the variant does not exist yet it is queued for creation and the original is served in the mean time.
+    '''
+    if not settings.NEGOTIATE_IMAGE_FORMATS or uploaded_file.file_type != UploadedFile.FileType.IMAGE or uploaded_file.state != UploadedFile.State.LOCAL:
+        return None, None
+
+    mime_type = choose_format(request.META.get('HTTP_ACCEPT', ''), uploaded_file.mime_type)
+    if mime_type is None:
+        return None, None
+
+    path = variant_path(uploaded_file, mime_type)
+    try:
+        # An empty variant marks that the conversion was not smaller than the original so the original should be served
+        if os.stat(path).st_size > 0:
+            metrics.cache_lookup("image_variant", hit=True)
+            return path, mime_type
+        metrics.cache_lookup("image_variant", hit=True)
+        return None, None
+    except FileNotFoundError:
+        metrics.cache_lookup("image_variant", hit=False)
+
+    if claim_pending(path):
+        from .tasks import create_image_variant # import moved into function due to circular import
+        create_image_variant.delay(uploaded_file.slug, mime_type)
+    return None, None
+
+def claim_pending(path: str, stale_after: int = PENDING_TIMEOUT) -> bool:
+    '''
+        Creates the pending marker for a variant, returns False if another request has already queued the variant.\n
+        Markers older than stale_after seconds are taken over, it must be longer than the task that removes the marker can run for
+    '''
+    pending_path = f"{path}.pending"
+    try:
+        fd = os.open(pending_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.close(fd)
+        return True
+    except FileExistsError:
+        try:
+            if os.stat(pending_path).st_mtime < time.time() - stale_after:
+                # Stale marker, the task that was creating this variant must have died so we will take over
+                os.utime(pending_path)
+                return True
+        except FileNotFoundError:
+            pass
+        return False
+    except OSError:
+        return False
+
+def render_variant(source_path: str, destination_path: str, pil_format: str) -> int:
+    '''
+        Runs inside the sandbox. Converts the image at source_path to pil_format and writes it to destination_path.\n
+        returns: the size of the variant in bytes
+    '''
+    from PIL import Image, ImageOps
+    import warnings
+    # Variants are full size so nothing can be skipped while decoding, images over the thumbnail pixel limit raise instead
+    Image.MAX_IMAGE_PIXELS = settings.THUMBNAIL_MAX_IMAGE_PIXELS
+    warnings.simplefilter("error", Image.DecompressionBombWarning)
+    with Image.open(source_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        img.save(destination_path, format=pil_format, quality=80)
+    return os.path.getsize(destination_path)
+
+def render_variant_sandboxed(source_path: str, destination_path: str, pil_format: str) -> int:
+    '''
+        Converts source_path in a sandboxed child process with the same limits as thumbnail previews.\n
+        returns: the size of the variant in bytes, raises sandbox.SandboxError if decoding failed or passed a limit
+    '''
+    return sandbox.run_limited(render_variant, source_path, destination_path, pil_format,
+                               memory_limit=settings.THUMBNAIL_MEMORY_LIMIT, cpu_limit=settings.THUMBNAIL_CPU_LIMIT, timeout=settings.THUMBNAIL_TIMEOUT)
+
+def delete_image_variants(uploaded_file: UploadedFile):
+    '''
+        Removes any cached variants of the uploaded file, this needs to be done when the original is archived or deleted
+    '''
+    for mime_type in VARIANT_FORMATS.keys():
+        path = variant_path(uploaded_file, mime_type)
+        for variant_file in (path, f"{path}.pending"):
+            if os.path.isfile(variant_file):
+                os.remove(variant_file)
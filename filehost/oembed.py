@@ -2,7 +2,7 @@ from django.http import HttpRequest
 from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 from .models import UploadedFile
-from PIL import Image
+from filehost import metrics
 from dicttoxml import dicttoxml
 import json 
 
@@ -77,9 +77,11 @@ def build_oembed_dict(request: HttpRequest, uploaded_file: UploadedFile, max_wid
     if uploaded_file.slug in CACHED_OEMBED_DICT.keys():
         resp, last_accessed = CACHED_OEMBED_DICT[uploaded_file.slug]
         CACHED_OEMBED_DICT[uploaded_file.slug] = (resp, timezone.now())
+        metrics.cache_lookup("oembed", hit=True)
         return None, resp
     
     # Response is not cached, create a new one...
+    metrics.cache_lookup("oembed", hit=False)
 
     oembed_response = {
         "version": "1.0",
@@ -96,6 +98,7 @@ def build_oembed_dict(request: HttpRequest, uploaded_file: UploadedFile, max_wid
 
         case UploadedFile.FileType.IMAGE:
             oembed_response["type"] = "photo"
+            from PIL import Image # imported here so that web workers only load Pillow once an image embed is requested
             img = Image.open(uploaded_file.file.path)
             img_width, img_height = img.size
             
@@ -0,0 +1,193 @@
+from django.conf import settings
+from filehost.models import UploadedFile, StoredFile, SLUG_LENGTH
+from filehost import manifest
+from stat import S_ISREG
+import os, time
+
+# Orphan detection works from the storage manifest (see filehost/manifest.py), or with a full scan loads every known slug once
+# into a compact sorted index and diffs it against a single listing of each upload directory, rather than querying the
+# database for every file found on disk or on the NAS.
+
+# Files modified more recently than this (seconds) before the index was loaded are never treated as orphans,
+# they may belong to an upload that had not been saved to the database yet
+ORPHAN_GRACE_PERIOD = 3600
+# Orphans are removed this many at a time
+ORPHAN_BATCH_SIZE = 500
+# Number of orphaned paths listed in the report
+REPORT_SAMPLE_SIZE = 100
+
+
+class SlugIndex():
+    '''
+        Every known slug packed into one sorted byte string, SLUG_LENGTH bytes per file rather than a python string object each
+    '''
+
+    def __init__(self, slugs):
+        self.loaded_at = time.time()
+        records = []
+        # Slugs are always generated at SLUG_LENGTH but the column allows shorter ones, those few are kept in a normal set
+        self.irregular = set()
+        for slug in slugs:
+            if len(slug) == SLUG_LENGTH and slug.isascii():
+                records.append(slug.encode('ascii'))
+            else:
+                self.irregular.add(slug)
+        records.sort()
+        self.data = b"".join(records)
+        self.count = len(records)
+
+    @classmethod
+    def load(cls):
+        # Files pending deletion still own their stored files until the reaper removes them
+        return cls(UploadedFile.all_objects.values_list('slug', flat=True).iterator(chunk_size=10000))
+
+    def __len__(self):
+        return self.count + len(self.irregular)
+
+    def __contains__(self, slug: str) -> bool:
+        if len(slug) != SLUG_LENGTH or not slug.isascii():
+            return slug in self.irregular
+        key = slug.encode('ascii')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self.data[middle * SLUG_LENGTH:(middle + 1) * SLUG_LENGTH]
+            if record < key:
+                low = middle + 1
+            elif record > key:
+                high = middle
+            else:
+                return True
+        return False
+
+    def owns(self, filename: str) -> bool:
+        # Files are named after their slug, eg: gZ8tMsnP.png, gZ8tMsnP.png.webp, gZ8tMsnP.png.jpeg
+        return filename.split('.')[0] in self
+
+
+class OrphanReport():
+    '''
+        Counts of what an orphan cleanup found, on a dry run nothing is removed and removed stays at 0
+    '''
+
+    def __init__(self, location: str, dry_run=False):
+        self.location = location
+        self.dry_run = dry_run
+        self.scanned = 0
+        self.orphans = 0
+        self.orphaned_bytes = 0
+        self.removed = 0
+        self.failed = 0
+        self.sample = []
+
+    def add(self, path: str, size: int):
+        self.orphans += 1
+        self.orphaned_bytes += size
+        if len(self.sample) < REPORT_SAMPLE_SIZE:
+            self.sample.append(path)
+
+    def as_dict(self) -> dict:
+        return {
+            "location": self.location,
+            "dry_run": self.dry_run,
+            "scanned": self.scanned,
+            "orphans": self.orphans,
+            "orphaned_bytes": self.orphaned_bytes,
+            "removed": self.removed,
+            "failed": self.failed,
+            "sample": self.sample,
+        }
+
+
+def local_directories():
+    for directory in manifest.local_directories():
+        yield os.path.join(settings.MEDIA_ROOT, directory)
+
+def archive_directories(nas_path: str):
+    for directory in manifest.archive_directories():
+        yield nas_path + directory
+
+def scan_local(index: SlugIndex, report: OrphanReport):
+    '''
+        Lists each upload directory in MEDIA_ROOT once, yields (path, size) for every file that does not belong to a known slug
+    '''
+    cutoff = index.loaded_at - ORPHAN_GRACE_PERIOD
+    for directory in local_directories():
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                report.scanned += 1
+                if index.owns(entry.name):
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime >= cutoff:
+                    continue
+                yield entry.path, stat.st_size
+
+def scan_archive(sftp, nas_path: str, index: SlugIndex, report: OrphanReport):
+    '''
+        Lists each upload directory on the NAS once, yields (path, size) for every file that does not belong to a known slug
+    '''
+    cutoff = index.loaded_at - ORPHAN_GRACE_PERIOD
+    for directory in archive_directories(nas_path):
+        try:
+            # listdir_iter streams the listing rather than building a list of every file in the directory first
+            entries = sftp.listdir_iter(directory)
+            for entry in entries:
+                if not S_ISREG(entry.st_mode):
+                    continue
+                report.scanned += 1
+                if index.owns(entry.filename) or entry.st_mtime >= cutoff:
+                    continue
+                yield directory + "/" + entry.filename, entry.st_size
+        except FileNotFoundError:
+            continue
+
+def scan_manifest(location: str, root: str, report: OrphanReport):
+    '''
+        Yields (path, size) for every file in the storage manifest that does not belong to a known slug, the manifest should be reconciled first
+    '''
+    cutoff = time.time() - ORPHAN_GRACE_PERIOD
+    report.scanned = StoredFile.objects.filter(location=location).count()
+    for directory, name, size, mtime in manifest.orphaned_files(location).values_list('directory', 'name', 'size', 'mtime').iterator():
+        if mtime >= cutoff:
+            continue
+        yield os.path.join(root, directory, name), size
+
+def remove_in_batches(orphans, remove_batch, report: OrphanReport):
+    '''
+        Removes orphans ORPHAN_BATCH_SIZE at a time with remove_batch(paths), which returns how many of the paths it removed
+    '''
+    batch = []
+    for path, size in orphans:
+        report.add(path, size)
+        if report.dry_run:
+            continue
+        batch.append(path)
+        if len(batch) >= ORPHAN_BATCH_SIZE:
+            removed = remove_batch(batch)
+            report.removed += removed
+            report.failed += len(batch) - removed
+            print(f"Removed {removed} of {len(batch)} orphaned {report.location} files")
+            batch = []
+    if batch:
+        removed = remove_batch(batch)
+        report.removed += removed
+        report.failed += len(batch) - removed
+        print(f"Removed {removed} of {len(batch)} orphaned {report.location} files")
+    return report
+
+def remove_local_batch(paths) -> int:
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
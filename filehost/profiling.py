@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.db import connection
+from django.http import HttpRequest, FileResponse, HttpResponseNotFound, HttpResponseForbidden
+from django.urls import reverse
+from django.utils import timezone
+import os, secrets, time
+
+# Superusers can profile a single request by sending the X-Profile header or adding ?_profile=1 to the url. The view is run
+# under cProfile with every SQL query timed, and the report is saved under PROFILE_REPORT_ROOT for download, the url of
+# the report is returned in the X-Profile-Report header. Requests without the flag only pay for one header and one
+# query string lookup. Streaming responses are only profiled up to the point the response is returned, not while streaming.
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+PROFILE_QUERY_FLAG = "_profile"
+# Number of functions and queries listed in each report
+REPORT_FUNCTIONS = 60
+REPORT_QUERIES = 50
+
+
+class QueryTimer():
+    '''
+        Database execute wrapper that records the time taken by every query run while profiling
+    '''
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - start, sql))
+
+
+class ProfilingMiddleware():
+    '''
+        Profiles requests from superusers that ask for it, must come after AuthenticationMiddleware
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest):
+        if PROFILE_HEADER not in request.META and PROFILE_QUERY_FLAG not in request.META.get('QUERY_STRING', ''):
+            return self.get_response(request)
+        if not (request.user.is_authenticated and request.user.is_superuser):
+            return self.get_response(request)
+        return profile_request(request, self.get_response)
+
+
+def profile_request(request: HttpRequest, get_response):
+    import cProfile # only imported once a request is actually profiled
+    profiler = cProfile.Profile()
+    query_timer = QueryTimer()
+    start = time.perf_counter()
+    with connection.execute_wrapper(query_timer):
+        profiler.enable()
+        try:
+            response = get_response(request)
+        finally:
+            profiler.disable()
+    elapsed = time.perf_counter() - start
+    name = save_report(request, profiler, query_timer.queries, elapsed)
+    response["X-Profile-Report"] = reverse("filehost:profile-report", kwargs={'name': name})
+    return response
+
+def save_report(request: HttpRequest, profiler, queries, elapsed: float) -> str:
+    '''
+        Writes a text report and the raw profile (which can be opened with pstats or snakeviz) to PROFILE_REPORT_ROOT.\n
+        returns: the name of the text report
+    '''
+    import io, pstats
+    os.makedirs(settings.PROFILE_REPORT_ROOT, exist_ok=True)
+    name = f"{timezone.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(4)}"
+
+    stream = io.StringIO()
+    stream.write(f"{request.method} {request.get_full_path()}\n")
+    stream.write(f"Profiled by {request.user} at {timezone.now().isoformat()}\n")
+    query_time = sum(duration for duration, sql in queries)
+    stream.write(f"Total time: {elapsed:.4f}s, {len(queries)} queries taking {query_time:.4f}s\n\n")
+
+    stream.write("Slowest queries\n")
+    for duration, sql in sorted(queries, key=lambda query: query[0], reverse=True)[:REPORT_QUERIES]:
+        stream.write(f"{duration * 1000:10.3f}ms  {sql}\n")
+    stream.write("\n")
+
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_FUNCTIONS)
+    stats.dump_stats(os.path.join(settings.PROFILE_REPORT_ROOT, f"{name}.prof"))
+    with open(os.path.join(settings.PROFILE_REPORT_ROOT, f"{name}.txt"), 'w') as f:
+        f.write(stream.getvalue())
+
+    remove_old_reports()
+    return f"{name}.txt"
+
+def remove_old_reports():
+    '''
+        Keeps only the newest PROFILE_REPORTS_KEPT reports
+    '''
+    reports = sorted(entry.name for entry in os.scandir(settings.PROFILE_REPORT_ROOT) if entry.name.endswith(".txt"))
+    for report in reports[:-settings.PROFILE_REPORTS_KEPT]:
+        for path in (report, report[:-len(".txt")] + ".prof"):
+            try:
+                os.remove(os.path.join(settings.PROFILE_REPORT_ROOT, path))
+            except FileNotFoundError:
+                pass
+
+def download_report(request: HttpRequest, name: str):
+    if not (request.user.is_authenticated and request.user.is_superuser):
+        return HttpResponseForbidden("Only superusers can download profiling reports.") # 403 Forbidden
+    # Only plain file names written by save_report are served
+    if os.path.basename(name) != name or not (name.endswith(".txt") or name.endswith(".prof")):
+        return HttpResponseNotFound("That profiling report does not exist.") # 404 Not Found
+    path = os.path.join(settings.PROFILE_REPORT_ROOT, name)
+    if not os.path.isfile(path):
+        return HttpResponseNotFound("That profiling report does not exist.") # 404 Not Found
+    return FileResponse(open(path, "rb"), as_attachment=name.endswith(".prof"), content_type="text/plain" if name.endswith(".txt") else "application/octet-stream") # 200 OK
@@ -0,0 +1,101 @@
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from django.conf import settings
+from .models import UploadedFile
+from filehost import nas, segments, tasks
+import os
+
+# Archived files requested through the raw views are streamed straight from the NAS to the client and written to MEDIA_ROOT
+# in the same pass, so the first request for an archived file costs one transfer rather than a queued task and a retry.
+
+# How long (seconds) clients are asked to wait before retrying a file that is already being moved by someone else
+RETRY_AFTER = 5
+
+
+class ArchiveStream():
+    '''
+        Streams an archived file from the NAS to the client while writing it to its local path.\n
+        Once every byte has been sent and verified the file is marked as local. If the client goes away or the transfer fails
+        part way through, the claim is released and the file is handed to the localise task instead
+    '''
+
+    def __init__(self, uploaded_file: UploadedFile, session: nas.SFTPSession):
+        self.uploaded_file = uploaded_file
+        self.session = session
+        self.local_path = os.path.join(settings.MEDIA_ROOT, uploaded_file.file_path)
+        self.part_path = f"{self.local_path}.part"
+        self.local_file = None
+        self.finished = False
+        self.closed = False
+
+    def __iter__(self):
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+        self.local_file = open(self.part_path, 'wb')
+        for block in tasks.iter_archived_copy(self.session.sftp, self.uploaded_file):
+            self.local_file.write(block)
+            yield block
+        self.local_file.close()
+        os.replace(self.part_path, self.local_path)
+        tasks.mark_localised(self.session.sftp, self.uploaded_file)
+        self.finished = True
+        print(f"Localised file: {self.uploaded_file} while streaming it to a client")
+
+    def close(self):
+        '''
+            Called by django once the response is finished with, whether or not it was fully sent
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        if self.local_file is not None:
+            self.local_file.close()
+        # A session abandoned mid transfer may still have prefetch requests in flight so it is not put back in the pool
+        nas.pool.release(self.session, discard=not self.finished)
+        if not self.finished:
+            if os.path.isfile(self.part_path):
+                os.remove(self.part_path)
+            self.uploaded_file.release_moving(UploadedFile.State.ARCHIVED)
+            self.uploaded_file.request_localisation()
+
+
+def archived_size(sftp, uploaded_file: UploadedFile):
+    '''
+        Size of the file once it has been restored, or None when it is compressed as that is only known once it has been decompressed
+    '''
+    if uploaded_file.compression != UploadedFile.Compression.NONE:
+        return None
+    entry = segments.entry_for(uploaded_file)
+    if entry is not None:
+        return entry.length
+    return sftp.stat(nas.archive_path(uploaded_file)).st_size
+
+def serve_archived_file(uploaded_file: UploadedFile, as_attachment=False) -> HttpResponse:
+    '''
+        Claims an archived file and streams it from the NAS while it is de-archived.\n
+        returns: the streaming response, or 503 Service Unavailable if the file is already being moved by another request or worker.\n
+        A move that has gone stale is taken over and handed to the localise task, so the client's retry finds the file local
+    '''
+    if uploaded_file.state == UploadedFile.State.MOVING:
+        uploaded_file.request_localisation()
+    if uploaded_file.state != UploadedFile.State.ARCHIVED or not uploaded_file.claim_moving():
+        response = HttpResponse("This file is archived and is currently being moved, please try again shortly.", status=503) # 503 Service Unavailable
+        response['Retry-After'] = str(RETRY_AFTER)
+        return response
+
+    try:
+        session = nas.pool.acquire()
+    except Exception:
+        uploaded_file.release_moving(UploadedFile.State.ARCHIVED)
+        raise
+    stream = ArchiveStream(uploaded_file, session)
+    try:
+        size = archived_size(session.sftp, uploaded_file)
+    except Exception:
+        stream.close()
+        raise
+
+    response = StreamingHttpResponse(stream, content_type=uploaded_file.mime_type or "application/octet-stream") # 200 OK
+    if size is not None:
+        response['Content-Length'] = str(size)
+    response['Content-Disposition'] = content_disposition_header(as_attachment, os.path.basename(uploaded_file.file_path))
+    return response
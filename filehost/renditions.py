@@ -0,0 +1,170 @@
+from django.conf import settings
+from filehost.models import UploadedFile
+from filehost import negotiation, sandbox
+import glob, os, shutil, subprocess, time
+
+# Video uploads are transcoded once, in the background on the transcodes queue, into an HLS ladder of several resolutions
+# cut into short segments, so that players can start quickly and pick a bitrate that suits their connection rather than
+# downloading the original. The ladder is kept next to the original, eg: API/VIDEO/gZ8tMsnP.mp4.hls/master.m3u8, and like
+# negotiated image variants it is removed when the original is archived or deleted and made again on demand once it is local.
+# ffmpeg runs in the sandbox (see filehost/sandbox.py) with its own, much larger, limits than thumbnails.
+
+# Rungs of the ladder: name -> (height, video bitrate kbps, audio bitrate kbps), highest first. Rungs taller than the original are skipped
+HLS_LADDER = {
+    "1080p": (1080, 5000, 192),
+    "720p": (720, 2800, 128),
+    "480p": (480, 1400, 128),
+    "360p": (360, 800, 96),
+}
+# Length of each segment in seconds, every segment starts on a keyframe so players can switch rungs between any two of them
+HLS_SEGMENT_SECONDS = 4
+MASTER_PLAYLIST = "master.m3u8"
+
+# Files a player may fetch from a ladder, with the type they are served as
+RENDITION_CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+}
+
+
+def renditions_directory(uploaded_file: UploadedFile) -> str:
+    '''
+        Renditions are kept next to the original, eg: API/VIDEO/gZ8tMsnP.mp4.hls/
+    '''
+    return os.path.join(settings.MEDIA_ROOT, f"{uploaded_file.file_path}.hls")
+
+def has_renditions(uploaded_file: UploadedFile) -> bool:
+    # The master playlist is only there once the whole ladder has been moved into place
+    return os.path.isfile(os.path.join(renditions_directory(uploaded_file), MASTER_PLAYLIST))
+
+def rendition_file(uploaded_file: UploadedFile, name: str):
+    '''
+        Resolves a playlist or segment name requested by a player within the file's ladder.\n
+        returns: (path, content type), or (None, None) if the name is not a file of the ladder
+    '''
+    content_type = RENDITION_CONTENT_TYPES.get(os.path.splitext(name)[1])
+    if content_type is None:
+        return None, None
+    directory = os.path.realpath(renditions_directory(uploaded_file))
+    path = os.path.realpath(os.path.join(directory, name))
+    if not path.startswith(directory + os.sep) or not os.path.isfile(path):
+        return None, None
+    return path, content_type
+
+def delete_renditions(uploaded_file: UploadedFile):
+    '''
+        Removes the ladder of the uploaded file, this needs to be done when the original is archived or deleted
+    '''
+    # file_path is only set to a relative path once the file has been uploaded
+    if not uploaded_file.file_path or os.path.isabs(uploaded_file.file_path):
+        return
+    directory = renditions_directory(uploaded_file)
+    # Each transcode works in its own temporary directory, see create_hls_renditions in tasks.py
+    for path in [directory] + glob.glob(f"{glob.escape(directory)}.tmp-*"):
+        shutil.rmtree(path, ignore_errors=True)
+    if os.path.isfile(f"{directory}.pending"):
+        os.remove(f"{directory}.pending")
+
+def request_renditions(uploaded_file: UploadedFile) -> bool:
+    '''
+        Queues the ladder of a local video to be made unless it already exists or has been queued.\n
+        returns: True if the ladder is ready to be played
+    '''
+    if not settings.HLS_RENDITIONS or uploaded_file.file_type != UploadedFile.FileType.VIDEO or uploaded_file.state != UploadedFile.State.LOCAL:
+        return False
+    if has_renditions(uploaded_file):
+        return True
+    # The same pending marker as negotiated variants, so a ladder is only queued once however many viewers ask for it.
+    # A transcode may run for up to HLS_TIMEOUT so the marker is only stale once that, and some time in the queue, has passed
+    if negotiation.claim_pending(renditions_directory(uploaded_file), stale_after=settings.HLS_TIMEOUT + negotiation.PENDING_TIMEOUT):
+        from .tasks import create_hls_renditions # import moved into function due to circular import
+        create_hls_renditions.delay(uploaded_file.slug)
+    return False
+
+
+##################################################
+#                  Transcoding                   #
+##################################################
+
+def probe(source_path: str):
+    '''
+        returns: the height of the first video stream (None if there is not one) and whether there is an audio stream
+    '''
+    import ffmpeg
+    streams = ffmpeg.probe(source_path)["streams"]
+    heights = [int(stream["height"]) for stream in streams if stream.get("codec_type") == "video" and stream.get("height")]
+    has_audio = any(stream.get("codec_type") == "audio" for stream in streams)
+    return (heights[0] if heights else None), has_audio
+
+def ladder_for(height: int) -> list:
+    '''
+        Picks the rungs of HLS_LADDER that are no taller than the original, videos shorter than every rung get a single rung at their own height.\n
+        returns: a list of (name, height, video bitrate kbps, audio bitrate kbps) highest first
+    '''
+    rungs = [(name, rung_height, video_kbps, audio_kbps) for name, (rung_height, video_kbps, audio_kbps) in HLS_LADDER.items() if rung_height <= height]
+    if not rungs:
+        name, (rung_height, video_kbps, audio_kbps) = list(HLS_LADDER.items())[-1]
+        # x264 needs even dimensions
+        even_height = max(2, height - height % 2)
+        rungs = [(f"{even_height}p", even_height, video_kbps, audio_kbps)]
+    return rungs
+
+def transcode_arguments(source_path: str, output_directory: str, rungs: list, has_audio: bool) -> list:
+    '''
+        The ffmpeg command that decodes the original once and encodes every rung from it in a single pass
+    '''
+    outputs = "".join(f"[v{index}]" for index in range(len(rungs)))
+    filters = [f"[0:v:0]split={len(rungs)}{outputs}"]
+    filters += [f"[v{index}]scale=-2:{height}[v{index}out]" for index, (name, height, video_kbps, audio_kbps) in enumerate(rungs)]
+    arguments = ["ffmpeg", "-nostdin", "-y", "-loglevel", "error", "-i", source_path, "-filter_complex", ";".join(filters)]
+
+    stream_map = []
+    for index, (name, height, video_kbps, audio_kbps) in enumerate(rungs):
+        arguments += ["-map", f"[v{index}out]", f"-c:v:{index}", "libx264", f"-b:v:{index}", f"{video_kbps}k",
+                      f"-maxrate:v:{index}", f"{video_kbps * 107 // 100}k", f"-bufsize:v:{index}", f"{video_kbps * 3 // 2}k"]
+        streams = f"v:{index}"
+        if has_audio:
+            arguments += ["-map", "0:a:0", f"-c:a:{index}", "aac", f"-b:a:{index}", f"{audio_kbps}k"]
+            streams += f",a:{index}"
+        stream_map.append(f"{streams},name:{name}")
+
+    arguments += [
+        "-preset", "veryfast", "-pix_fmt", "yuv420p", "-ac", "2",
+        # A keyframe at the start of every segment, scene cuts do not add more so every rung is segmented at the same times
+        "-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})", "-sc_threshold", "0",
+        "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod", "-hls_flags", "independent_segments",
+        "-hls_segment_filename", os.path.join(output_directory, "%v", "segment%04d.ts"),
+        "-master_pl_name", MASTER_PLAYLIST, "-var_stream_map", " ".join(stream_map),
+        os.path.join(output_directory, "%v", "index.m3u8"),
+    ]
+    return arguments
+
+def transcode(source_path: str, output_directory: str) -> dict:
+    '''
+        Runs inside the sandbox. Writes the HLS ladder of source_path to output_directory.\n
+        returns: the rungs that were made and the seconds spent probing and transcoding
+    '''
+    start = time.perf_counter()
+    height, has_audio = probe(source_path)
+    if height is None:
+        raise ValueError(f"{source_path} does not have a video stream")
+    rungs = ladder_for(height)
+    probe_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    os.makedirs(output_directory, exist_ok=True)
+    result = subprocess.run(transcode_arguments(source_path, output_directory, rungs, has_audio), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {result.returncode}: {result.stderr.strip()[-500:]}")
+    return {
+        "renditions": [name for name, height, video_kbps, audio_kbps in rungs],
+        "timings": {"probe": probe_seconds, "transcode": time.perf_counter() - start},
+    }
+
+def transcode_sandboxed(source_path: str, output_directory: str) -> dict:
+    '''
+        Transcodes source_path in a sandboxed child process limited by HLS_MEMORY_LIMIT, HLS_CPU_LIMIT and HLS_TIMEOUT.\n
+        returns: what transcode returned, raises sandbox.SandboxError if ffmpeg failed or passed a limit
+    '''
+    return sandbox.run_limited(transcode, source_path, output_directory,
+                               memory_limit=settings.HLS_MEMORY_LIMIT, cpu_limit=settings.HLS_CPU_LIMIT, timeout=settings.HLS_TIMEOUT)
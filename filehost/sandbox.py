@@ -0,0 +1,104 @@
+import json, os, resource, select, signal, time
+
+# Work that decodes untrusted files (rendering thumbnail previews with Pillow, LibreOffice, ffmpeg etc.) is run in a forked
+# child process so that a decompression bomb or a converter that runs away cannot take the celery worker down with it.
+# The child's address space and CPU time are limited with setrlimit, which anything it starts inherits, and the child is
+# put in its own process group so that it and any converters it started are killed together when the wall-clock timeout passes.
+# os.fork is used directly rather than multiprocessing as prefork pool workers are daemonic and may not start processes.
+
+
+class SandboxError(Exception):
+    '''
+        The sandboxed function raised, ran out of memory or CPU time, or was killed
+    '''
+
+
+class SandboxTimeout(SandboxError):
+    '''
+        The sandboxed function did not finish before its wall-clock timeout
+    '''
+
+
+def apply_limits(memory_limit=None, cpu_limit=None):
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if cpu_limit:
+        # SIGXCPU is sent at the soft limit, the kernel kills the process outright a little after at the hard limit
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+
+def kill_group(pid: int):
+    for kill in (lambda: os.killpg(pid, signal.SIGKILL), lambda: os.kill(pid, signal.SIGKILL)):
+        try:
+            kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+def describe_exit(status: int) -> str:
+    if os.WIFSIGNALED(status):
+        number = os.WTERMSIG(status)
+        reasons = {signal.SIGKILL: "killed, most likely for passing its memory or CPU limit", signal.SIGXCPU: "stopped for passing its CPU limit", signal.SIGSEGV: "crashed"}
+        return f"the sandboxed process was {reasons.get(number, 'killed')} (signal {number})"
+    return f"the sandboxed process exited with code {os.WEXITSTATUS(status)}"
+
+
+def run_limited(function, *args, memory_limit=None, cpu_limit=None, timeout=None):
+    '''
+        Runs function(*args) in a forked child process limited to memory_limit bytes of address space and cpu_limit seconds of CPU time,
+        the child (and anything it started) is killed if it is still running after timeout seconds.\n
+        The function should only work with files, its return value is sent back as JSON.\n
+        returns: what the function returned, raises SandboxError (or SandboxTimeout) if it did not finish
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child, never returns. os._exit skips the parent's exit handlers and leaves its database connections alone
+        exit_code = 1
+        try:
+            os.close(read_fd)
+            os.setpgid(0, 0)
+            apply_limits(memory_limit, cpu_limit)
+            try:
+                message = {"result": function(*args)}
+                exit_code = 0
+            except MemoryError:
+                message = {"error": "ran out of memory"}
+            except BaseException as e:
+                message = {"error": f"{type(e).__name__}: {e}"}
+            with os.fdopen(write_fd, "w") as pipe:
+                json.dump(message, pipe)
+        finally:
+            os._exit(exit_code)
+
+    os.close(write_fd)
+    try:
+        os.setpgid(pid, pid) # also set here in case the child has not got to it yet
+    except (ProcessLookupError, PermissionError):
+        pass
+
+    deadline = time.monotonic() + timeout if timeout else None
+    output = b""
+    try:
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise SandboxTimeout(f"the sandboxed process did not finish within {timeout} seconds")
+            ready, _, _ = select.select([read_fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            output += chunk
+    finally:
+        os.close(read_fd)
+        # Also clears up any converters the child left running
+        kill_group(pid)
+        pid, status = os.waitpid(pid, 0)
+
+    try:
+        message = json.loads(output) if output else {}
+    except ValueError:
+        message = {}
+    if "result" in message:
+        return message["result"]
+    raise SandboxError(message.get("error") or describe_exit(status))
@@ -0,0 +1,157 @@
+from __future__ import annotations
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from filehost.models import UploadedFile, ArchiveSegment, ArchiveSegmentEntry
+from filehost import nas
+from typing import TYPE_CHECKING
+import hashlib, os, secrets
+
+if TYPE_CHECKING:
+    import paramiko
+
+# Small archived files are packed into append-only segment files on the NAS rather than being stored as one file each.
+# The offset, length and checksum of each packed file is kept in the ArchiveSegmentEntry index so that it can be read back
+# with a single ranged read. Segments are sealed once they reach NAS_SEGMENT_TARGET_SIZE and are compacted once enough of
+# their contents belongs to files that have since been localised or deleted.
+
+# Segment settings, see LFS/settings.py
+NAS_SEGMENT_PACKING = settings.NAS_SEGMENT_PACKING
+NAS_SEGMENT_MAX_FILE_SIZE = settings.NAS_SEGMENT_MAX_FILE_SIZE
+NAS_SEGMENT_TARGET_SIZE = settings.NAS_SEGMENT_TARGET_SIZE
+NAS_SEGMENT_COMPACT_RATIO = settings.NAS_SEGMENT_COMPACT_RATIO
+
+SEGMENT_DIRECTORY = "SEGMENTS"
+
+
+def segment_path(segment: ArchiveSegment) -> str:
+    return os.path.join(nas.NAS_PATH, SEGMENT_DIRECTORY, f"{segment.name}.seg")
+
+def should_pack(local_path: str) -> bool:
+    return NAS_SEGMENT_PACKING and os.path.getsize(local_path) <= NAS_SEGMENT_MAX_FILE_SIZE
+
+def entry_for(uploaded_file: UploadedFile):
+    return ArchiveSegmentEntry.objects.filter(slug=uploaded_file.slug).select_related('segment').first()
+
+def append_bytes(sftp: paramiko.SFTPClient, data: bytes):
+    '''
+        Appends data to an open segment, the segment row is locked while writing so concurrent archive workers each append to a different segment.\n
+        Must be called inside a transaction that also records the returned location in the index.\n
+        returns: the segment and offset the data was written at
+    '''
+    segment = ArchiveSegment.objects.select_for_update(skip_locked=True).filter(sealed=False).order_by('pk').first()
+    if segment is None:
+        segment_directory = os.path.join(nas.NAS_PATH, SEGMENT_DIRECTORY)
+        if not nas.remote_exists(sftp, segment_directory):
+            sftp.mkdir(segment_directory)
+        segment = ArchiveSegment.objects.create(name=f"{timezone.now():%Y%m%d%H%M%S}-{secrets.token_hex(4)}")
+
+    remote_path = segment_path(segment)
+    # Segments are only ever written past their recorded size, anything past that was left by an append that was interrupted
+    # before it was recorded in the index and is simply overwritten
+    with sftp.open(remote_path, 'r+' if segment.size > 0 else 'w') as remote_file:
+        remote_file.seek(segment.size)
+        remote_file.write(data)
+    if sftp.stat(remote_path).st_size < segment.size + len(data):
+        raise IOError(f"Appending to segment {segment} failed, the segment is shorter than expected!")
+
+    offset = segment.size
+    segment.size += len(data)
+    if segment.size >= NAS_SEGMENT_TARGET_SIZE:
+        segment.sealed = True
+    segment.save()
+    return segment, offset
+
+def read_entry(sftp: paramiko.SFTPClient, entry: ArchiveSegmentEntry) -> bytes:
+    '''
+        Reads a packed file's bytes with a single ranged read and verifies them against the index
+    '''
+    with sftp.open(segment_path(entry.segment), 'rb') as remote_file:
+        remote_file.seek(entry.offset)
+        data = remote_file.read(entry.length)
+    if len(data) != entry.length or hashlib.sha256(data).hexdigest() != entry.checksum:
+        raise IOError(f"Packed file {entry} failed verification, the bytes read do not match the index!")
+    return data
+
+def pack_file(sftp: paramiko.SFTPClient, uploaded_file: UploadedFile, local_path: str) -> ArchiveSegmentEntry:
+    '''
+        Packs a small local file into a segment, compressing it first if the uploaded file's codec says so.\n
+        A file that was already packed by an archive interrupted before the local copy was removed keeps its entry if the packed
+        bytes still match, otherwise the stale entry is released and the file is packed again
+    '''
+    with open(local_path, 'rb') as local_file:
+        data = local_file.read()
+    if uploaded_file.compression == UploadedFile.Compression.ZSTD:
+        import zstandard
+        data = zstandard.ZstdCompressor(level=nas.NAS_COMPRESSION_LEVEL, write_checksum=True).compress(data)
+    checksum = hashlib.sha256(data).hexdigest()
+
+    entry = entry_for(uploaded_file)
+    if entry is not None and entry.length == len(data) and entry.checksum == checksum:
+        try:
+            read_entry(sftp, entry)
+            return entry
+        except IOError:
+            pass
+    with transaction.atomic():
+        if entry is not None:
+            ArchiveSegmentEntry.release(uploaded_file.slug)
+        segment, offset = append_bytes(sftp, data)
+        return ArchiveSegmentEntry.objects.create(slug=uploaded_file.slug, segment=segment, offset=offset, length=len(data), checksum=checksum)
+
+def read_file(sftp: paramiko.SFTPClient, uploaded_file: UploadedFile, entry: ArchiveSegmentEntry) -> bytes:
+    '''
+        Reads a packed file's original contents, decompressing them if the uploaded file's codec says so
+    '''
+    data = read_entry(sftp, entry)
+    if uploaded_file.compression == UploadedFile.Compression.ZSTD:
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+def unpack_file(sftp: paramiko.SFTPClient, uploaded_file: UploadedFile, entry: ArchiveSegmentEntry, local_path: str) -> int:
+    '''
+        Restores a packed file to local_path, it is written to a .part file first so a partial file is never left at local_path
+    '''
+    data = read_file(sftp, uploaded_file, entry)
+    part_path = f"{local_path}.part"
+    try:
+        with open(part_path, 'wb') as local_file:
+            local_file.write(data)
+        os.replace(part_path, local_path)
+    finally:
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+    return len(data)
+
+def compact_segment(sftp: paramiko.SFTPClient, segment: ArchiveSegment) -> int:
+    '''
+        Moves the live entries of a segment into open segments then removes it from the NAS, returns the number of bytes reclaimed
+    '''
+    for slug in list(segment.entries.values_list('slug', flat=True)):
+        with transaction.atomic():
+            # Lock the entry so that it cannot be released while it is being moved
+            entry = ArchiveSegmentEntry.objects.select_for_update().filter(slug=slug, segment=segment).first()
+            if entry is None:
+                continue
+            data = read_entry(sftp, entry)
+            new_segment, offset = append_bytes(sftp, data)
+            entry.segment = new_segment
+            entry.offset = offset
+            entry.save()
+
+    if segment.entries.exists():
+        raise IOError(f"Segment {segment} still has live entries after compaction!")
+    try:
+        sftp.remove(segment_path(segment))
+    except FileNotFoundError:
+        pass
+    reclaimed = segment.dead_bytes
+    segment.delete()
+    return reclaimed
+
+def segments_to_compact():
+    '''
+        Sealed segments where enough of the contents is dead for compaction to be worth it
+    '''
+    return [segment for segment in ArchiveSegment.objects.filter(sealed=True, dead_bytes__gt=0) if segment.dead_bytes >= segment.size * NAS_SEGMENT_COMPACT_RATIO]
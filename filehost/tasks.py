@@ -1,162 +1,307 @@
-from celery import shared_task
-import paramiko, os, traceback
-from filehost.models import UploadedFile
+from celery import shared_task, group, chain
+import os, time, traceback
+from filehost.models import UploadedFile, ArchiveSegmentEntry, StoredFile
 from filehost.oembed import CACHED_OEMBED_DICT as OEMBED_CACHE
 from filehost.oembed import CACHE_AGE
+from filehost import negotiation, nas, segments, orphans, manifest, usage, bulk, changelist, deletion, metrics, thumbnails, waveforms, renditions
+from filehost.nas import NAS_HOST, NAS_SFTP_PORT, NAS_USERNAME, NAS_PATH, PRIVATE_KEY_PATH
+from django.db.models import Q
 from django.utils import timezone
 from django.conf import settings
-from stat import S_ISREG
-from LFS.settings import env_file as ENV_FILE
-import configparser, shutil
-from PIL import Image
-import ffmpeg
-import environ
+import secrets, shutil
+from datetime import datetime
 
-from preview_generator.manager import PreviewManager
+# Pillow and preview_generator (along with the builders and converters it loads) are imported inside the tasks that render
+# with them, so that importing this module to queue a task does not load the thumbnailing stack into web workers
 
-# Initialize environment variables
-env = environ.Env(DEBUG=(bool, False))
 
-# Load environment variables
-environ.Env.read_env(ENV_FILE)
+# Preview managers are built on first use in each worker process, building one loads every preview builder
+PREVIEW_MANAGERS = {}
 
-# # NAS connection details 
-# config = configparser.ConfigParser()
-# config.read_file(open(r'/usr/share/django/config/LFS/nas.cnf'))
+def preview_manager(cache_path='/tmp/cache/'):
+    if cache_path not in PREVIEW_MANAGERS:
+        from preview_generator.manager import PreviewManager
+        PREVIEW_MANAGERS[cache_path] = PreviewManager(cache_path, create_folder=True)
+    return PREVIEW_MANAGERS[cache_path]
 
-NAS_HOST = env('NAS_HOST')
-NAS_SFTP_PORT = env('NAS_SFTP_PORT')
-NAS_USERNAME = env('NAS_USERNAME')
-NAS_PATH = env('NAS_PATH')
-PRIVATE_KEY_PATH = env('NAS_PRIVATE_KEY_PATH')
 
-
-def print_error_info(e: Exception, transport: paramiko.Transport):
+def print_error_info(e: Exception):
     print(f"The following credentials were used:")
     print(f"NAS_HOST: {NAS_HOST}")
     print(f"NAS_SFTP_PORT: {NAS_SFTP_PORT}")
     print(f"NAS_USERNAME: {NAS_USERNAME}")
     print(f"NAS_PATH: {NAS_PATH}")
     print(f"PRIVATE_KEY_PATH: {PRIVATE_KEY_PATH}")
-    print(f"transport connection info:")
-    print(f"transport.is_alive: {transport.is_alive()}")
-    print(f"transport.is_active: {transport.is_active()}")
-    print(f"transport.is_authenticated: {transport.is_authenticated()}")
+    print(f"SFTP session pool info: {nas.pool.stats()}")
     traceback.print_exception(e, limit=5)
 
 
+def store_archived_copy(sftp, uploaded_file: UploadedFile, local_path: str):
+    """
+    Copies a local file to the NAS, small files are packed into a segment when segment packing is enabled
+    """
+    if segments.should_pack(local_path):
+        segments.pack_file(sftp, uploaded_file, local_path)
+    else:
+        archive_path = nas.archive_path(uploaded_file)
+        size = nas.put_file(sftp, local_path, archive_path, compression=uploaded_file.compression)
+        manifest.record_archived(os.path.relpath(archive_path, NAS_PATH), size)
+
+def archived_copy_exists(sftp, uploaded_file: UploadedFile) -> bool:
+    return segments.entry_for(uploaded_file) is not None or nas.remote_exists(sftp, nas.archive_path(uploaded_file))
+
+def restore_archived_copy(sftp, uploaded_file: UploadedFile, local_path: str):
+    """
+    Copies an archived file back from the NAS to local_path, packed files are read back with a single ranged read
+    """
+    entry = segments.entry_for(uploaded_file)
+    if entry is not None:
+        segments.unpack_file(sftp, uploaded_file, entry, local_path)
+    else:
+        nas.get_file(sftp, nas.archive_path(uploaded_file), local_path, compression=uploaded_file.compression)
+
+def iter_archived_copy(sftp, uploaded_file: UploadedFile):
+    """
+    Reads an archived file back from the NAS in order, yielding its original contents a block at a time.\n
+    Each block has been verified against the archive by the time the last one is yielded
+    """
+    entry = segments.entry_for(uploaded_file)
+    if entry is not None:
+        data = segments.read_file(sftp, uploaded_file, entry)
+        for offset in range(0, len(data), nas.TRANSFER_BLOCK_SIZE):
+            yield data[offset:offset + nas.TRANSFER_BLOCK_SIZE]
+    else:
+        yield from nas.iter_file(sftp, nas.archive_path(uploaded_file), compression=uploaded_file.compression)
+
+def remove_archived_copy(sftp, uploaded_file: UploadedFile):
+    """
+    Removes the archived copy of a file from the NAS, packed files have their bytes marked as dead for compaction to reclaim later
+    """
+    if not ArchiveSegmentEntry.release(uploaded_file.slug):
+        nas.remove_file(sftp, nas.archive_path(uploaded_file))
+        manifest.forget(StoredFile.Location.ARCHIVED, uploaded_file.slug)
+
+
+def archive_uploaded_file(sftp, uploaded_file: UploadedFile):
+    """
+    Moves a local uploaded file to the NAS archive and marks it as archived.\n
+    Files left moving by an interrupted archive are resumed, returns False if another worker is already moving the file
+    """
+    resuming = uploaded_file.state == UploadedFile.State.MOVING
+    if not uploaded_file.claim_moving():
+        print(f"Skipping archiving file: {uploaded_file}, it is already being moved by another worker")
+        return False
+
+    try:
+        # Check that the file exists/is a file if not raise FileNotFoundError
+        if os.path.isfile(uploaded_file.file.path):
+            # Record the codec before uploading so that an interrupted archive can still find the compressed copy when it is resumed
+            uploaded_file.compression = nas.choose_compression(uploaded_file, uploaded_file.file.path)
+            UploadedFile.objects.filter(slug=uploaded_file.slug).update(compression=uploaded_file.compression)
+            # Move the file to the nas and mark as acrhived
+            store_archived_copy(sftp, uploaded_file, uploaded_file.file.path)
+            uploaded_file.set_archived(years=1)
+            uploaded_file.file.delete()
+            negotiation.delete_image_variants(uploaded_file)
+            renditions.delete_renditions(uploaded_file)
+        elif resuming and archived_copy_exists(sftp, uploaded_file):
+            # The previous attempt moved the file to the nas and removed the local copy but was interrupted before marking it as archived
+            uploaded_file.set_archived(years=1)
+        else:
+            raise FileNotFoundError(f"Could not verify the file with path: {uploaded_file.file.path} exists or is a file!")
+    except Exception:
+        # Return the file to local so that it can be retried, unless the local copy is gone in which case it is left for the next resume
+        if os.path.isfile(uploaded_file.file.path):
+            uploaded_file.release_moving(UploadedFile.State.LOCAL)
+        raise
+    return True
+
+def localise_uploaded_file(sftp, uploaded_file: UploadedFile):
+    """
+    Moves an archived uploaded file from the NAS archive to local storage and marks it as local.\n
+    Archived files are claimed first, files that are already moving must have been claimed by the caller.\n
+    returns: False if another worker claimed the file first
+    """
+    if uploaded_file.state == UploadedFile.State.ARCHIVED and not uploaded_file.claim_moving():
+        print(f"Skipping localising file: {uploaded_file}, it is already being moved by another worker")
+        return False
+
+    # Establish file paths
+    local_path = os.path.join(settings.MEDIA_ROOT, uploaded_file.file_path)
+
+    # Retrive the file from the nas and move to local system while ensuring required variables are set to expected values
+    try:
+        restore_archived_copy(sftp, uploaded_file, local_path)
+    except Exception:
+        # Give up the claim so that the file can be de-archived by the next request
+        uploaded_file.release_moving(UploadedFile.State.ARCHIVED)
+        raise
+    mark_localised(sftp, uploaded_file)
+    return True
+
+def mark_localised(sftp, uploaded_file: UploadedFile):
+    """
+    Marks a file whose archived copy has been restored to its local path as local, then removes the archived copy
+    """
+    archived = UploadedFile(slug=uploaded_file.slug, file_path=uploaded_file.file_path, compression=uploaded_file.compression)
+    uploaded_file.file.name = uploaded_file.file_path
+    uploaded_file.state = UploadedFile.State.LOCAL
+    uploaded_file.compression = UploadedFile.Compression.NONE
+    uploaded_file.set_expiration(months=6)
+    uploaded_file.save()
+
+    # Remove the file from the nas once we have got it on the local system and set all the required variables
+    remove_archived_copy(sftp, archived)
+
+
+def delete_expired_archived_file(sftp, uploaded_file: UploadedFile):
+    """
+    Marks an expired archived file for deletion, the reaper queued at the end of the batch removes it from the NAS along with its thumbnail and the model
+    """
+    return deletion.mark_for_deletion([uploaded_file.slug], reap=False) == 1
+
+def expire_uploaded_file(sftp, uploaded_file: UploadedFile):
+    """
+    Archives or deletes a single expired file depending on its state
+    """
+    match uploaded_file.state:
+        # file is stored locally (or was interrupted while being archived) and has expired and will now be archived
+        case UploadedFile.State.LOCAL | UploadedFile.State.MOVING:
+            return archive_uploaded_file(sftp, uploaded_file)
+        # file is stored on the nas archive and has expired, delete the file then delete the model
+        case UploadedFile.State.ARCHIVED:
+            return delete_expired_archived_file(sftp, uploaded_file)
+
+
+def expired_files_queryset():
+    """
+    Files that have expired and still need work done, files that are currently moving are left alone unless they have been moving for so long that they must have been interrupted
+    """
+    stale_moving = timezone.now() - timezone.timedelta(seconds=settings.EXPIRY_STALE_MOVING_AFTER)
+    return UploadedFile.objects.filter(persistent=False, expiration_date__lte=timezone.localdate()).filter(
+        Q(state__in=[UploadedFile.State.LOCAL, UploadedFile.State.ARCHIVED])
+        | Q(state=UploadedFile.State.MOVING, moving_since__lte=stale_moving)
+        | Q(state=UploadedFile.State.MOVING, moving_since__isnull=True)
+    )
+
 @shared_task
 def expire_files():
     """
-    Task to periodically expire files and move them to the NAS archive if they have reached their expiration_date
+    Task to periodically expire files and move them to the NAS archive if they have reached their expiration_date.\n
+    The expired slugs are streamed in chunks and fanned out to expire_file_batch sub-tasks, the chunks are split into
+    EXPIRY_MAX_CONCURRENT_BATCHES chains so that no more than that many batches run at once and one stuck batch only holds up its own chain
     """
-    transport = None
+    try:
+        lanes = [[] for i in range(settings.EXPIRY_MAX_CONCURRENT_BATCHES)]
+        batch = []
+        batch_count = 0
+        file_count = 0
+
+        slugs = expired_files_queryset().order_by().values_list('slug', flat=True)
+        for slug in slugs.iterator(chunk_size=settings.EXPIRY_CHUNK_SIZE):
+            batch.append(slug)
+            file_count += 1
+            if len(batch) >= settings.EXPIRY_CHUNK_SIZE:
+                lanes[batch_count % len(lanes)].append(expire_file_batch.si(batch))
+                batch_count += 1
+                batch = []
+        if batch:
+            lanes[batch_count % len(lanes)].append(expire_file_batch.si(batch))
+            batch_count += 1
+
+        if batch_count > 0:
+            group(chain(*lane) for lane in lanes if lane).apply_async()
+        print(f"Expiring {file_count} files in {batch_count} batches")
+        return {"files": file_count, "batches": batch_count}
+    except Exception as e:
+        # Print Helpful debug messages
+        print(f"Expiring files has failed: {e}")
+        print_error_info(e)
+        return False
+
+@shared_task(bind=True)
+def expire_file_batch(self, slugs):
+    """
+    Task to archive or delete a batch of expired files, each file's transition is claimed atomically so re-running a batch only does unfinished work
+    """
+    counts = {"total": len(slugs), "done": 0, "skipped": 0, "failed": 0}
     try:
         # exception counter for for loop so that an exception does not stop all files from being processed, but only stops that current file
         exception_counter = 0
 
-        # Connect to NAS via SFTP
-        transport = paramiko.Transport((NAS_HOST, NAS_SFTP_PORT))
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-        transport.connect(username=NAS_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-
-        # Fetch list of expired files that are not persistent
-        expired_files = UploadedFile.objects.filter(persistent=False).filter(expiration_date__lte=timezone.now())
-
-        for uploaded_file in expired_files:
-            match uploaded_file.state:
-
-                # file is stored locally and has expired and will now be archived
-                case UploadedFile.State.LOCAL:
-                    try:
-                        uploaded_file.set_moving()
-                        nas_file_path = os.path.join(NAS_PATH, uploaded_file.file_path)
-
-                        # Check that the file exists/is a file if not raise FileNotFoundError
-                        if os.path.isfile(uploaded_file.file.path):
-                            # Move the file to the nas and mark as acrhived
-                            sftp.put(uploaded_file.file.path, nas_file_path)
-                            uploaded_file.set_archived(years=1)
-                            uploaded_file.file.delete()
-                        else:
-                            raise FileNotFoundError(f"Could not verify the file with path: {uploaded_file.file.path} exists or is a file!")
-                    except Exception as local_e:
-                        exception_counter+=1
-                        print(f"Failed to archive local expired file: {uploaded_file} with local path: {uploaded_file.file.path}. Error: {local_e}")
-                        traceback.print_exception(local_e, limit=3)
-                        continue
-
-                # file is stored on the nas archive and has expired, delete the file then delete the model
-                case UploadedFile.State.ARCHIVED:
-                    try:
-                        # Get the file on the nas archive and delete both the file and the model
-                        nas_file_path = os.path.join(NAS_PATH, uploaded_file.file_path)
-                        sftp.remove(nas_file_path)
-                        if uploaded_file.thumbnail and os.path.isfile(uploaded_file.thumbnail):
-                            uploaded_file.thumbnail.delete()
-                        uploaded_file.delete()
-                    except Exception as archived_e:
-                        exception_counter+=1
-                        print(f"Failed to delete archived expired file: {uploaded_file} with remote path: {nas_file_path}. Error: {archived_e}")
-                        traceback.print_exception(archived_e, limit=3)
-                        continue
-
-        # Close the SFTP connection to the NAS
-        sftp.close()
-        transport.close()
+        # Re-check expiry so that files which were finished or changed since the batch was queued are not touched again
+        expired_files = expired_files_queryset().filter(slug__in=slugs)
+        # Progress is recorded from the transfer threads which do not have the task request context, so the task id is captured here
+        task_id = self.request.id
+
+        def record_progress(uploaded_file, result, expire_e, elapsed):
+            if expire_e is not None:
+                counts["failed"] += 1
+            elif result:
+                counts["done"] += 1
+            else:
+                counts["skipped"] += 1
+            if task_id is not None:
+                self.update_state(task_id=task_id, state="PROGRESS", meta=counts)
+
+        for uploaded_file, result, expire_e, elapsed in nas.run_transfers(expired_files, expire_uploaded_file, callback=record_progress):
+            if expire_e is not None:
+                exception_counter+=1
+                print(f"Failed to expire file: {uploaded_file} with path: {uploaded_file.file_path}. Error: {expire_e}")
+                traceback.print_exception(expire_e, limit=3)
+            elif result:
+                print(f"Expired file: {uploaded_file} in {elapsed:.3f}s")
+        # Files that were finished or claimed elsewhere since the batch was queued are counted as skipped
+        counts["skipped"] += counts["total"] - (counts["done"] + counts["skipped"] + counts["failed"])
+        # Expired archived files are only marked for deletion, reap them all together
+        if counts["done"] > 0:
+            reap_deleted_files.delay()
 
         if exception_counter >= 1:
             raise Exception(f"Multiple exceptions ({exception_counter}) were encountered while archiving/deleting expired files, Please review logs for more info")
 
-        return True
+        return counts
     except Exception as e:
-        # Print Helpful debug messages
-        print(f"Expiring files has failed: {e}")
-        print_error_info(e, transport)
-        return False
+        # Print Helpful debug messages, the batch is not re-raised so that the rest of its chain still runs
+        print(f"Expiring batch of files has failed: {e}")
+        print_error_info(e)
+        return counts
     
+@shared_task(bind=True)
+def bulk_update_files(self, slugs, action, params=None):
+    """
+    Task to apply a bulk admin action to a large selection of files, progress is reported after each chunk is updated
+    """
+    counts = {"action": action, "total": len(slugs), "done": 0, "updated": 0}
+    task_id = self.request.id
+
+    def record_progress(done, total):
+        counts["done"] = done
+        if task_id is not None:
+            self.update_state(task_id=task_id, state="PROGRESS", meta=counts)
+
+    counts["updated"] = bulk.apply(slugs, action, params, progress=record_progress)
+    print(f"Applied bulk action: {action} to {counts['updated']} of {counts['total']} files")
+    return counts
+
 @shared_task
 def archive_files(slugs):
     """
     Task to forcfully archive files and move them to the NAS archive
     """
-    transport = None
     try:
         # exception counter for for loop so that an exception does not stop all files from being processed, but only stops that current file
         exception_counter = 0
 
-        # Connect to NAS via SFTP
-        transport = paramiko.Transport((NAS_HOST, NAS_SFTP_PORT))
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-        transport.connect(username=NAS_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-
-        for slug in slugs:
-            uploaded_file = UploadedFile.objects.get(slug=slug)
-
-            if uploaded_file.state == UploadedFile.State.LOCAL:
-                    uploaded_file.set_moving()
-                    try:
-                        nas_file_path = os.path.join(NAS_PATH, uploaded_file.file_path)
-
-                        # Check that the file exists/is a file if not raise FileNotFoundError
-                        if os.path.isfile(uploaded_file.file.path):
-                            # Move the file to the nas and mark as acrhived
-                            sftp.put(uploaded_file.file.path, nas_file_path)
-                            uploaded_file.set_archived(years=1)
-                            uploaded_file.file.delete()
-                        else:
-                            raise FileNotFoundError(f"Could not verify the file with path: {uploaded_file.file.path} exists or is a file!")
-                    except Exception as local_e:
-                        exception_counter+=1
-                        print(f"Failed to archive local file: {uploaded_file} with local path: {uploaded_file.file.path}. Error: {local_e}")
-                        traceback.print_exception(local_e, limit=3)
-                        continue
-
-        # Close the SFTP connection to the NAS
-        sftp.close()
-        transport.close()
+        local_files = UploadedFile.objects.filter(slug__in=slugs, state=UploadedFile.State.LOCAL)
+        for uploaded_file, result, local_e, elapsed in nas.run_transfers(local_files, archive_uploaded_file):
+            if local_e is not None:
+                exception_counter+=1
+                print(f"Failed to archive local file: {uploaded_file} with local path: {uploaded_file.file.path}. Error: {local_e}")
+                traceback.print_exception(local_e, limit=3)
+                continue
+            if result:
+                print(f"Archived file: {uploaded_file} in {elapsed:.3f}s")
 
         if exception_counter >= 1:
             raise Exception(f"Multiple exceptions ({exception_counter}) were encountered while archiving/deleting expired files, Please review logs for more info")
@@ -165,7 +310,7 @@ def archive_files(slugs):
     except Exception as e:
         # Print Helpful debug messages
         print(f"Forcefully Archiving files has failed: {e}")
-        print_error_info(e, transport)
+        print_error_info(e)
         return False
 
 @shared_task
@@ -173,45 +318,18 @@ def localise_files(slugs):
     """
     Task to forcfully dearchive files and move them to local storage
     """
-    transport = None
     try:
         # exception counter for for loop so that an exception does not stop all files from being processed, but only stops that current file
         exception_counter = 0
 
-        # Connect to NAS via SFTP
-        transport = paramiko.Transport((NAS_HOST, NAS_SFTP_PORT))
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-        transport.connect(username=NAS_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-
-        for slug in slugs:
-            uploaded_file = UploadedFile.objects.get(slug=slug)
-
-            if uploaded_file.state == UploadedFile.State.ARCHIVED:
-                    try:
-                        uploaded_file.set_moving()
-                        # Establish file paths
-                        archive_path = os.path.join(NAS_PATH, uploaded_file.file_path)
-                        local_path = os.path.join(settings.MEDIA_ROOT, uploaded_file.file_path)
-                        
-                        # Retrive the file from the nas and move to local system while ensuring required variables are set to expected values
-                        sftp.get(archive_path, local_path)
-                        uploaded_file.file.name = uploaded_file.file_path
-                        uploaded_file.state = UploadedFile.State.LOCAL
-                        uploaded_file.set_expiration(months=6)
-                        uploaded_file.save()
-
-                        # Remove the file from the nas once we have got it on the local system and set all the required variables
-                        sftp.remove(archive_path)
-                    except Exception as local_e:
-                        exception_counter+=1
-                        print(f"Failed to localise archived file: {uploaded_file}. Error: {local_e}")
-                        traceback.print_exception(local_e, limit=3)
-                        continue
-
-        # Close the SFTP connection to the NAS
-        sftp.close()
-        transport.close()
+        archived_files = UploadedFile.objects.filter(slug__in=slugs, state=UploadedFile.State.ARCHIVED)
+        for uploaded_file, result, local_e, elapsed in nas.run_transfers(archived_files, localise_uploaded_file):
+            if local_e is not None:
+                exception_counter+=1
+                print(f"Failed to localise archived file: {uploaded_file}. Error: {local_e}")
+                traceback.print_exception(local_e, limit=3)
+                continue
+            print(f"Localised file: {uploaded_file} in {elapsed:.3f}s")
 
         if exception_counter >= 1:
             raise Exception(f"Multiple exceptions ({exception_counter}) were encountered while archiving/deleting expired files, Please review logs for more info")
@@ -220,47 +338,30 @@ def localise_files(slugs):
     except Exception as e:
         # Print Helpful debug messages
         print(f"Forcefully Localising files has failed: {e}")
-        print_error_info(e, transport)
+        print_error_info(e)
         return False
 
 @shared_task
-def localise_file(slug: str): 
+def localise_file(slug: str, claimed_at: str = None): 
     """
-    Task to dearchive a file and move it from the NAS Archive to local storage
+    Task to dearchive a file and move it from the NAS Archive to local storage.\n
+    claimed_at is the moving_since of the claim made by UploadedFile.request_localisation, the task takes over that claim
     """
-    transport = None
     try:
         #UploadedFile to retrive from the nas archive
         uploaded_file = UploadedFile.objects.get(slug=slug)
 
-        # Check the file is actually Archived and not already being moved
-        if uploaded_file.state == UploadedFile.State.ARCHIVED:
-            uploaded_file.set_moving()
-            # Connect to NAS via SFTP
-            transport = paramiko.Transport((NAS_HOST, NAS_SFTP_PORT))
-            private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-            transport.connect(username=NAS_USERNAME, pkey=private_key)
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            
-            # Establish file paths
-            archive_path = os.path.join(NAS_PATH, uploaded_file.file_path)
-            local_path = os.path.join(settings.MEDIA_ROOT, uploaded_file.file_path)
-            
-            # Retrive the file from the nas and move to local system while ensuring required variables are set to expected values
-            sftp.get(archive_path, local_path)
-            uploaded_file.file.name = uploaded_file.file_path
-            uploaded_file.state = UploadedFile.State.LOCAL
-            uploaded_file.set_expiration(months=6)
-            uploaded_file.save()
-
-            # Remove the file from the nas once we have got it on the local system and set all the required variables
-            sftp.remove(archive_path)
-
-
-            # Close the SFTP connection
-            sftp.close()
-            transport.close()
-
+        # Only take over a moving file if it is still the claim that queued this task, otherwise someone else is moving it
+        if uploaded_file.state == UploadedFile.State.MOVING and (claimed_at is None or uploaded_file.moving_since != datetime.fromisoformat(claimed_at)):
+            print(f"Skipping localising file: {uploaded_file}, it is already being moved by another worker")
+            return False
+
+        # Check the file is actually Archived or claimed for us
+        if uploaded_file.state in (UploadedFile.State.ARCHIVED, UploadedFile.State.MOVING):
+            start = time.perf_counter()
+            if not nas.pool.run(lambda sftp: localise_uploaded_file(sftp, uploaded_file)):
+                return False
+            print(f"Localised file: {uploaded_file} in {time.perf_counter() - start:.3f}s")
             return True
 
         elif uploaded_file.state == UploadedFile.State.LOCAL:
@@ -269,111 +370,106 @@ def localise_file(slug: str):
     except Exception as e:
         # Print Helpful debug messages
         print(f"Dearchiving file: {slug} has failed: {e}")
-        print_error_info(e, transport)
+        print_error_info(e)
         return False
 
 @shared_task
 def delete_archived_file(slug: str):
     """
-    Task to delete an archived file
+    Task to delete an archived file, the file is marked for deletion and removed from the NAS by the reaper
     """
-    transport = None
-    try:
-        #UploadedFile to retrive from the nas archive
-        uploaded_file = UploadedFile.objects.get(slug=slug)
+    return deletion.mark_for_deletion([slug]) == 1
 
-        # Check the file is actually Archived
-        if uploaded_file.state == UploadedFile.State.ARCHIVED:
-            uploaded_file.set_moving()
-            # Connect to NAS via SFTP
-            transport = paramiko.Transport((NAS_HOST, NAS_SFTP_PORT))
-            private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-            transport.connect(username=NAS_USERNAME, pkey=private_key)
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            
-            # Establish file paths
-            archive_path = os.path.join(NAS_PATH, uploaded_file.file_path)
-
-            # Get the file on the nas archive and delete the file
-            sftp.remove(archive_path)
-
-            # Close the SFTP connection
-            sftp.close()
-            transport.close()
-
-            # Make sure that the instance itself ahs actually been deleted
-            if UploadedFile.objects.filter(slug=uploaded_file.slug).count() > 0:
-                uploaded_file.delete()
+@shared_task
+def reap_deleted_files():
+    """
+    Task to remove the stored files of everything pending deletion in batches, then delete their models
+    """
+    try:
+        report = deletion.reap()
+        print(f"Reaped deleted files: {report}")
+        return report
+    except Exception as e:
+        # Print Helpful debug messages
+        print(f"Reaping deleted files has failed: {e}")
+        print_error_info(e)
+        return False
 
-            return True
+@shared_task
+def remove_archived_files(archived):
+    """
+    Task to remove archived copies left behind by models that were deleted directly, archived is a list of (slug, path on the NAS)
+    """
+    def remove_all(sftp):
+        for slug, remote_path in archived:
+            try:
+                nas.remove_file(sftp, remote_path)
+            except FileNotFoundError:
+                pass
+            manifest.forget(StoredFile.Location.ARCHIVED, slug)
 
-        elif uploaded_file.state == UploadedFile.State.LOCAL:
-            raise TypeError(f"Could not delete local file: {uploaded_file}, as it is not archived!")
-        
+    try:
+        nas.pool.run(remove_all)
+        return True
     except Exception as e:
-        # Print Helpful debug messages
-        print(f"Deleting archived file: {slug} has failed: {e}")
-        print_error_info(e, transport)
+        # Print Helpful debug messages, anything left behind is picked up by the orphaned file cleanup
+        print(f"Removing {len(archived)} archived files has failed: {e}")
+        print_error_info(e)
         return False
     
     
 @shared_task
-def cleanup_orphaned_files_local():
-    """
-    Task to make sure that we remove files from local storage that no longer have an UploadedFile instance related to them for various reasons
-    """
-    # search through the upload_type directories in the media root to find all files
-    for upload_type in UploadedFile.UploadType.TYPES:
-        for dirpath, dirs, files in os.walk(settings.MEDIA_ROOT, upload_type):
-            for name in files:
-                # extract slug from file and check to see whether it matches an uploaded file
-                slug = name.split('.')[0]
-                if UploadedFile.objects.filter(slug=slug).count() > 0:
-                    continue
-                else:
-                    # if the file doesn't match any uploaded files then we log the path and delete the file
-                    full_path = os.path.join(dirpath, name)
-                    print (f"Cleaning up orphaned local file: {full_path}")
-                    os.remove(full_path)
+def cleanup_orphaned_files_local(dry_run=False, full_scan=False):
+    """
+    Task to make sure that we remove files from local storage that no longer have an UploadedFile instance related to them for various reasons.\n
+    Orphans are found from the reconciled storage manifest unless full_scan is set. With dry_run the orphans are only reported, returns the report
+    """
+    report = orphans.OrphanReport("local", dry_run=dry_run)
+    if full_scan:
+        # load every known slug once and diff it against a single listing of each upload directory in the media root
+        found = orphans.scan_local(orphans.SlugIndex.load(), report)
+    else:
+        manifest.reconcile_local()
+        found = orphans.scan_manifest(StoredFile.Location.LOCAL, settings.MEDIA_ROOT, report)
+    orphans.remove_in_batches(found, orphans.remove_local_batch, report)
+    print(f"Orphaned local file cleanup: {report.as_dict()}")
+    return report.as_dict()
 
 @shared_task
-def cleanup_orpahaned_files_archived():
+def cleanup_orpahaned_files_archived(dry_run=False, full_scan=False):
     """
-    Task to make sure that we remove files from the NAS archive that no longer have an UploadedFile instance related to them for various reasons
+    Task to make sure that we remove files from the NAS archive that no longer have an UploadedFile instance related to them for various reasons.\n
+    Orphans are found from the reconciled storage manifest unless full_scan is set. With dry_run the orphans are only reported, returns the report or False if the cleanup failed
     """
-    transport = None
     try:
-        # Connect to NAS via SFTP
-        transport = paramiko.Transport((NAS_HOST, NAS_SFTP_PORT))
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-        transport.connect(username=NAS_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-        
-        for upload_type in UploadedFile.UploadType.TYPES:
-            for file_type in UploadedFile.FileType.TYPES:
-                for entry in sftp.listdir_attr(NAS_PATH + upload_type + "/" + file_type):
-                    mode = entry.st_mode
-                    if S_ISREG(mode):
-                        # extract slug from file and check to see whether it matches an uploaded file
-                        slug = entry.filename.split('.')[0]
-                        if UploadedFile.objects.filter(slug=slug).count() > 0:
-                            continue
-                        else:
-                            # if the file doesn't match any uploaded files then we log the path and delete the file
-                            full_path = NAS_PATH + upload_type + "/" + file_type + "/" + entry.filename
-                            print (f"Cleaning up orphaned archived file: {full_path}")
-                            sftp.remove(full_path)
-
-        # Close the SFTP connection
-        sftp.close()
-        transport.close()
-
-        return True
+        report = orphans.OrphanReport("archived", dry_run=dry_run)
+
+        def remove_batch(paths):
+            # Removals are spread over several pooled sessions as each one is a round trip to the NAS
+            results = nas.run_transfers(paths, lambda sftp, path: sftp.remove(path))
+            return len([error for path, result, error, elapsed in results if error is None or isinstance(error, FileNotFoundError)])
+
+        with nas.sftp_session() as sftp:
+            if full_scan:
+                found = orphans.scan_archive(sftp, NAS_PATH, orphans.SlugIndex.load(), report)
+            else:
+                manifest.reconcile_archive(sftp, NAS_PATH)
+                found = orphans.scan_manifest(StoredFile.Location.ARCHIVED, NAS_PATH, report)
+            orphans.remove_in_batches(found, remove_batch, report)
+
+        # Packed files live inside segments, so orphans are entries in the segment index that no longer have an uploaded file
+        for slug, length in ArchiveSegmentEntry.objects.exclude(slug__in=UploadedFile.objects.values('slug')).values_list('slug', 'length'):
+            report.add(f"{segments.SEGMENT_DIRECTORY}/{slug}", length)
+            if not dry_run and ArchiveSegmentEntry.release(slug):
+                report.removed += 1
+
+        print(f"Orphaned archived file cleanup: {report.as_dict()}")
+        return report.as_dict()
                 
     except Exception as e:
         # Print Helpful debug messages
         print(f"Cleaning up orphaned archived files has failed: {e}")
-        print_error_info(e, transport)
+        print_error_info(e)
         return False
     
 @shared_task
@@ -383,27 +479,94 @@ def cleanup_orphaned_files_async():
     """
     cleanup_orphaned_files_local.delay()
     cleanup_orpahaned_files_archived.delay()
+
+@shared_task
+def reconcile_storage_manifest(force=False):
+    """
+    Task to bring the storage manifest up to date with local media and the NAS, only directories that have changed are listed unless force is set
+    """
+    try:
+        local_report = manifest.reconcile_local(force=force)
+        print(f"Reconciled local storage manifest: {local_report}")
+        with nas.sftp_session() as sftp:
+            archive_report = manifest.reconcile_archive(sftp, NAS_PATH, force=force)
+        print(f"Reconciled archived storage manifest: {archive_report}")
+        return {"local": local_report, "archived": archive_report}
+    except Exception as e:
+        # Print Helpful debug messages
+        print(f"Reconciling the storage manifest has failed: {e}")
+        print_error_info(e)
+        return False
+
+@shared_task
+def scrub_local_files(limit=manifest.SCRUB_BATCH_SIZE):
+    """
+    Task to checksum the local files that have gone the longest without being checked and report any that have been corrupted
+    """
+    report = manifest.scrub_local(limit=limit)
+    print(f"Scrubbed local files: {report}")
+    return report
+
+@shared_task
+def recalculate_storage_usage():
+    """
+    Task to rebuild the storage usage counters from the uploaded files, this corrects any drift and backfills sizes recorded before counters existed
+    """
+    report = usage.recalculate()
+    print(f"Recalculated storage usage: {report}")
+    return report
+
+@shared_task
+def refresh_admin_facets():
+    """
+    Task to recount the mime types offered by the admin mime type filter
+    """
+    mime_types = changelist.refresh_mime_type_facets()
+    print(f"Refreshed admin facets: {mime_types} mime types")
+    return mime_types
+
+@shared_task
+def compact_archive_segments():
+    """
+    Task to compact sealed segments on the NAS once enough of their packed files have been localised or deleted
+    """
+    try:
+        # exception counter for for loop so that an exception does not stop all segments from being processed, but only stops that current segment
+        exception_counter = 0
+        for segment, reclaimed, compact_e, elapsed in nas.run_transfers(segments.segments_to_compact(), segments.compact_segment, max_workers=1):
+            if compact_e is not None:
+                exception_counter+=1
+                print(f"Failed to compact segment: {segment}. Error: {compact_e}")
+                traceback.print_exception(compact_e, limit=3)
+                continue
+            print(f"Compacted segment: {segment}, reclaimed {reclaimed} bytes in {elapsed:.3f}s")
+
+        if exception_counter >= 1:
+            raise Exception(f"Multiple exceptions ({exception_counter}) were encountered while compacting segments, Please review logs for more info")
+
+        return True
+    except Exception as e:
+        # Print Helpful debug messages
+        print(f"Compacting archive segments has failed: {e}")
+        print_error_info(e)
+        return False
     
 def test_sftp(debug=True):
-    transport = None
+    session = None
     try:
         if debug:
             print("Attempting sftp connection to NAS...")
-        # Connect to NAS via SFTP
-        transport = paramiko.Transport((NAS_HOST, NAS_SFTP_PORT))
-        private_key = paramiko.RSAKey(filename=PRIVATE_KEY_PATH)
-        transport.connect(username=NAS_USERNAME, pkey=private_key)
-        sftp = paramiko.SFTPClient.from_transport(transport)
+        # Open a fresh session rather than a pooled one so that the connection details are actually tested
+        session = nas.pool.connect()
 
         if debug:
             print("Connected, listing directories...")
-        sftp.listdir()
+        session.sftp.listdir()
         if debug:
             print("Success! Closing connection...")
         
         # Close the SFTP connection
-        sftp.close()
-        transport.close()
+        session.close()
         if debug:
             print("Connection closed, everything seems to work!")
 
@@ -412,7 +575,9 @@ def test_sftp(debug=True):
     except Exception as e:
         # Print Helpful debug messages
         print(f"Testing sftp connection has failed: {e}")
-        print_error_info(e, transport)
+        print_error_info(e)
+        if session is not None:
+            session.close()
         return False
 
 
@@ -429,9 +594,18 @@ def maintain_oembed_cache():
 
 
 @shared_task
-def create_thumbnail(slug: str, manager: PreviewManager = PreviewManager('/tmp/cache/', create_folder=True)):
+def create_thumbnail(slug: str, manager=None, timings=None):
+    """
+    Task to create the thumbnail of an uploaded file, each stage's time is recorded in the thumbnail stage metrics
+    and, when a timings dict is passed in, added to it by stage
+    """
     try:
+        if manager is None:
+            manager = preview_manager()
+        load_start = time.perf_counter()
         uploaded_file = UploadedFile.objects.get(slug=slug)
+        file_type = uploaded_file.file_type
+        metrics.record_thumbnail_stage("load", file_type, time.perf_counter() - load_start, timings)
         # Setup Thumbnail paths and get filename
         filename = os.path.basename(uploaded_file.file_path)
         uploaded_file.thumbnail_path = os.path.join(uploaded_file.upload_type, uploaded_file.file_type, "THUMBNAIL", filename)
@@ -445,73 +619,150 @@ def create_thumbnail(slug: str, manager: PreviewManager = PreviewManager('/tmp/c
 
         thumbnail_ext = ""
 
+        if uploaded_file.file_type == UploadedFile.FileType.AUDIO:
+            try:
+                print("extracting waveform in the sandbox...")
+                # The audio is decoded once, its peaks are kept for the waveform view and the thumbnail is a rendering of them
+                rendered_timings = waveforms.extract_sandboxed(absolute_file_path, waveforms.peaks_path(uploaded_file), f"{absolute_thumb_path}.png", thumbnails.THUMBNAIL_SIZE)
+                for stage, seconds in rendered_timings.items():
+                    metrics.record_thumbnail_stage(stage, file_type, seconds, timings)
+                print("created waveform!")
+                thumbnail_ext = "png"
+            except Exception as e:
+                print(f"Extracting the waveform for: {slug} has failed: {e}")
+                traceback.print_exception(e, limit=5)
+                # Remove anything the sandbox wrote before it failed
+                waveforms.delete_peaks(uploaded_file)
+                if os.path.exists(f"{absolute_thumb_path}.png"):
+                    os.remove(f"{absolute_thumb_path}.png")
+
         # If mime type is supported by the preview builder then we build a thumbnail preview of the file
-        if uploaded_file.mime_type in manager.get_supported_mimetypes():
+        elif uploaded_file.mime_type in manager.get_supported_mimetypes():
             print("mimetype is supported by preview builder!")
             try:
-                new_thumbnail_file_path = ""
-                
-                if uploaded_file.mime_type in UploadedFile.FileType.SUPPORTED_ARCHIVE_MIMETYPES:
-                    print("creating zip file preview...")
-                    # Create the archive text preview using preview generator
-                    archive_text_preview = manager.get_text_preview(file_path=absolute_file_path)
-                    print("created zip file text preview!")
-                    # Create a Jpeg of the text preview of the file
-                    new_thumbnail_file_path = manager.get_jpeg_preview(file_path=archive_text_preview, height=512, width=512)
-                    print("created zip file JPEG preview!")
-                else:
-                    print("creating standard JPEG preview...")      
-                    # Create the thumbnail using preview generator
-                    new_thumbnail_file_path = manager.get_jpeg_preview(file_path=absolute_file_path, height=512, width=512)
-                    print("created standard JPEG preview!")
-
-                print("Copying preview to new location...")
-                # Copy the new thumbnail to it's permanent location
+                print("creating JPEG preview in the sandbox...")
+                # Rendering decodes untrusted files so it runs in a child process with memory, CPU and time limits,
+                # the preview is copied to its permanent location and resized to 512x512 by the same process
+                rendered_timings = thumbnails.render_sandboxed(manager, uploaded_file.mime_type, absolute_file_path, f"{absolute_thumb_path}.jpeg")
+                for stage, seconds in rendered_timings.items():
+                    metrics.record_thumbnail_stage(stage, file_type, seconds, timings)
+                print("created JPEG preview!")
                 thumbnail_ext = "jpeg"
-                shutil.copy2(new_thumbnail_file_path, f"{absolute_thumb_path}.jpeg")
-                absolute_thumb_path = f"{absolute_thumb_path}.jpeg"
             except Exception as e:
                 print(f"Creating thumbnail for: {slug} has failed: {e}")
                 traceback.print_exception(e, limit=5)
-                print("error occurred during thumbnail generation, creating basic svg thumbnail...")
-                # An error occurred during preivew generation, we will generate a basic svg preview instead
+                # Remove anything the sandbox wrote before it failed
+                if os.path.exists(f"{absolute_thumb_path}.jpeg"):
+                    os.remove(f"{absolute_thumb_path}.jpeg")
+
+        else:
+            print("mimetype is not supported by preview generator, creating basic svg...")
+
+        if not thumbnail_ext:
+            print("no preview could be made, creating basic svg thumbnail...")
+            # We make a basic svg of the slug and mimetype instead
+            with metrics.thumbnail_stage("placeholder", file_type, timings):
                 svg = uploaded_file.generate_basic_svg_preview(filename)
                 # Write to an svg thumbnail file
                 thumbnail_ext = "svg"
                 with open(f"{absolute_thumb_path}.svg", 'w') as f:
                     f.write(svg)
                     f.close()
-                absolute_thumb_path = f"{absolute_thumb_path}.svg"
-
-        else:
-            print("mimetype is not supported by preview generator, creating basic svg...")
-            # Mimetype is not supported by preview generator so we make a basic svg of the slug and mimetype
-            svg = uploaded_file.generate_basic_svg_preview(filename)
-            # Write to an svg thumbnail file
-            thumbnail_ext = "svg"
-            with open(f"{absolute_thumb_path}.svg", 'w') as f:
-                f.write(svg)
-                f.close()
-            absolute_thumb_path = f"{absolute_thumb_path}.svg"
-
-        if not (thumbnail_ext == 'svg'):
-            print("thumbnail is not an svg, attempting to resize...")
-            # Resize the image to make sure that it is going to be 512x512
-            img = Image.open(absolute_thumb_path)
-            if img.width > 512 or img.height > 512:
-                img.thumbnail((512, 512))
-            # Save and close the thumbnail image regardless of whether we resized it or not as we still opened the image file
-            img.save(absolute_thumb_path)
-            img.close()
-            print("thumbnail resized!")
 
         print("Adjusting uploaded file properties...")
         # Force point the thumbnail property to the new file and save
         uploaded_file.thumbnail_path = f"{uploaded_file.thumbnail_path}.{thumbnail_ext}"
         uploaded_file.thumbnail.name = uploaded_file.thumbnail_path
-        uploaded_file.save()
+        uploaded_file.thumbnail_present = True
+        with metrics.thumbnail_stage("save", file_type, timings):
+            uploaded_file.save()
         print("uploaded file properties adjusted! Thumbnail saved!")
+        return thumbnail_ext
     except Exception as e:
         # Print Helpful debug messages
         print(f"Creating thumbnail for: {slug} has failed: {e}")
         traceback.print_exception(e, limit=5)
+
+
+@shared_task
+def create_hls_renditions(slug: str):
+    """
+    Task to transcode a local video into its HLS ladder (see filehost/renditions.py) and keep it next to the original
+    """
+    directory = None
+    temp_directory = None
+    try:
+        uploaded_file = UploadedFile.objects.get(slug=slug)
+        directory = renditions.renditions_directory(uploaded_file)
+
+        if uploaded_file.file_type != UploadedFile.FileType.VIDEO:
+            raise TypeError(f"Could not create renditions of: {uploaded_file}, as it is not a video!")
+        if uploaded_file.state != UploadedFile.State.LOCAL:
+            raise TypeError(f"Could not create renditions of: {uploaded_file}, as it is not local!")
+        if renditions.has_renditions(uploaded_file):
+            print(f"Renditions of: {slug} already exist")
+            return True
+
+        # Transcode into a temporary directory first so that a player never finds half a ladder, each attempt gets its own
+        # so that a duplicate task can never remove a directory that another ffmpeg is still writing to
+        temp_directory = f"{directory}.tmp-{secrets.token_hex(4)}"
+        result = renditions.transcode_sandboxed(uploaded_file.file.path, temp_directory)
+
+        # The original may have been archived or deleted while it was being transcoded, the ladder goes with it
+        if not UploadedFile.objects.filter(slug=slug, state=UploadedFile.State.LOCAL).exists():
+            raise TypeError(f"Could not keep the renditions of: {slug}, it is no longer local!")
+        if renditions.has_renditions(uploaded_file):
+            print(f"Renditions of: {slug} were created by another task, discarding this copy")
+            return True
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temp_directory, directory)
+        print(f"Created {', '.join(result['renditions'])} renditions for: {slug} in {result['timings']['transcode']:.1f}s")
+        return result
+    except Exception as e:
+        # Print Helpful debug messages
+        print(f"Creating renditions for: {slug} has failed: {e}")
+        traceback.print_exception(e, limit=5)
+        return False
+    finally:
+        if temp_directory is not None:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+        if directory is not None:
+            if os.path.isfile(f"{directory}.pending"):
+                os.remove(f"{directory}.pending")
+
+
+@shared_task
+def create_image_variant(slug: str, mime_type: str):
+    """
+    Task to create a negotiated format variant (webp, avif) of an image and cache it next to the original
+    """
+    path = None
+    try:
+        uploaded_file = UploadedFile.objects.get(slug=slug)
+        path = negotiation.variant_path(uploaded_file, mime_type)
+        ext, pil_format = negotiation.VARIANT_FORMATS[mime_type]
+
+        if uploaded_file.state != UploadedFile.State.LOCAL:
+            raise TypeError(f"Could not create a variant of: {uploaded_file}, as it is not local!")
+
+        # Write to a temporary file first so that a half written variant is never served. Decoding the upload
+        # runs in the sandbox with the thumbnail limits as it is just as untrusted
+        temp_path = f"{path}.tmp"
+        variant_size = negotiation.render_variant_sandboxed(uploaded_file.file.path, temp_path, pil_format)
+
+        if variant_size >= uploaded_file.file.size:
+            # The variant is not any smaller than the original, leave an empty variant so that the original keeps being served
+            open(temp_path, 'w').close()
+        os.replace(temp_path, path)
+        print(f"Created {ext} variant for: {slug}")
+        return True
+    except Exception as e:
+        # Print Helpful debug messages
+        print(f"Creating {mime_type} variant for: {slug} has failed: {e}")
+        traceback.print_exception(e, limit=5)
+        if path is not None and os.path.isfile(f"{path}.tmp"):
+            os.remove(f"{path}.tmp")
+        return False
+    finally:
+        if path is not None and os.path.isfile(f"{path}.pending"):
+            os.remove(f"{path}.pending")
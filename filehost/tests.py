@@ -1,11 +1,13 @@
-from django.test import TestCase, override_settings
+from django.test import TestCase, SimpleTestCase, override_settings
 from django.core.files import File
 from django.conf import settings
 from django.utils import timezone
-import os
+from django.db.models import Sum
+import os, hashlib, threading, time
+from unittest import mock
 
-from filehost import tasks
-from .models import UploadedFile, random_slug, SLUG_LENGTH, post_save_hook
+from filehost import tasks, negotiation, nas, orphans, manifest, usage, bulk, changelist, deletion, metrics, waveforms, renditions
+from .models import UploadedFile, StoredFile, StorageUsage, MimeTypeFacet, random_slug, SLUG_LENGTH, post_save_hook
 from i54m_apiuser.models import ApiUser
 from django.contrib.auth.models import AnonymousUser
 
@@ -151,6 +153,16 @@ class UploadedFileTests(TestCase):
         self.assertIs(len(slug), SLUG_LENGTH)
         self.assertFalse(UploadedFile.objects.filter(slug=slug).count() > 0)
 
+    def test_random_slug_skips_pending_deletion(self):
+        """
+        random_slug() does not hand out the slug of a file that is pending deletion, its row still holds the primary key until it is reaped
+        """
+        uf: UploadedFile = self.uploaded_files["api-text"]
+        UploadedFile.objects.filter(pk=uf.pk).update(pending_deletion=True)
+        with mock.patch("filehost.models.random.choices", side_effect=[list(uf.slug), list("fresh123")]):
+            self.assertEqual(random_slug(), "fresh123")
+        UploadedFile.all_objects.filter(pk=uf.pk).update(pending_deletion=False)
+
 
 ##################################################
 #           test filetype uploads                #
@@ -342,6 +354,169 @@ class UploadedFileTests(TestCase):
             uf.save()
 
 
+    def test_claim_moving_only_once(self):
+        """
+        Test that only the first of two copies of the same file can claim it for moving, so two workers never move the same file
+        """
+        for key in self.uploaded_files.keys():
+            uf: UploadedFile = self.uploaded_files[key]
+            uf.refresh_from_db()
+            other_copy = UploadedFile.objects.get(slug=uf.slug)
+            self.assertTrue(uf.claim_moving())
+            self.assertEqual(uf.state, UploadedFile.State.MOVING)
+            self.assertIsNotNone(uf.moving_since)
+            self.assertFalse(other_copy.claim_moving())
+            uf.release_moving(UploadedFile.State.LOCAL)
+            uf.refresh_from_db()
+            self.assertEqual(uf.state, UploadedFile.State.LOCAL)
+            self.assertIsNone(uf.moving_since)
+
+    def test_request_localisation_only_once(self):
+        """
+        Test that only the first request for an archived file queues it for de-archiving, so popular links do not queue duplicate tasks
+        """
+        for key in self.uploaded_files.keys():
+            uf: UploadedFile = self.uploaded_files[key]
+            UploadedFile.objects.filter(slug=uf.slug).update(state=UploadedFile.State.ARCHIVED)
+            uf.refresh_from_db()
+            other_copy = UploadedFile.objects.get(slug=uf.slug)
+            with mock.patch.object(tasks.localise_file, 'delay') as delay:
+                self.assertTrue(uf.request_localisation())
+                self.assertFalse(other_copy.request_localisation())
+                self.assertFalse(uf.request_localisation())
+                delay.assert_called_once_with(uf.slug, uf.moving_since.isoformat())
+            uf.release_moving(UploadedFile.State.LOCAL)
+
+    def test_storage_usage_counters(self):
+        """
+        Test that the storage usage counters match the uploaded files and follow them as they change state
+        """
+        self.assertEqual(usage.totals(StorageUsage.objects.all()), {
+            "files": UploadedFile.objects.count(),
+            "bytes": UploadedFile.objects.aggregate(total=Sum('size'))['total'],
+        })
+        uf: UploadedFile = self.uploaded_files["api-image"]
+        uf.refresh_from_db()
+        self.assertEqual(uf.size, os.path.getsize(uf.file.path))
+        counters = StorageUsage.objects.filter(uploader=uf.uploader, file_type=uf.file_type, upload_type=uf.upload_type)
+        local_files = counters.get(state=UploadedFile.State.LOCAL).files
+        self.assertTrue(uf.claim_moving())
+        self.assertEqual(counters.get(state=UploadedFile.State.LOCAL).files, local_files - 1)
+        self.assertEqual(counters.get(state=UploadedFile.State.MOVING).files, 1)
+        self.assertEqual(counters.get(state=UploadedFile.State.MOVING).bytes, uf.size)
+        uf.release_moving(UploadedFile.State.LOCAL)
+        self.assertEqual(counters.get(state=UploadedFile.State.LOCAL).files, local_files)
+        self.assertEqual(counters.get(state=UploadedFile.State.MOVING).files, 0)
+
+    def test_storage_usage_recalculate_button(self):
+        """
+        Test that usage is recalculated from the changelist button, even with no counters listed, and that counters cannot be deleted from the admin
+        """
+        from django.urls import reverse
+        self.client.force_login(self.admin_user)
+        changelist_url = reverse("admin:filehost_storageusage_changelist")
+        recalculate_url = reverse("admin:filehost_storageusage_recalculate")
+        self.assertContains(self.client.get(changelist_url, {"q": "nobody"}), recalculate_url)
+        with mock.patch.object(tasks.recalculate_storage_usage, 'delay') as delay:
+            self.assertEqual(self.client.get(recalculate_url).status_code, 405)
+            self.assertRedirects(self.client.post(recalculate_url), changelist_url, fetch_redirect_response=False)
+        delay.assert_called_once_with()
+        counter = StorageUsage.objects.first()
+        self.assertEqual(self.client.get(reverse("admin:filehost_storageusage_delete", args=[counter.pk])).status_code, 403)
+
+    def test_bulk_actions(self):
+        """
+        Test that bulk admin actions keep the featured rule and move files between uploaders' storage usage counters
+        """
+        uf: UploadedFile = self.uploaded_files["api-text"]
+        UploadedFile.objects.filter(pk=uf.pk).update(featured=True, access=UploadedFile.Access.PUBLIC)
+        self.assertEqual(bulk.apply([uf.pk], bulk.PRIVATE), 1)
+        uf.refresh_from_db()
+        self.assertEqual(uf.access, UploadedFile.Access.PRIVATE)
+        self.assertFalse(uf.featured)
+
+        previous_uploader = uf.uploader
+        bulk.apply([uf.pk], bulk.TAKE_OWNERSHIP, {'uploader_id': self.other_user.pk})
+        uf.refresh_from_db()
+        self.assertEqual(uf.uploader, self.other_user)
+        self.assertEqual(usage.totals(StorageUsage.objects.filter(uploader=self.other_user))["files"], UploadedFile.objects.filter(uploader=self.other_user).count())
+        self.assertEqual(usage.totals(StorageUsage.objects.filter(uploader=previous_uploader))["files"], UploadedFile.objects.filter(uploader=previous_uploader).count())
+
+    def test_deletion_is_reaped_in_background(self):
+        """
+        Test that deleted files are hidden and uncounted straight away, then removed from storage by the reaper
+        """
+        uf = UploadedFile(file=File(open(TEST_TEXT, "rb")), upload_type=UploadedFile.UploadType.MANUAL, uploader=self.uploader_user)
+        uf.set_expiration(days=1)
+        post_save_hook(instance=uf, created=True)
+        uf.refresh_from_db()
+        local_path = uf.file.path
+        counted = usage.totals(StorageUsage.objects.filter(uploader=self.uploader_user))
+
+        self.assertTrue(uf.mark_for_deletion())
+        self.assertFalse(uf.mark_for_deletion())
+        self.assertFalse(UploadedFile.objects.filter(slug=uf.slug).exists())
+        self.assertEqual(usage.totals(StorageUsage.objects.filter(uploader=self.uploader_user)), {"files": counted["files"] - 1, "bytes": counted["bytes"] - uf.size})
+        self.assertTrue(os.path.isfile(local_path))
+
+        report = deletion.reap()
+        self.assertEqual(report["reaped"], 1)
+        self.assertFalse(os.path.isfile(local_path))
+        self.assertFalse(UploadedFile.all_objects.filter(slug=uf.slug).exists())
+        self.assertEqual(usage.totals(StorageUsage.objects.filter(uploader=self.uploader_user))["files"], counted["files"] - 1)
+
+    def test_delete_view_marks_for_deletion(self):
+        """
+        Test that deleting through the delete view hides the file straight away and leaves removing its stored files to the reaper
+        """
+        from django.urls import reverse
+        uf = UploadedFile(file=File(open(TEST_TEXT, "rb")), upload_type=UploadedFile.UploadType.MANUAL, uploader=self.uploader_user)
+        uf.set_expiration(days=1)
+        post_save_hook(instance=uf, created=True)
+        uf.refresh_from_db()
+        local_path = uf.file.path
+
+        self.client.force_login(self.uploader_user)
+        response = self.client.post(reverse("filehost:delete-upload", kwargs={"slug": uf.slug}))
+        self.assertRedirects(response, reverse("filehost:list-uploads"), fetch_redirect_response=False)
+        self.assertFalse(UploadedFile.objects.filter(slug=uf.slug).exists())
+        self.assertTrue(UploadedFile.all_objects.get(slug=uf.slug).pending_deletion)
+        self.assertTrue(os.path.isfile(local_path))
+
+        self.assertEqual(deletion.reap()["reaped"], 1)
+        self.assertFalse(os.path.isfile(local_path))
+
+    def test_archived_copy_removed_after_commit(self):
+        """
+        Test that deleting an archived file directly only queues removing its archived copy once the delete has been committed
+        """
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug="d0000001", file="MANUAL/TEXT/d0000001.txt", file_path="MANUAL/TEXT/d0000001.txt", state=UploadedFile.State.ARCHIVED,
+                         expiration_date=timezone.localdate() + timezone.timedelta(days=1), upload_type=UploadedFile.UploadType.MANUAL,
+                         file_type=UploadedFile.FileType.TEXT, mime_type="text/plain", uploader=self.uploader_user, size=5)
+        ])
+        uf = UploadedFile.objects.get(slug="d0000001")
+        with mock.patch("filehost.tasks.remove_archived_files.delay") as remove_archived_files:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                uf.delete()
+            remove_archived_files.assert_not_called()
+            for callback in callbacks:
+                callback()
+        remove_archived_files.assert_called_once_with([("d0000001", nas.archive_path(uf))])
+
+    def test_admin_changelist_counts(self):
+        """
+        Test that the admin mime type facets match the uploaded files and that small tables are counted exactly
+        """
+        changelist.refresh_mime_type_facets()
+        for facet in MimeTypeFacet.objects.all():
+            self.assertEqual(facet.files, UploadedFile.objects.filter(mime_type=facet.mime_type).count())
+        self.assertEqual(MimeTypeFacet.objects.aggregate(total=Sum('files'))['total'], UploadedFile.objects.count())
+        self.assertEqual(changelist.EstimatedCountPaginator(UploadedFile.objects.all(), 100).count, UploadedFile.objects.count())
+        image_files = UploadedFile.objects.filter(file_type=UploadedFile.FileType.IMAGE)
+        self.assertEqual(changelist.EstimatedCountPaginator(image_files, 100).count, image_files.count())
+
+
 ##################################################
 #             test can_be_managed_by             #
 ##################################################
@@ -403,6 +578,7 @@ class UploadedFileTests(TestCase):
         for type in UPLOAD_TYPES:
             uf: UploadedFile = self.uploaded_files[f"{type.lower()}-file"]
             self.assertTrue(uf.has_thumbnail) # ensure that the has_thumbnail property is working
+            self.assertTrue(uf.thumbnail_present) # ensure that the stored flag used by the admin listing was set
             self.assertEqual(uf.thumbnail_path, f"{type}/FILE/THUMBNAIL/{uf.slug}.54m.svg") # ensure thumbnail file path is as expected
             self.assertIsNotNone(uf.thumbnail) # ensure that there is a thumbnail linked to the uploadedfile
             self.assertTrue(os.path.exists(uf.thumbnail.path)) # ensure that the thumbnail file actually exists
@@ -436,9 +612,10 @@ class UploadedFileTests(TestCase):
         for type in UPLOAD_TYPES:
             uf: UploadedFile = self.uploaded_files[f"{type.lower()}-audio"]
             self.assertTrue(uf.has_thumbnail) # ensure that the has_thumbnail property is working
-            self.assertEqual(uf.thumbnail_path, f"{type}/AUDIO/THUMBNAIL/{uf.slug}.mp3.svg") # ensure thumbnail file path is as expected
+            self.assertEqual(uf.thumbnail_path, f"{type}/AUDIO/THUMBNAIL/{uf.slug}.mp3.png") # ensure the thumbnail is a rendering of the waveform
             self.assertIsNotNone(uf.thumbnail) # ensure that there is a thumbnail linked to the uploadedfile
             self.assertTrue(os.path.exists(uf.thumbnail.path)) # ensure that the thumbnail file actually exists
+            self.assertTrue(os.path.exists(waveforms.peaks_path(uf))) # ensure that the peaks were kept for the waveform view
 
     def test_video_filetype_thumbnail(self):
         """
@@ -518,6 +695,132 @@ class OEmbedTests(TestCase):
     pass
 
 
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                           File Status View Tests                                                   #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+@override_settings(MEDIA_ROOT=os.path.join(TEST_MEDIA_ROOT, "FileStatusViewTests"))
+class FileStatusViewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug=slug, file=f"API/TEXT/{slug}.txt", file_path=f"API/TEXT/{slug}.txt", state=state, moving_since=now if state == UploadedFile.State.MOVING else None,
+                         expiration_date=timezone.localdate() + timezone.timedelta(days=1), upload_type=UploadedFile.UploadType.API,
+                         file_type=UploadedFile.FileType.TEXT, mime_type="text/plain", size=5)
+            for slug, state in (("s0000001", UploadedFile.State.LOCAL), ("s0000002", UploadedFile.State.MOVING))
+        ])
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, "API", "TEXT"), exist_ok=True)
+        with open(os.path.join(settings.MEDIA_ROOT, "API", "TEXT", "s0000001.txt"), "w") as f:
+            f.write("local")
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        shutil.rmtree(os.path.join(TEST_MEDIA_ROOT, "FileStatusViewTests"), ignore_errors=True)
+        return super().tearDownClass()
+
+    def status_url(self, slug: str) -> str:
+        from django.urls import reverse
+        return reverse("filehost:fetch-file-status", kwargs={"slug": slug})
+
+    def test_local_file_answered_immediately(self):
+        """
+        test that a local file is reported as ready without waiting, however long the client asked to wait
+        """
+        with mock.patch("filehost.views.time.sleep") as sleep:
+            response = self.client.get(self.status_url("s0000001"), {"wait": 5})
+        self.assertEqual(response.status_code, 200)
+        status = response.json()
+        self.assertEqual((status["state"], status["ready"]), (UploadedFile.State.LOCAL, True))
+        self.assertNotIn("retry_after", status)
+        sleep.assert_not_called()
+
+    @override_settings(FILE_STATUS_MAX_WAIT=3)
+    def test_wait_is_clamped(self):
+        """
+        test that ?wait is clamped between 0 and FILE_STATUS_MAX_WAIT, and that files that are not ready tell the client when to poll again
+        """
+        from filehost import views
+        with mock.patch.object(views, "wait_for_state_change", return_value=UploadedFile.State.MOVING) as wait:
+            response = self.client.get(self.status_url("s0000002"), {"wait": 600})
+            wait.assert_called_once_with("s0000002", UploadedFile.State.MOVING, 3)
+            status = response.json()
+            self.assertEqual((status["ready"], status["retry_after"]), (False, views.STATUS_RETRY_AFTER))
+
+            wait.reset_mock()
+            self.client.get(self.status_url("s0000002"), {"wait": -5})
+            wait.assert_called_once_with("s0000002", UploadedFile.State.MOVING, 0)
+            self.assertEqual(self.client.get(self.status_url("s0000002"), {"wait": "soon"}).status_code, 400)
+
+    def test_deleted_while_waiting_is_not_found(self):
+        """
+        test that a file deleted while a client is waiting on it is answered with 404, as are later requests
+        """
+        with mock.patch("filehost.views.time.sleep", side_effect=lambda seconds: deletion.mark_for_deletion(["s0000002"], reap=False)):
+            response = self.client.get(self.status_url("s0000002"), {"wait": 5})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(self.status_url("s0000002")).status_code, 404)
+
+    def test_event_stream_sets_reconnect_delay(self):
+        """
+        test that the event stream tells EventSource how long to wait before reconnecting
+        """
+        from filehost import views
+        response = self.client.get(self.status_url("s0000001"), HTTP_ACCEPT="text/event-stream")
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn(f"retry: {views.STATUS_RETRY_AFTER * 1000}\n", content)
+        self.assertIn('"ready": true', content)
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                             Read Through Tests                                                     #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+@override_settings(MEDIA_ROOT=os.path.join(TEST_MEDIA_ROOT, "ReadThroughTests"), READ_THROUGH_ARCHIVE=True)
+class ReadThroughTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        stale = timezone.now() - timezone.timedelta(seconds=settings.EXPIRY_STALE_MOVING_AFTER + 60)
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug=slug, file=f"API/TEXT/{slug}.txt", file_path=f"API/TEXT/{slug}.txt", state=UploadedFile.State.MOVING, moving_since=moving_since,
+                         expiration_date=timezone.localdate() + timezone.timedelta(days=1), upload_type=UploadedFile.UploadType.API,
+                         file_type=UploadedFile.FileType.TEXT, mime_type="text/plain", size=5)
+            for slug, moving_since in (("r0000001", stale), ("r0000002", timezone.now()))
+        ])
+
+    def raw_url(self, slug: str) -> str:
+        from django.urls import reverse
+        return reverse("filehost:fetch-file-raw", kwargs={"slug": slug})
+
+    def test_stale_move_is_taken_over(self):
+        """
+        test that a file left moving by a worker that died is handed to the localise task rather than answered with 503 forever
+        """
+        with mock.patch.object(tasks.localise_file, "delay") as delay:
+            response = self.client.get(self.raw_url("r0000001"))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        uploaded_file = UploadedFile.objects.get(slug="r0000001")
+        delay.assert_called_once_with("r0000001", uploaded_file.moving_since.isoformat())
+        self.assertGreater(uploaded_file.moving_since, timezone.now() - timezone.timedelta(minutes=1))
+
+    def test_active_move_is_left_alone(self):
+        """
+        test that a file that is still being moved is not queued again, the client is just asked to retry
+        """
+        with mock.patch.object(tasks.localise_file, "delay") as delay:
+            response = self.client.get(self.raw_url("r0000002"))
+        self.assertEqual(response.status_code, 503)
+        delay.assert_not_called()
+
+
 ######################################################################################################################
 # ------------------------------------------------------------------------------------------------------------------ #
 #                                   Celery Async and Periodic Tasks Tests                                            #
@@ -576,3 +879,1706 @@ class CeleryTasksTests(TestCase):
 
 
 
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                       Negotiated Image Delivery Tests                                              #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+@override_settings(NEGOTIATION_FORMATS=['image/avif', 'image/webp'])
+class NegotiationTests(SimpleTestCase):
+
+    def test_choose_preferred_format(self):
+        """
+        test that the most preferred format is chosen when the client accepts multiple formats
+        """
+        self.assertEqual(negotiation.choose_format("image/avif,image/webp,image/apng,*/*;q=0.8", "image/png"), "image/avif")
+        self.assertEqual(negotiation.choose_format("image/webp,*/*", "image/png"), "image/webp")
+
+    def test_choose_format_quality_values(self):
+        """
+        test that quality values are respected and formats refused with q=0 are never chosen
+        """
+        self.assertEqual(negotiation.choose_format("image/avif;q=0.5,image/webp", "image/jpeg"), "image/webp")
+        self.assertEqual(negotiation.choose_format("image/avif;q=0,image/webp;q=0", "image/jpeg"), None)
+
+    def test_choose_format_wildcards_ignored(self):
+        """
+        test that wildcards do not cause a variant to be served as browsers send them even when they cannot display the variant
+        """
+        self.assertEqual(negotiation.choose_format("*/*", "image/png"), None)
+        self.assertEqual(negotiation.choose_format("image/*", "image/png"), None)
+        self.assertEqual(negotiation.choose_format("", "image/png"), None)
+
+    def test_choose_format_unsupported_source(self):
+        """
+        test that animated and vector images are always served as the original
+        """
+        self.assertEqual(negotiation.choose_format("image/avif,image/webp", "image/gif"), None)
+        self.assertEqual(negotiation.choose_format("image/avif,image/webp", "image/svg+xml"), None)
+
+
+@override_settings(NEGOTIATE_IMAGE_FORMATS=True, NEGOTIATION_FORMATS=['image/webp'])
+class NegotiatedVariantTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        from PIL import Image
+        create_test_apiusers(cls)
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug=slug, file=f"API/IMAGE/{slug}.png", file_path=f"API/IMAGE/{slug}.png", expiration_date=timezone.localdate() + timezone.timedelta(days=1),
+                         upload_type=UploadedFile.UploadType.API, file_type=UploadedFile.FileType.IMAGE, mime_type="image/png",
+                         access=UploadedFile.Access.PUBLIC, uploader=cls.uploader_user, size=0)
+            for slug in ("n0000001", "n0000002")
+        ])
+        # Noise does not compress as PNG so the lossy webp variant is always smaller
+        for slug in ("n0000001", "n0000002"):
+            path = os.path.join(settings.MEDIA_ROOT, f"API/IMAGE/{slug}.png")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Image.frombytes("RGB", (128, 128), os.urandom(128 * 128 * 3)).save(path)
+
+    def tearDown(self):
+        for slug in ("n0000001", "n0000002"):
+            path = negotiation.variant_path(UploadedFile.objects.get(slug=slug), "image/webp")
+            for leftover in (path, f"{path}.pending", f"{path}.tmp"):
+                if os.path.isfile(leftover):
+                    os.remove(leftover)
+        return super().tearDown()
+
+    @classmethod
+    def tearDownClass(cls):
+        for slug in ("n0000001", "n0000002"):
+            path = os.path.join(settings.MEDIA_ROOT, f"API/IMAGE/{slug}.png")
+            if os.path.isfile(path):
+                os.remove(path)
+        return super().tearDownClass()
+
+    def raw_url(self, slug: str) -> str:
+        from django.urls import reverse
+        return reverse("filehost:fetch-file-raw", kwargs={"slug": slug})
+
+    def test_variant_queued_once(self):
+        """
+        test that the original is served while the variant is created and the pending marker stops the variant being queued again
+        """
+        with mock.patch.object(tasks.create_image_variant, "delay") as delay:
+            for _ in range(2):
+                response = self.client.get(self.raw_url("n0000001"), HTTP_ACCEPT="image/webp,*/*")
+                self.assertEqual(response["Content-Type"], "image/png")
+        delay.assert_called_once_with("n0000001", "image/webp")
+        self.assertTrue(os.path.isfile(f"{negotiation.variant_path(UploadedFile.objects.get(slug='n0000001'), 'image/webp')}.pending"))
+
+    def test_variant_served_with_vary(self):
+        """
+        test that once created the variant is served to clients that accept it, the original to the rest, and both vary on Accept
+        """
+        self.assertTrue(tasks.create_image_variant("n0000001", "image/webp"))
+        path = negotiation.variant_path(UploadedFile.objects.get(slug="n0000001"), "image/webp")
+        self.assertGreater(os.path.getsize(path), 0)
+        self.assertFalse(os.path.isfile(f"{path}.pending"))
+
+        response = self.client.get(self.raw_url("n0000001"), HTTP_ACCEPT="image/webp,*/*")
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("Accept", response["Vary"])
+        response = self.client.get(self.raw_url("n0000001"), HTTP_ACCEPT="*/*")
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("Accept", response["Vary"])
+
+    def test_variant_not_smaller_serves_original(self):
+        """
+        test that a variant that is not smaller than the original is left empty and the original keeps being served without queuing again
+        """
+        def render_larger(source_path, destination_path, pil_format):
+            with open(destination_path, "wb") as f:
+                f.write(b"\0" * (os.path.getsize(source_path) + 1))
+            return os.path.getsize(destination_path)
+
+        with mock.patch.object(negotiation, "render_variant_sandboxed", side_effect=render_larger):
+            self.assertTrue(tasks.create_image_variant("n0000002", "image/webp"))
+        self.assertEqual(os.path.getsize(negotiation.variant_path(UploadedFile.objects.get(slug="n0000002"), "image/webp")), 0)
+
+        with mock.patch.object(tasks.create_image_variant, "delay") as delay:
+            response = self.client.get(self.raw_url("n0000002"), HTTP_ACCEPT="image/webp,*/*")
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("Accept", response["Vary"])
+        delay.assert_not_called()
+
+    @override_settings(THUMBNAIL_MAX_IMAGE_PIXELS=1000)
+    def test_oversized_images_are_not_converted(self):
+        """
+        test that images over the pixel limit are refused by the sandbox and no variant or temporary file is left behind
+        """
+        self.assertFalse(tasks.create_image_variant("n0000001", "image/webp"))
+        path = negotiation.variant_path(UploadedFile.objects.get(slug="n0000001"), "image/webp")
+        self.assertFalse(os.path.isfile(path))
+        self.assertFalse(os.path.isfile(f"{path}.tmp"))
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                             NAS Transfer Tests                                                     #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class NASTransferTests(SimpleTestCase):
+
+    def test_chunk_ranges_cover_file(self):
+        """
+        test that chunk ranges cover the whole file with no gaps or overlaps and only the last chunk is short
+        """
+        chunks = nas.chunk_ranges(250, 100)
+        self.assertEqual(chunks, [(0, 0, 100), (1, 100, 100), (2, 200, 50)])
+        self.assertEqual(nas.chunk_ranges(200, 100), [(0, 0, 100), (1, 100, 100)])
+        self.assertEqual(nas.chunk_ranges(0, 100), [])
+
+    def test_only_large_uncompressed_files_are_chunked(self):
+        """
+        test that chunking is only used for uncompressed files at or above the threshold
+        """
+        self.assertTrue(nas.should_chunk(nas.NAS_CHUNKED_TRANSFER_THRESHOLD))
+        self.assertFalse(nas.should_chunk(nas.NAS_CHUNKED_TRANSFER_THRESHOLD - 1))
+        self.assertFalse(nas.should_chunk(nas.NAS_CHUNKED_TRANSFER_THRESHOLD, UploadedFile.Compression.ZSTD))
+
+    def test_chunk_verifier(self):
+        """
+        test that streamed data is checked against the manifest even when blocks do not line up with chunk boundaries
+        """
+        data = os.urandom(250)
+        manifest = {'size': 250, 'chunk_size': 100, 'chunks': [hashlib.sha256(data[offset:offset + 100]).hexdigest() for offset in range(0, 250, 100)]}
+        verifier = nas.ChunkVerifier(manifest, "test")
+        for offset in range(0, 250, 30):
+            verifier.update(data[offset:offset + 30])
+        verifier.finish()
+
+        corrupted = data[:150] + b"0" + data[151:]
+        verifier = nas.ChunkVerifier(manifest, "test")
+        with self.assertRaises(IOError):
+            verifier.update(corrupted)
+
+    def run_transfers_concurrently(self, items, max_workers, failing=(), callback=None):
+        """
+        Runs run_transfers without a NAS, each operation is timed so overlapping workers can be counted
+        """
+        lock = threading.Lock()
+        running = {"now": 0, "peak": 0}
+
+        def operation(sftp, item):
+            with lock:
+                running["now"] += 1
+                running["peak"] = max(running["peak"], running["now"])
+            time.sleep(0.01)
+            with lock:
+                running["now"] -= 1
+            if item in failing:
+                raise ValueError(f"item {item} failed")
+            return item * 2
+
+        with mock.patch.object(nas.pool, "run", side_effect=lambda operation, retries=1: operation(None)):
+            results = nas.run_transfers(items, operation, max_workers=max_workers, callback=callback)
+        return results, running["peak"]
+
+    def test_transfers_never_exceed_max_workers(self):
+        """
+        test that every item is transferred and no more than max_workers run at once
+        """
+        results, peak = self.run_transfers_concurrently(range(20), max_workers=3)
+        self.assertEqual(sorted(item for item, result, error, elapsed in results), list(range(20)))
+        self.assertLessEqual(peak, 3)
+        self.assertGreater(peak, 1)
+
+    def test_failed_transfer_does_not_stop_others(self):
+        """
+        test that a failing item is recorded with its error while every other item still completes
+        """
+        results, peak = self.run_transfers_concurrently(range(20), max_workers=3, failing=(5,))
+        self.assertEqual(len(results), 20)
+        errors = {item: error for item, result, error, elapsed in results if error is not None}
+        self.assertEqual(list(errors), [5])
+        self.assertIsInstance(errors[5], ValueError)
+        self.assertTrue(all(result == item * 2 for item, result, error, elapsed in results if item != 5))
+
+    def test_transfer_callbacks_are_serialised(self):
+        """
+        test that callback is called once per item, including failures, and never by two workers at once
+        """
+        lock = threading.Lock()
+        calls = {"now": 0, "peak": 0, "items": []}
+
+        def callback(item, result, error, elapsed):
+            # Deliberately not thread safe, run_transfers promises it does not need to be
+            calls["now"] += 1
+            with lock:
+                calls["peak"] = max(calls["peak"], calls["now"])
+            time.sleep(0.005)
+            calls["items"].append(item)
+            calls["now"] -= 1
+
+        self.run_transfers_concurrently(range(20), max_workers=4, failing=(3,), callback=callback)
+        self.assertEqual(sorted(calls["items"]), list(range(20)))
+        self.assertEqual(calls["peak"], 1)
+
+    def test_chunks_use_caller_session_when_pool_busy(self):
+        """
+        test that chunks are sent one at a time over the caller's session, without checking out any more, when no lanes are spare
+        """
+        sftp = object()
+        sent = []
+        with mock.patch.object(nas.pool, "reserve_lanes", return_value=0), mock.patch.object(nas.pool, "run") as run:
+            nas.run_chunks(sftp, nas.chunk_ranges(250, 100), lambda chunk_sftp, chunk: sent.append((chunk_sftp, chunk[0])) or "checksum", lambda chunk, checksum: None, "testing")
+        self.assertEqual(sent, [(sftp, 0), (sftp, 1), (sftp, 2)])
+        run.assert_not_called()
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                          SFTP Session Pool Tests                                                   #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class FakeTransport():
+    """
+    Stands in for a paramiko.Transport, tests break it by clearing active
+    """
+
+    def __init__(self):
+        self.active = True
+        self.closed = False
+
+    def is_active(self):
+        return self.active and not self.closed
+
+    def is_authenticated(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSFTP():
+    """
+    Stands in for a paramiko.SFTPClient, the round trip liveness check fails once responsive is cleared
+    """
+
+    def __init__(self):
+        self.responsive = True
+
+    def normalize(self, path):
+        if not self.responsive:
+            raise EOFError("connection lost")
+        return "/"
+
+    def close(self):
+        pass
+
+
+class SFTPSessionPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pool = nas.SFTPSessionPool(max_idle=2, idle_timeout=60, check_after=5)
+        self.opened = []
+        connect = mock.patch.object(self.pool, "connect", side_effect=self.fake_connect)
+        connect.start()
+        self.addCleanup(connect.stop)
+
+    def fake_connect(self):
+        session = nas.SFTPSession(FakeTransport(), FakeSFTP(), 0.0)
+        self.opened.append(session)
+        return session
+
+    def test_idle_session_is_reused(self):
+        """
+        test that a healthy session released to the pool is handed out again instead of opening a new one
+        """
+        session = self.pool.acquire()
+        self.pool.release(session)
+        self.assertIs(self.pool.acquire(), session)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(self.pool.reuses, 1)
+
+    def test_stale_session_is_discarded(self):
+        """
+        test that sessions whose transport dropped, or that fail the round trip check after check_after, are closed and replaced
+        """
+        session = self.pool.acquire()
+        self.pool.release(session)
+        session.transport.active = False
+        replacement = self.pool.acquire()
+        self.assertIsNot(replacement, session)
+        self.assertTrue(session.transport.closed)
+
+        # The transport still looks active but the server stopped answering while the session sat idle
+        self.pool.release(replacement)
+        replacement.sftp.responsive = False
+        replacement.last_used -= self.pool.check_after + 1
+        self.assertIsNot(self.pool.acquire(), replacement)
+        self.assertTrue(replacement.transport.closed)
+        self.assertEqual(len(self.opened), 3)
+
+    def test_idle_session_expires(self):
+        """
+        test that sessions idle for longer than idle_timeout are closed instead of reused
+        """
+        session = self.pool.acquire()
+        self.pool.release(session)
+        session.last_used -= self.pool.idle_timeout + 1
+        self.assertIsNot(self.pool.acquire(), session)
+        self.assertTrue(session.transport.closed)
+
+        # Expired sessions are also closed whenever another session is released, not just when they are next acquired
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.pool.release(first)
+        first.last_used -= self.pool.idle_timeout + 1
+        self.pool.release(second)
+        self.assertTrue(first.transport.closed)
+        self.assertEqual(self.pool.stats()["idle_sessions"], 1)
+
+    def test_run_retries_once_then_raises(self):
+        """
+        test that run retries a connection failure exactly once on a fresh session, then re-raises, and never retries other errors
+        """
+        operation = mock.Mock(side_effect=EOFError("connection lost"))
+        with self.assertRaises(EOFError):
+            self.pool.run(operation)
+        self.assertEqual(operation.call_count, 2)
+        self.assertEqual(len(self.opened), 2)
+        # Sessions whose connection failed are not returned to the pool
+        self.assertEqual(self.pool.stats()["idle_sessions"], 0)
+
+        operation = mock.Mock(side_effect=[EOFError("connection lost"), "done"])
+        self.assertEqual(self.pool.run(operation), "done")
+        self.assertEqual(operation.call_count, 2)
+
+        operation = mock.Mock(side_effect=ValueError("not a connection error"))
+        with self.assertRaises(ValueError):
+            self.pool.run(operation)
+        self.assertEqual(operation.call_count, 1)
+
+    def test_pool_is_emptied_after_fork(self):
+        """
+        test that a forked child does not reuse, or close, the sessions of its parent
+        """
+        session = self.pool.acquire()
+        self.pool.release(session)
+        with mock.patch.object(nas.os, "getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(self.pool.acquire(), session)
+            self.assertEqual(self.pool.stats()["idle_sessions"], 0)
+        self.assertFalse(session.transport.closed)
+
+    def test_chunk_lanes_never_exceed_pool_size(self):
+        """
+        test that chunked transfers are only promised sessions that keep the process within max_idle, and none once the pool is busy
+        """
+        session = self.pool.acquire()
+        self.assertEqual(self.pool.reserve_lanes(4), 1)
+        self.assertEqual(self.pool.reserve_lanes(4), 0)
+        self.pool.release_lanes(1)
+        self.pool.release(session)
+        self.assertEqual(self.pool.reserve_lanes(4), 2)
+        self.pool.release_lanes(2)
+
+        busy = [self.pool.acquire(), self.pool.acquire()]
+        self.assertEqual(self.pool.stats()["checked_out_sessions"], 2)
+        self.assertEqual(self.pool.reserve_lanes(4), 0)
+
+    def test_liveness_checked_outside_lock(self):
+        """
+        test that the round trip liveness check runs without holding the pool lock, so a slow NAS does not block other threads
+        """
+        session = self.pool.acquire()
+        self.pool.release(session)
+        session.last_used -= self.pool.check_after + 1
+        lock_held = []
+        def normalize(path):
+            lock_held.append(self.pool._lock.locked())
+            return "/"
+        session.sftp.normalize = normalize
+        self.assertIs(self.pool.acquire(), session)
+        self.assertEqual(lock_held, [False])
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                            NAS Compression Tests                                                   #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+STAND_IN_NAS_PATH = "/archive/"
+
+class StandInNASMixin():
+    """
+    Points nas.py at the benchmark stand-in NAS, an SFTP server in a background thread serving a temporary directory,
+    so transfers run over a real SSH transport without touching the real NAS
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from benchmarks.sftp_server import StandInNAS
+        import tempfile
+        cls.nas_workdir = tempfile.mkdtemp(prefix="lfs-test-nas-")
+        cls.stand_in_nas = StandInNAS(os.path.join(cls.nas_workdir, "nas"))
+        cls.stand_in_nas.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        cls.stand_in_nas.stop()
+        shutil.rmtree(cls.nas_workdir, ignore_errors=True)
+        return super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        patches = [
+            mock.patch.multiple(nas, NAS_HOST="127.0.0.1", NAS_SFTP_PORT=self.stand_in_nas.port, NAS_USERNAME="test",
+                                NAS_PATH=STAND_IN_NAS_PATH, PRIVATE_KEY_PATH=self.stand_in_nas.client_key_path),
+            mock.patch.object(tasks, "NAS_PATH", STAND_IN_NAS_PATH),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # Sessions to any other server must not be handed out, and this test's sessions must not outlive it
+        nas.pool.close_all()
+        self.addCleanup(nas.pool.close_all)
+
+    def nas_file(self, remote_path: str) -> str:
+        """
+        Where a remote path is stored on the local disk of the stand-in NAS
+        """
+        return os.path.join(self.stand_in_nas.root, remote_path.lstrip("/"))
+
+    def make_nas_directory(self, remote_path: str):
+        os.makedirs(self.nas_file(remote_path), exist_ok=True)
+
+    def make_local_file(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.nas_workdir, "local", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def read_file(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+
+@override_settings(MEDIA_ROOT=os.path.join(TEST_MEDIA_ROOT, "NASCompressionTests"))
+class NASCompressionTests(StandInNASMixin, TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        shutil.rmtree(os.path.join(TEST_MEDIA_ROOT, "NASCompressionTests"), ignore_errors=True)
+        return super().tearDownClass()
+
+    def test_choose_compression(self):
+        """
+        test that only compressible types whose sample compresses are compressed, incompressible samples are left as NONE
+        """
+        text = UploadedFile(file_type=UploadedFile.FileType.TEXT, mime_type="text/plain")
+        compressible = self.make_local_file("compressible.txt", b"the quick brown fox jumps over the lazy dog\n" * 5000)
+        incompressible = self.make_local_file("incompressible.txt", os.urandom(200000))
+        with mock.patch.object(nas, "NAS_COMPRESSION", True):
+            self.assertEqual(nas.choose_compression(text, compressible), UploadedFile.Compression.ZSTD)
+            self.assertEqual(nas.choose_compression(text, incompressible), UploadedFile.Compression.NONE)
+            # Already compressed types are never sampled, whatever their contents
+            image = UploadedFile(file_type=UploadedFile.FileType.IMAGE, mime_type="image/png")
+            self.assertEqual(nas.choose_compression(image, compressible), UploadedFile.Compression.NONE)
+            # Otherwise compressed types are sampled when their mime type is known to compress
+            wav = UploadedFile(file_type=UploadedFile.FileType.AUDIO, mime_type="audio/wav")
+            self.assertEqual(nas.choose_compression(wav, compressible), UploadedFile.Compression.ZSTD)
+        with mock.patch.object(nas, "NAS_COMPRESSION", False):
+            self.assertEqual(nas.choose_compression(text, compressible), UploadedFile.Compression.NONE)
+
+    def test_compression_decided_by_sample_ratio(self):
+        """
+        test that the decision is made from the first NAS_COMPRESSION_SAMPLE_SIZE bytes compared against NAS_COMPRESSION_MAX_RATIO
+        """
+        text = UploadedFile(file_type=UploadedFile.FileType.TEXT, mime_type="text/plain")
+        half = nas.NAS_COMPRESSION_SAMPLE_SIZE // 2
+        # Half random and half zeros, so the sample compresses to a little over half its size
+        half_compressible = self.make_local_file("half.txt", os.urandom(half) + bytes(half))
+        with mock.patch.object(nas, "NAS_COMPRESSION", True):
+            with mock.patch.object(nas, "NAS_COMPRESSION_MAX_RATIO", 0.6):
+                self.assertEqual(nas.choose_compression(text, half_compressible), UploadedFile.Compression.ZSTD)
+            with mock.patch.object(nas, "NAS_COMPRESSION_MAX_RATIO", 0.4):
+                self.assertEqual(nas.choose_compression(text, half_compressible), UploadedFile.Compression.NONE)
+
+            # Only the sample is looked at, a file that only compresses after it is still left uncompressed
+            random_start = self.make_local_file("random_start.txt", os.urandom(nas.NAS_COMPRESSION_SAMPLE_SIZE) + bytes(1000000))
+            self.assertEqual(nas.choose_compression(text, random_start), UploadedFile.Compression.NONE)
+
+    def test_transfer_round_trip(self):
+        """
+        test that compressed and uncompressed files come back from the NAS exactly as they were sent
+        """
+        self.make_nas_directory("/archive/round_trip")
+        data = b"the quick brown fox jumps over the lazy dog\n" * 20000 + os.urandom(1000)
+        local_path = self.make_local_file("round_trip.txt", data)
+
+        with nas.pool.session() as sftp:
+            sent = nas.put_file(sftp, local_path, "/archive/round_trip/plain.txt")
+            self.assertEqual(sent, len(data))
+            self.assertEqual(self.read_file(self.nas_file("/archive/round_trip/plain.txt")), data)
+            nas.get_file(sftp, "/archive/round_trip/plain.txt", os.path.join(self.nas_workdir, "local", "plain.txt"))
+
+            sent = nas.put_file(sftp, local_path, "/archive/round_trip/compressed.txt.zst", compression=UploadedFile.Compression.ZSTD)
+            stored = self.read_file(self.nas_file("/archive/round_trip/compressed.txt.zst"))
+            self.assertEqual(sent, len(stored))
+            self.assertLess(len(stored), len(data))
+            # zstd frame magic number
+            self.assertEqual(stored[:4], b"\x28\xb5\x2f\xfd")
+            nas.get_file(sftp, "/archive/round_trip/compressed.txt.zst", os.path.join(self.nas_workdir, "local", "compressed.txt"), compression=UploadedFile.Compression.ZSTD)
+
+        self.assertEqual(self.read_file(os.path.join(self.nas_workdir, "local", "plain.txt")), data)
+        self.assertEqual(self.read_file(os.path.join(self.nas_workdir, "local", "compressed.txt")), data)
+
+    def test_codec_recorded_when_archived(self):
+        """
+        test that archiving records the chosen codec on the file, stores the compressed copy under the codec's extension and restores it intact
+        """
+        from filehost import segments
+        data = b"the quick brown fox jumps over the lazy dog\n" * 5000
+        local_path = os.path.join(settings.MEDIA_ROOT, "API", "TEXT", "c0000000.txt")
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as f:
+            f.write(data)
+        self.make_nas_directory("/archive/API/TEXT")
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug="c0000000", file="API/TEXT/c0000000.txt", file_path="API/TEXT/c0000000.txt", expiration_date=timezone.localdate(),
+                         upload_type=UploadedFile.UploadType.API, file_type=UploadedFile.FileType.TEXT, mime_type="text/plain", size=len(data))
+        ])
+        uploaded_file = UploadedFile.objects.get(slug="c0000000")
+
+        with mock.patch.object(nas, "NAS_COMPRESSION", True), mock.patch.object(segments, "NAS_SEGMENT_PACKING", False), nas.pool.session() as sftp:
+            self.assertTrue(tasks.archive_uploaded_file(sftp, uploaded_file))
+            uploaded_file.refresh_from_db()
+            self.assertEqual(uploaded_file.state, UploadedFile.State.ARCHIVED)
+            self.assertEqual(uploaded_file.compression, UploadedFile.Compression.ZSTD)
+            self.assertEqual(nas.archive_path(uploaded_file), "/archive/API/TEXT/c0000000.txt.zst")
+            self.assertTrue(os.path.isfile(self.nas_file("/archive/API/TEXT/c0000000.txt.zst")))
+            self.assertFalse(os.path.isfile(local_path))
+
+            self.assertTrue(tasks.localise_uploaded_file(sftp, uploaded_file))
+        uploaded_file.refresh_from_db()
+        self.assertEqual(uploaded_file.state, UploadedFile.State.LOCAL)
+        self.assertEqual(uploaded_file.compression, UploadedFile.Compression.NONE)
+        self.assertEqual(self.read_file(local_path), data)
+        self.assertFalse(os.path.isfile(self.nas_file("/archive/API/TEXT/c0000000.txt.zst")))
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                            Archive Segment Tests                                                   #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class ArchiveSegmentTests(StandInNASMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.make_nas_directory(STAND_IN_NAS_PATH)
+
+    def pack(self, sftp, slug: str, data: bytes, compression=UploadedFile.Compression.NONE):
+        from filehost import segments
+        local_path = self.make_local_file(f"{slug}.bin", data)
+        return segments.pack_file(sftp, UploadedFile(slug=slug, compression=compression), local_path)
+
+    def test_pack_round_trip(self):
+        """
+        test that packed files are appended one after another in the same segment and come back exactly as they were packed
+        """
+        from filehost import segments
+        first, second = os.urandom(1000), b"the quick brown fox jumps over the lazy dog\n" * 100
+        with nas.pool.session() as sftp:
+            first_entry = self.pack(sftp, "s0000001", first)
+            second_entry = self.pack(sftp, "s0000002", second, UploadedFile.Compression.ZSTD)
+            self.assertEqual(first_entry.segment, second_entry.segment)
+            self.assertEqual((first_entry.offset, second_entry.offset), (0, len(first)))
+            self.assertLess(second_entry.length, len(second))
+            self.assertEqual(os.path.getsize(self.nas_file(segments.segment_path(first_entry.segment))), len(first) + second_entry.length)
+
+            self.assertEqual(segments.read_entry(sftp, first_entry), first)
+            restored = os.path.join(self.nas_workdir, "local", "restored.bin")
+            self.assertEqual(segments.unpack_file(sftp, UploadedFile(slug="s0000001"), segments.entry_for(UploadedFile(slug="s0000001")), restored), len(first))
+            self.assertEqual(self.read_file(restored), first)
+            compressed = UploadedFile(slug="s0000002", compression=UploadedFile.Compression.ZSTD)
+            self.assertEqual(segments.unpack_file(sftp, compressed, segments.entry_for(compressed), restored), len(second))
+            self.assertEqual(self.read_file(restored), second)
+
+    def test_checksum_mismatch_raises(self):
+        """
+        test that a packed file whose bytes changed on the NAS fails verification and is not restored
+        """
+        from filehost import segments
+        with nas.pool.session() as sftp:
+            self.pack(sftp, "s0000001", os.urandom(1000))
+            entry = self.pack(sftp, "s0000002", os.urandom(1000))
+            path = self.nas_file(segments.segment_path(entry.segment))
+            with open(path, "r+b") as f:
+                f.seek(entry.offset + 10)
+                byte = f.read(1)
+                f.seek(entry.offset + 10)
+                f.write(bytes([byte[0] ^ 0xFF]))
+
+            with self.assertRaises(IOError):
+                segments.read_entry(sftp, entry)
+            restored = os.path.join(self.nas_workdir, "local", "corrupted.bin")
+            with self.assertRaises(IOError):
+                segments.unpack_file(sftp, UploadedFile(slug="s0000002"), entry, restored)
+            self.assertFalse(os.path.exists(restored))
+            self.assertFalse(os.path.exists(f"{restored}.part"))
+            # The other file in the segment is untouched
+            self.assertEqual(len(segments.read_entry(sftp, segments.entry_for(UploadedFile(slug="s0000001")))), 1000)
+
+    def test_release_counts_dead_bytes(self):
+        """
+        test that releasing an entry removes it from the index and counts its bytes as dead in its segment, once
+        """
+        from .models import ArchiveSegment, ArchiveSegmentEntry
+        with nas.pool.session() as sftp:
+            self.pack(sftp, "s0000001", os.urandom(1000))
+            entry = self.pack(sftp, "s0000002", os.urandom(300))
+        self.assertTrue(ArchiveSegmentEntry.release("s0000002"))
+        segment = ArchiveSegment.objects.get(pk=entry.segment_id)
+        self.assertEqual((segment.size, segment.dead_bytes), (1300, 300))
+        self.assertFalse(ArchiveSegmentEntry.objects.filter(slug="s0000002").exists())
+
+        self.assertFalse(ArchiveSegmentEntry.release("s0000002"))
+        segment.refresh_from_db()
+        self.assertEqual(segment.dead_bytes, 300)
+
+    def test_compaction_keeps_live_entries(self):
+        """
+        test that compacting a sealed segment moves its live entries into an open segment, drops the dead ones and removes the old segment
+        """
+        from filehost import segments
+        from .models import ArchiveSegment, ArchiveSegmentEntry
+        live = {"s0000001": os.urandom(200), "s0000003": os.urandom(300)}
+        with nas.pool.session() as sftp:
+            self.pack(sftp, "s0000001", live["s0000001"])
+            dead = self.pack(sftp, "s0000002", os.urandom(2000))
+            self.pack(sftp, "s0000003", live["s0000003"])
+            ArchiveSegment.objects.filter(pk=dead.segment_id).update(sealed=True)
+            ArchiveSegmentEntry.release("s0000002")
+
+            old_segment = ArchiveSegment.objects.get(pk=dead.segment_id)
+            self.assertEqual(segments.segments_to_compact(), [old_segment])
+            old_path = self.nas_file(segments.segment_path(old_segment))
+            self.assertEqual(segments.compact_segment(sftp, old_segment), 2000)
+
+            self.assertFalse(ArchiveSegment.objects.filter(pk=old_segment.pk).exists())
+            self.assertFalse(os.path.exists(old_path))
+            self.assertFalse(ArchiveSegmentEntry.objects.filter(slug="s0000002").exists())
+            new_segment = ArchiveSegment.objects.get()
+            self.assertEqual(new_segment.size, 500)
+            for slug, data in live.items():
+                entry = segments.entry_for(UploadedFile(slug=slug))
+                self.assertEqual(entry.segment, new_segment)
+                self.assertEqual(segments.read_entry(sftp, entry), data)
+
+    def test_repacking_reuses_or_replaces_entry(self):
+        """
+        test that packing a file that already has an entry reuses it when the bytes match and replaces it, counting the old bytes as dead, when not
+        """
+        from .models import ArchiveSegment, ArchiveSegmentEntry
+        data = os.urandom(1000)
+        with nas.pool.session() as sftp:
+            entry = self.pack(sftp, "s0000001", data)
+            self.assertEqual(self.pack(sftp, "s0000001", data), entry)
+            self.assertEqual(ArchiveSegment.objects.get().size, 1000)
+
+            changed = os.urandom(400)
+            replaced = self.pack(sftp, "s0000001", changed)
+            self.assertEqual(replaced.offset, 1000)
+            self.assertEqual(ArchiveSegmentEntry.objects.count(), 1)
+            segment = ArchiveSegment.objects.get()
+            self.assertEqual((segment.size, segment.dead_bytes), (1400, 1000))
+            from filehost import segments
+            self.assertEqual(segments.read_entry(sftp, segments.entry_for(UploadedFile(slug="s0000001"))), changed)
+
+    def test_interrupted_archive_resumes(self):
+        """
+        test that an archive interrupted after the file was packed but before it was marked as archived succeeds when it is retried
+        """
+        from filehost import segments
+        from .models import ArchiveSegment, ArchiveSegmentEntry
+        data = os.urandom(1000)
+        local_path = os.path.join(settings.MEDIA_ROOT, "API", "FILE", "s0000009.bin")
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as f:
+            f.write(data)
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug="s0000009", file="API/FILE/s0000009.bin", file_path="API/FILE/s0000009.bin", expiration_date=timezone.localdate(),
+                         upload_type=UploadedFile.UploadType.API, file_type=UploadedFile.FileType.FILE, mime_type="application/octet-stream", size=len(data))
+        ])
+        uploaded_file = UploadedFile.objects.get(slug="s0000009")
+
+        with mock.patch.object(nas, "NAS_COMPRESSION", False), mock.patch.object(segments, "NAS_SEGMENT_PACKING", True), nas.pool.session() as sftp:
+            with mock.patch.object(UploadedFile, "set_archived", side_effect=RuntimeError("worker lost")):
+                with self.assertRaises(RuntimeError):
+                    tasks.archive_uploaded_file(sftp, uploaded_file)
+            self.assertTrue(ArchiveSegmentEntry.objects.filter(slug="s0000009").exists())
+            self.assertTrue(os.path.isfile(local_path))
+
+            uploaded_file = UploadedFile.objects.get(slug="s0000009")
+            self.assertTrue(tasks.archive_uploaded_file(sftp, uploaded_file))
+        uploaded_file.refresh_from_db()
+        self.assertEqual(uploaded_file.state, UploadedFile.State.ARCHIVED)
+        self.assertFalse(os.path.isfile(local_path))
+        self.assertEqual(ArchiveSegment.objects.get().size, 1000)
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                           Chunked Transfer Tests                                                   #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class ChunkedTransferTests(StandInNASMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Ten 1000 byte chunks, sent by a single lane so the chunks finish in order
+        patch = mock.patch.multiple(nas, NAS_CHUNKED_TRANSFER_THRESHOLD=1000, NAS_CHUNK_SIZE=1000, NAS_CHUNK_WORKERS=1)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.make_nas_directory("/archive/chunked")
+
+    def test_interrupted_upload_resumes(self):
+        """
+        test that rerunning an upload interrupted after 3 of 10 chunks only sends the other 7, and the result verifies against its manifest
+        """
+        data = os.urandom(10000)
+        local_path = self.make_local_file("chunked.bin", data)
+        remote_path = "/archive/chunked/chunked.bin"
+        run_chunks = nas.run_chunks
+
+        def interrupted(sftp, chunks, operation, callback, description):
+            def send_first_three(chunk_sftp, chunk):
+                if chunk[0] >= 3:
+                    raise IOError("connection to the NAS lost")
+                return operation(chunk_sftp, chunk)
+            return run_chunks(sftp, chunks, send_first_three, callback, description)
+
+        with nas.pool.session() as sftp:
+            with mock.patch.object(nas, "run_chunks", side_effect=interrupted):
+                with self.assertRaises(IOError):
+                    nas.put_file(sftp, local_path, remote_path)
+            self.assertFalse(nas.remote_exists(sftp, remote_path))
+            self.assertEqual(sorted(nas.read_manifest(sftp, nas.manifest_path(f"{remote_path}.part"))["chunks"]), ["0", "1", "2"])
+
+            with mock.patch.object(nas, "run_chunks", wraps=run_chunks) as resumed:
+                self.assertEqual(nas.put_file(sftp, local_path, remote_path), len(data))
+            sent = resumed.call_args.args[1]
+            self.assertEqual([index for index, offset, length in sent], list(range(3, 10)))
+
+            manifest = nas.read_manifest(sftp, nas.manifest_path(remote_path))
+            self.assertEqual(manifest["chunks"], [hashlib.sha256(data[offset:offset + 1000]).hexdigest() for offset in range(0, 10000, 1000)])
+            self.assertFalse(nas.remote_exists(sftp, f"{remote_path}.part"))
+
+            restored = os.path.join(self.nas_workdir, "local", "restored.bin")
+            self.assertEqual(nas.get_file(sftp, remote_path, restored), len(data))
+        self.assertEqual(self.read_file(restored), data)
+        self.assertEqual(self.read_file(self.nas_file(remote_path)), data)
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                            Orphan Cleanup Tests                                                    #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class OrphanCleanupTests(SimpleTestCase):
+
+    def test_slug_index_membership(self):
+        """
+        test that the slug index finds every known slug, including irregular ones, and nothing else
+        """
+        known = ["gZ8tMsnP", "aaaaaaaa", "ZZZZZZZZ", "00000000", "short"]
+        index = orphans.SlugIndex(known)
+        self.assertEqual(len(index), len(known))
+        for slug in known:
+            self.assertIn(slug, index)
+        for slug in ["gZ8tMsnp", "aaaaaaab", "unknown", "", "ÄÄÄÄÄÄÄÄ"]:
+            self.assertNotIn(slug, index)
+        self.assertTrue(index.owns("gZ8tMsnP.png.webp"))
+        self.assertFalse(index.owns("gZ8tMsnX.png"))
+
+    def test_dry_run_removes_nothing(self):
+        """
+        test that a dry run reports orphans without removing them
+        """
+        report = orphans.OrphanReport("local", dry_run=True)
+        removed = []
+        orphans.remove_in_batches([("a/one.png", 10), ("a/two.png", 20)], lambda paths: removed.extend(paths) or len(paths), report)
+        self.assertEqual(removed, [])
+        self.assertEqual(report.orphans, 2)
+        self.assertEqual(report.orphaned_bytes, 30)
+        self.assertEqual(report.removed, 0)
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                           Storage Manifest Tests                                                   #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+@override_settings(MEDIA_ROOT=os.path.join(TEST_MEDIA_ROOT, "StorageManifestTests"))
+class StorageManifestTests(TestCase):
+
+    def tearDown(self):
+        for root, dirs, files in os.walk(settings.MEDIA_ROOT, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+
+    def test_reconcile_only_lists_changed_directories(self):
+        """
+        test that reconciling picks up files added and removed behind the manifest's back and skips directories that have not changed
+        """
+        directory = os.path.join(settings.MEDIA_ROOT, UploadedFile.UploadType.API, UploadedFile.FileType.IMAGE)
+        os.makedirs(directory)
+        path = os.path.join(directory, "gZ8tMsnP.png")
+        with open(path, 'wb') as f:
+            f.write(b"test")
+        os.utime(directory, (1000, 1000))
+
+        report = manifest.reconcile_local()
+        self.assertEqual(report["added"], 1)
+        entry = StoredFile.objects.get(location=StoredFile.Location.LOCAL, name="gZ8tMsnP.png")
+        self.assertEqual(entry.slug, "gZ8tMsnP")
+        self.assertEqual(entry.size, 4)
+
+        report = manifest.reconcile_local()
+        self.assertEqual(report["listed"], 0)
+
+        os.remove(path)
+        os.utime(directory, (2000, 2000))
+        report = manifest.reconcile_local()
+        self.assertEqual(report["listed"], 1)
+        self.assertEqual(report["removed"], 1)
+        self.assertFalse(StoredFile.objects.filter(name="gZ8tMsnP.png").exists())
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                           Celery Routing Tests                                                     #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class CeleryRoutingTests(SimpleTestCase):
+
+    def test_every_task_is_routed(self):
+        """
+        test that every filehost task is routed to a named queue so that none of them end up sharing the default queue by accident
+        """
+        from LFS.celery import app, WORKER_PROFILES
+        routes = app.conf.task_routes
+        for name in app.tasks.keys():
+            if name.startswith("filehost.tasks."):
+                self.assertIn(name, routes)
+        served = set()
+        for arguments in WORKER_PROFILES.values():
+            served.update(arguments[arguments.index("-Q") + 1].split(","))
+        for route in routes.values():
+            self.assertIn(route["queue"], served)
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                               Metrics Tests                                                        #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class MetricsTests(SimpleTestCase):
+
+    def test_timed_records_each_call(self):
+        """
+        test that timed functions are counted and timed even when they raise
+        """
+        from prometheus_client import REGISTRY
+        @metrics.timed("test_view")
+        def view(fail=False):
+            if fail:
+                raise ValueError("test")
+            return "ok"
+
+        before = REGISTRY.get_sample_value("lfs_view_seconds_count", {"view": "test_view"}) or 0
+        self.assertEqual(view(), "ok")
+        with self.assertRaises(ValueError):
+            view(fail=True)
+        self.assertEqual(REGISTRY.get_sample_value("lfs_view_seconds_count", {"view": "test_view"}), before + 2)
+
+    def test_cache_lookups_counted(self):
+        from prometheus_client import REGISTRY
+        before = REGISTRY.get_sample_value("lfs_cache_lookups_total", {"cache": "test", "result": "miss"}) or 0
+        metrics.cache_lookup("test", hit=False)
+        self.assertEqual(REGISTRY.get_sample_value("lfs_cache_lookups_total", {"cache": "test", "result": "miss"}), before + 1)
+
+    @override_settings(METRICS_ALLOWED_IPS=["10.0.0.5"])
+    def test_scrape_ignores_forwarded_for(self):
+        """
+        test that only the connecting address is allowed to scrape, a spoofed X-Forwarded-For header is not trusted
+        """
+        from django.test import RequestFactory
+        factory = RequestFactory()
+        request = factory.get("/metrics", REMOTE_ADDR="203.0.113.7", HTTP_X_FORWARDED_FOR="10.0.0.5")
+        request.user = AnonymousUser()
+        self.assertFalse(metrics.client_allowed(request))
+        self.assertEqual(metrics.scrape(request).status_code, 403)
+
+        request = factory.get("/metrics", REMOTE_ADDR="10.0.0.5")
+        request.user = AnonymousUser()
+        self.assertTrue(metrics.client_allowed(request))
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                              Profiling Tests                                                       #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+@override_settings(PROFILE_REPORT_ROOT=os.path.join(TEST_MEDIA_ROOT, "ProfilingTests"))
+class ProfilingTests(SimpleTestCase):
+
+    def tearDown(self):
+        if os.path.isdir(settings.PROFILE_REPORT_ROOT):
+            for entry in os.scandir(settings.PROFILE_REPORT_ROOT):
+                os.remove(entry.path)
+            os.rmdir(settings.PROFILE_REPORT_ROOT)
+
+    def test_only_flagged_superuser_requests_are_profiled(self):
+        """
+        test that requests are only profiled when a superuser asks for it and that the report is saved
+        """
+        from django.test import RequestFactory
+        from django.http import HttpResponse
+        from filehost.profiling import ProfilingMiddleware
+        middleware = ProfilingMiddleware(lambda request: HttpResponse("ok"))
+        superuser = mock.Mock(is_authenticated=True, is_superuser=True)
+
+        request = RequestFactory().get("/gZ8tMsnP/v/")
+        request.user = superuser
+        self.assertNotIn("X-Profile-Report", middleware(request))
+
+        request = RequestFactory().get("/gZ8tMsnP/v/", {"_profile": "1"})
+        request.user = AnonymousUser()
+        self.assertNotIn("X-Profile-Report", middleware(request))
+
+        request = RequestFactory().get("/gZ8tMsnP/v/", HTTP_X_PROFILE="1")
+        request.user = superuser
+        response = middleware(request)
+        name = os.path.basename(response["X-Profile-Report"])
+        with open(os.path.join(settings.PROFILE_REPORT_ROOT, name)) as f:
+            self.assertIn("GET /gZ8tMsnP/v/", f.read())
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                           Query Budget Tests                                                       #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+# Number of uploads each view is measured with, the queries and filesystem stats a view makes must not grow with them
+QUERY_BUDGET_SIZES = (10, 100, 1000)
+# Most queries and filesystem stats (os.stat, which os.path.exists/isfile/getsize use) each view may make: (queries, stats)
+VIEW_BUDGETS = {
+    "homepage": (2, 2),
+    "list_uploads": (4, 2),
+    "fetch_file_formatted": (6, 4),
+    "handle_oembed": (3, 3),
+    "handle_api_upload": (25, 30),
+}
+
+def normalise_query(sql: str) -> str:
+    """
+    Replaces the values in a query so that queries that only differ by the row they fetch compare as equal
+    """
+    import re
+    return re.sub(r"\b\d+\b", "?", re.sub(r"'(?:[^']|'')*'", "'?'", sql))
+
+def numbered(lines) -> str:
+    return "\n".join(f"{index:4}. {line}" for index, line in enumerate(lines, start=1))
+
+def growth_diff(before, after, before_label: str, after_label: str) -> str:
+    import difflib
+    return "\n".join(difflib.unified_diff(before, after, before_label, after_label, lineterm="", n=1))
+
+
+class StatCounter():
+    """
+    Stand in for os.stat that records the paths it is called with
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.stat = os.stat
+
+    def __call__(self, path, *args, **kwargs):
+        self.paths.append(str(path))
+        return self.stat(path, *args, **kwargs)
+
+
+@override_settings(MEDIA_ROOT=os.path.join(TEST_MEDIA_ROOT, "QueryBudgetTests"))
+class QueryBudgetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_apiusers(cls)
+        # A real upload for the views that read the file, the rest of the uploads are rows only
+        cls.uploaded_file = UploadedFile(file=File(open(TEST_IMAGE, "rb")), upload_type=UploadedFile.UploadType.API, uploader=cls.uploader_user)
+        cls.uploaded_file.set_expiration(days=1)
+        cls.uploaded_file.save()
+        cls.uploaded_file.refresh_from_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        shutil.rmtree(os.path.join(TEST_MEDIA_ROOT, "QueryBudgetTests"), ignore_errors=True)
+        return super().tearDownClass()
+
+    def add_uploads(self, total: int):
+        existing = UploadedFile.objects.filter(slug__startswith="q").count()
+        now = timezone.now()
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug=f"q{index:07d}", file=f"API/IMAGE/q{index:07d}.png", file_path=f"API/IMAGE/q{index:07d}.png",
+                         thumbnail=f"API/IMAGE/THUMBNAIL/q{index:07d}.png.jpeg", thumbnail_path=f"API/IMAGE/THUMBNAIL/q{index:07d}.png.jpeg", thumbnail_present=True,
+                         uploaded_at=now - timezone.timedelta(minutes=index + 1), expiration_date=timezone.localdate() + timezone.timedelta(days=1),
+                         upload_type=UploadedFile.UploadType.API, file_type=UploadedFile.FileType.IMAGE, mime_type="image/png", uploader=self.uploader_user, size=100)
+            for index in range(existing, total)
+        ])
+
+    def measure(self, request):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        stats = StatCounter()
+        with CaptureQueriesContext(connection) as queries, mock.patch("os.stat", stats):
+            response = request()
+        self.assertLess(response.status_code, 400)
+        return [normalise_query(query["sql"]) for query in queries.captured_queries], stats.paths
+
+    def assertWithinBudget(self, view: str, request):
+        query_budget, stat_budget = VIEW_BUDGETS[view]
+        # Warm up the template and url caches so that only the view's own work is counted
+        request()
+        baseline = None
+        for size in QUERY_BUDGET_SIZES:
+            self.add_uploads(size)
+            queries, stats = self.measure(request)
+            if baseline is None:
+                baseline = (size, queries, stats)
+            base_size, base_queries, base_stats = baseline
+            with self.subTest(view=view, uploads=size):
+                self.assertLessEqual(len(queries), query_budget, f"{view} made {len(queries)} queries with {size} uploads, its budget is {query_budget}:\n{numbered(queries)}")
+                self.assertLessEqual(len(queries), len(base_queries), f"{view} made more queries with {size} uploads than with {base_size}:\n"
+                                     + growth_diff(base_queries, queries, f"{base_size} uploads", f"{size} uploads"))
+                self.assertLessEqual(len(stats), stat_budget, f"{view} made {len(stats)} filesystem stats with {size} uploads, its budget is {stat_budget}:\n{numbered(stats)}")
+                self.assertLessEqual(len(stats), len(base_stats), f"{view} made more filesystem stats with {size} uploads than with {base_size}:\n"
+                                     + growth_diff(base_stats, stats, f"{base_size} uploads", f"{size} uploads"))
+
+    def test_homepage_query_budget(self):
+        """
+        test that the homepage does not look up each featured file's uploader or state
+        """
+        from django.urls import reverse
+        self.assertWithinBudget("homepage", lambda: self.client.get(reverse("filehost:homepage")))
+
+    def test_list_uploads_query_budget(self):
+        """
+        test that listing a user's uploads makes the same queries however many files they have
+        """
+        from django.urls import reverse
+        self.client.force_login(self.uploader_user)
+        self.assertWithinBudget("list_uploads", lambda: self.client.get(reverse("filehost:list-uploads")))
+
+    def test_fetch_file_formatted_query_budget(self):
+        """
+        test that the formatted view of a file stays within its budget
+        """
+        from django.urls import reverse
+        self.client.force_login(self.uploader_user)
+        self.assertWithinBudget("fetch_file_formatted", lambda: self.client.get(reverse("filehost:fetch-file-formatted", kwargs={"slug": self.uploaded_file.slug})))
+
+    def test_handle_oembed_query_budget(self):
+        """
+        test that building an uncached oembed response stays within its budget
+        """
+        from django.urls import reverse
+        from filehost.oembed import CACHED_OEMBED_DICT
+
+        def request():
+            CACHED_OEMBED_DICT.pop(self.uploaded_file.slug, None)
+            return self.client.get(reverse("filehost:oembed"), {"url": f"https://testserver/{self.uploaded_file.slug}", "format": "json"})
+        self.assertWithinBudget("handle_oembed", request)
+
+    def test_handle_api_upload_query_budget(self):
+        """
+        test that an api upload, including its thumbnail, makes the same queries however many files have been uploaded
+        """
+        from django.urls import reverse
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        with open(TEST_FILE, "rb") as f:
+            content = f.read()
+        # Api keys are managed by i54m_apiuser, the key lookup is replaced by a key that accepts any secret
+        api_key = mock.Mock(active=True, api_user=self.uploader_user)
+        api_key.has_valid_api_secret.return_value = True
+
+        def request():
+            return self.client.post(reverse("filehost:api-upload"), {"file": SimpleUploadedFile("test.54m", content)}, HTTP_APP_ID="test", HTTP_API_SECRET="secret")
+        with mock.patch("filehost.views.ApiKey.objects.get", return_value=api_key):
+            self.assertWithinBudget("handle_api_upload", request)
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                         Thumbnail Sandbox Tests                                                    #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+def allocate(size):
+    return len(bytearray(size))
+
+def sleep_for(seconds):
+    time.sleep(seconds)
+
+class ThumbnailSandboxTests(SimpleTestCase):
+
+    def test_limits_stop_runaway_work(self):
+        """
+        test that the sandbox returns results and stops work that passes its memory or time limits without affecting this process
+        """
+        from filehost import sandbox
+        self.assertEqual(sandbox.run_limited(allocate, 1024, memory_limit=2 * 1024 ** 3, timeout=30), 1024)
+        with self.assertRaises(sandbox.SandboxError):
+            sandbox.run_limited(allocate, 8 * 1024 ** 3, memory_limit=2 * 1024 ** 3, timeout=30)
+        with self.assertRaises(sandbox.SandboxTimeout):
+            sandbox.run_limited(sleep_for, 30, timeout=1)
+
+    @override_settings(THUMBNAIL_MAX_IMAGE_PIXELS=1000)
+    def test_oversized_images_are_not_decoded(self):
+        """
+        test that images with more pixels than THUMBNAIL_MAX_IMAGE_PIXELS fail in the sandbox so that the placeholder is used
+        """
+        from filehost import sandbox, thumbnails
+        os.makedirs(TEST_MEDIA_ROOT, exist_ok=True)
+        destination = os.path.join(TEST_MEDIA_ROOT, "sandbox-test.jpeg")
+        with self.assertRaises(sandbox.SandboxError):
+            thumbnails.render_sandboxed(tasks.preview_manager(), "image/png", os.path.abspath(TEST_IMAGE), destination)
+        if os.path.exists(destination):
+            os.remove(destination)
+
+    def test_large_images_are_shrunk_before_preview(self):
+        """
+        test that preview_generator is given a copy of a large image reduced to PRESHRINK_SIZE, with its EXIF orientation applied, and never the original
+        """
+        import shutil
+        from PIL import Image
+        from filehost import thumbnails
+        directory = os.path.join(TEST_MEDIA_ROOT, "PreshrinkTests")
+        os.makedirs(directory, exist_ok=True)
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        source = os.path.join(directory, "large.jpg")
+        exif = Image.Exif()
+        exif[0x0112] = 6 # rotated 90 degrees
+        Image.new("RGB", (4000, 3000), (13, 110, 253)).save(source, exif=exif.tobytes())
+
+        previewed = []
+        def get_jpeg_preview(file_path, height, width):
+            with Image.open(file_path) as img:
+                previewed.append(img.size)
+                preview_path = os.path.join(directory, "preview.jpeg")
+                img.convert("RGB").save(preview_path)
+            return preview_path
+        manager = mock.Mock(get_jpeg_preview=mock.Mock(side_effect=get_jpeg_preview))
+
+        destination = os.path.join(directory, "large.jpg.jpeg")
+        stages = thumbnails.render_preview(manager, "image/jpeg", source, destination)
+        self.assertEqual(previewed, [(thumbnails.PRESHRINK_SIZE * 3 // 4, thumbnails.PRESHRINK_SIZE)])
+        self.assertNotEqual(manager.get_jpeg_preview.call_args.kwargs["file_path"], source)
+        self.assertIn("decode", stages)
+        with Image.open(destination) as thumbnail:
+            self.assertLessEqual(max(thumbnail.size), thumbnails.THUMBNAIL_SIZE)
+        self.assertEqual(sorted(os.listdir(directory)), ["large.jpg", "large.jpg.jpeg", "preview.jpeg"])
+
+        # Images that are already small are previewed as they are
+        previewed.clear()
+        small = os.path.join(directory, "small.png")
+        Image.new("RGB", (300, 200)).save(small)
+        thumbnails.render_preview(manager, "image/png", small, os.path.join(directory, "small.png.jpeg"))
+        self.assertEqual(manager.get_jpeg_preview.call_args.kwargs["file_path"], small)
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                              Waveform Tests                                                        #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class WaveformTests(SimpleTestCase):
+
+    def test_peaks_round_trip(self):
+        """
+        test that peaks are reduced to every resolution and that the closest resolution is read back in the audiowaveform layout
+        """
+        import numpy
+        samples = numpy.tile(numpy.array([-32768, 0, 32767, 0], dtype=numpy.int16), 10000)
+        peaks = waveforms.compute_peaks(samples)
+        self.assertEqual([len(interleaved) // 2 for samples_per_bucket, interleaved in peaks], [8000, 2000, 500])
+        self.assertEqual([samples_per_bucket for samples_per_bucket, interleaved in peaks], [5, 20, 80])
+
+        os.makedirs(TEST_MEDIA_ROOT, exist_ok=True)
+        path = os.path.join(TEST_MEDIA_ROOT, "waveform-test.peaks")
+        waveforms.write_peaks(path, len(samples), peaks)
+        waveform = waveforms.read_peaks(path, buckets=600)
+        self.assertEqual(waveform.length, 500)
+        self.assertEqual(waveform.as_json()["data"][:2], [-128, 127])
+        self.assertEqual(len(waveform.as_dat()), 20 + 500 * 2)
+        os.remove(path)
+        self.assertIsNone(waveforms.read_peaks(path))
+
+
+
+@override_settings(MEDIA_ROOT=os.path.join(TEST_MEDIA_ROOT, "WaveformViewTests"))
+class WaveformViewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        import numpy
+        create_test_apiusers(cls)
+        # Archived so that no local copies are needed, the peaks outlive archiving as they are kept with the thumbnail
+        rows = (
+            ("w0000001", UploadedFile.FileType.AUDIO, "mp3", UploadedFile.Access.PUBLIC),
+            ("w0000002", UploadedFile.FileType.AUDIO, "mp3", UploadedFile.Access.PRIVATE),
+            ("w0000003", UploadedFile.FileType.AUDIO, "mp3", UploadedFile.Access.MEMBERS_ONLY),
+            ("w0000004", UploadedFile.FileType.AUDIO, "mp3", UploadedFile.Access.PUBLIC),
+            ("w0000005", UploadedFile.FileType.TEXT, "txt", UploadedFile.Access.PUBLIC),
+        )
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug=slug, file=f"API/{file_type}/{slug}.{extension}", file_path=f"API/{file_type}/{slug}.{extension}", state=UploadedFile.State.ARCHIVED,
+                         expiration_date=timezone.localdate() + timezone.timedelta(days=1), upload_type=UploadedFile.UploadType.API, file_type=file_type,
+                         access=access, uploader=cls.uploader_user, size=100)
+            for slug, file_type, extension, access in rows
+        ])
+        # Every file but w0000004 has peaks, 40000 samples gives 8000, 2000 and 500 buckets
+        peaks = waveforms.compute_peaks(numpy.tile(numpy.array([-32768, 0, 32767, 0], dtype=numpy.int16), 10000))
+        for slug in ("w0000001", "w0000002", "w0000003", "w0000005"):
+            path = waveforms.peaks_path(UploadedFile.objects.get(slug=slug))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            waveforms.write_peaks(path, 40000, peaks)
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        shutil.rmtree(os.path.join(TEST_MEDIA_ROOT, "WaveformViewTests"), ignore_errors=True)
+        return super().tearDownClass()
+
+    def waveform_url(self, slug: str) -> str:
+        from django.urls import reverse
+        return reverse("filehost:fetch-file-waveform", kwargs={"slug": slug})
+
+    def test_waveform_json(self):
+        """
+        test that the default resolution is served in audiowaveform's JSON layout and ?buckets picks the closest stored resolution
+        """
+        waveform = self.client.get(self.waveform_url("w0000001")).json()
+        self.assertEqual((waveform["version"], waveform["length"], waveform["samples_per_pixel"]), (2, 2000, 20))
+        self.assertEqual(len(waveform["data"]), 4000)
+        self.assertEqual(self.client.get(self.waveform_url("w0000001"), {"buckets": 400}).json()["length"], 500)
+        self.assertEqual(self.client.get(self.waveform_url("w0000001"), {"buckets": 100000}).json()["length"], 8000)
+
+    def test_buckets_validated(self):
+        """
+        test that ?buckets must be a whole number of at least 1
+        """
+        for buckets in ("many", "2.5", "0", "-4"):
+            with self.subTest(buckets=buckets):
+                self.assertEqual(self.client.get(self.waveform_url("w0000001"), {"buckets": buckets}).status_code, 400)
+
+    def test_waveform_dat(self):
+        """
+        test that ?format=dat serves audiowaveform's binary layout, a 20 byte header then a min, max byte pair per bucket
+        """
+        import struct
+        response = self.client.get(self.waveform_url("w0000001"), {"format": "dat"})
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        self.assertEqual(len(response.content), 20 + 2000 * 2)
+        self.assertEqual(struct.unpack("<iIiiI", response.content[:20]), (1, 1, waveforms.WAVEFORM_SAMPLE_RATE, 20, 2000))
+        self.assertEqual(struct.unpack("<2b", response.content[20:22]), (-128, 127))
+
+    def test_no_waveform_not_found(self):
+        """
+        test that files that are not audio, or have no peaks, are answered with 404
+        """
+        self.assertEqual(self.client.get(self.waveform_url("w0000005")).status_code, 404)
+        self.assertEqual(self.client.get(self.waveform_url("w0000004")).status_code, 404)
+        self.assertEqual(self.client.get(self.waveform_url("w9999999")).status_code, 404)
+
+    def test_access_checks(self):
+        """
+        test that the waveform of a private or members only file is only served to those allowed to see the file
+        """
+        for slug in ("w0000002", "w0000003"):
+            response = self.client.get(self.waveform_url(slug))
+            self.assertRedirects(response, f"{settings.LOGIN_URL}?next={self.waveform_url(slug)}", fetch_redirect_response=False)
+
+        self.client.force_login(self.other_user)
+        self.assertNotEqual(self.client.get(self.waveform_url("w0000002")).status_code, 200)
+        self.assertEqual(self.client.get(self.waveform_url("w0000003")).status_code, 200)
+
+        self.client.force_login(self.uploader_user)
+        self.assertEqual(self.client.get(self.waveform_url("w0000002")).status_code, 200)
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                           HLS Rendition Tests                                                      #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+class RenditionTests(SimpleTestCase):
+
+    def test_ladder_never_upscales(self):
+        """
+        test that only rungs no taller than the original are made and that short videos get a single rung at an even height
+        """
+        self.assertEqual([rung[0] for rung in renditions.ladder_for(720)], ["720p", "480p", "360p"])
+        self.assertEqual([rung[0] for rung in renditions.ladder_for(2160)], list(renditions.HLS_LADDER.keys()))
+        self.assertEqual([rung[:2] for rung in renditions.ladder_for(241)], [("240p", 240)])
+
+        arguments = renditions.transcode_arguments("in.mp4", "out", renditions.ladder_for(480), has_audio=True)
+        self.assertEqual(arguments[arguments.index("-var_stream_map") + 1], "v:0,a:0,name:480p v:1,a:1,name:360p")
+        arguments = renditions.transcode_arguments("in.mp4", "out", renditions.ladder_for(480), has_audio=False)
+        self.assertEqual(arguments[arguments.index("-var_stream_map") + 1], "v:0,name:480p v:1,name:360p")
+        self.assertNotIn("0:a:0", arguments)
+
+    @override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+    def test_rendition_files_stay_inside_the_ladder(self):
+        """
+        test that players can only fetch the playlists and segments of a ladder and that the ladder is removed with the original
+        """
+        uploaded_file = UploadedFile(file_path="API/VIDEO/hlstest1.mp4", file_type=UploadedFile.FileType.VIDEO)
+        directory = renditions.renditions_directory(uploaded_file)
+        os.makedirs(os.path.join(directory, "360p"), exist_ok=True)
+        for name in (renditions.MASTER_PLAYLIST, "360p/index.m3u8", "360p/segment0000.ts", "notes.txt"):
+            open(os.path.join(directory, name), "w").close()
+
+        self.assertTrue(renditions.has_renditions(uploaded_file))
+        self.assertEqual(renditions.rendition_file(uploaded_file, "360p/segment0000.ts")[1], "video/mp2t")
+        self.assertEqual(renditions.rendition_file(uploaded_file, renditions.MASTER_PLAYLIST)[1], "application/vnd.apple.mpegurl")
+        for name in ("notes.txt", "../hlstest1.mp4", "../../VIDEO/hlstest1.mp4.hls/../hlstest1.ts", "360p/missing.ts"):
+            self.assertEqual(renditions.rendition_file(uploaded_file, name), (None, None))
+
+        renditions.delete_renditions(uploaded_file)
+        self.assertFalse(os.path.exists(directory))
+
+
+
+@override_settings(MEDIA_ROOT=os.path.join(TEST_MEDIA_ROOT, "RenditionViewTests"), HLS_RENDITIONS=True)
+class RenditionViewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_test_apiusers(cls)
+        rows = (("h0000001", UploadedFile.Access.PRIVATE), ("h0000002", UploadedFile.Access.MEMBERS_ONLY), ("h0000003", UploadedFile.Access.PUBLIC))
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug=slug, file=f"API/VIDEO/{slug}.mp4", file_path=f"API/VIDEO/{slug}.mp4", expiration_date=timezone.localdate() + timezone.timedelta(days=1),
+                         upload_type=UploadedFile.UploadType.API, file_type=UploadedFile.FileType.VIDEO, mime_type="video/mp4",
+                         access=access, uploader=cls.uploader_user, size=5)
+            for slug, access in rows
+        ])
+        # The originals only need to exist, the ladders are a master playlist and one segment
+        for slug, access in rows:
+            uploaded_file = UploadedFile.objects.get(slug=slug)
+            directory = renditions.renditions_directory(uploaded_file)
+            os.makedirs(os.path.join(directory, "360p"), exist_ok=True)
+            with open(os.path.join(settings.MEDIA_ROOT, uploaded_file.file_path), "wb") as f:
+                f.write(b"video")
+            with open(os.path.join(directory, renditions.MASTER_PLAYLIST), "w") as f:
+                f.write("#EXTM3U\n360p/index.m3u8\n")
+            with open(os.path.join(directory, "360p", "segment0000.ts"), "wb") as f:
+                f.write(b"\x47" * 188)
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        shutil.rmtree(os.path.join(TEST_MEDIA_ROOT, "RenditionViewTests"), ignore_errors=True)
+        return super().tearDownClass()
+
+    def ladder_urls(self, slug: str):
+        from django.urls import reverse
+        return [reverse("filehost:fetch-file-hls", kwargs={"slug": slug, "name": name}) for name in (renditions.MASTER_PLAYLIST, "360p/segment0000.ts")]
+
+    def test_access_checks_apply_to_playlists_and_segments(self):
+        """
+        test that the playlists and segments of a private or members only video are only served to those allowed to see the video
+        """
+        for slug in ("h0000001", "h0000002"):
+            for url in self.ladder_urls(slug):
+                self.assertRedirects(self.client.get(url), f"{settings.LOGIN_URL}?next={url}", fetch_redirect_response=False)
+
+        self.client.force_login(self.other_user)
+        for url in self.ladder_urls("h0000001"):
+            self.assertNotEqual(self.client.get(url).status_code, 200)
+        for url in self.ladder_urls("h0000002"):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.client.force_login(self.uploader_user)
+        master, segment = self.ladder_urls("h0000001")
+        response = self.client.get(master)
+        self.assertEqual((response.status_code, response["Content-Type"]), (200, "application/vnd.apple.mpegurl"))
+        response = self.client.get(segment)
+        self.assertEqual((response.status_code, response["Content-Type"]), (200, "video/mp2t"))
+        self.assertEqual(b"".join(response.streaming_content), b"\x47" * 188)
+
+    def test_player_script_pinned_by_integrity(self):
+        """
+        test that hls.js is only loaded with its Subresource Integrity hash, and not at all while no hash is configured
+        """
+        from django.urls import reverse
+        url = reverse("filehost:fetch-file-formatted", kwargs={"slug": "h0000003"})
+        with override_settings(HLS_JS_INTEGRITY="sha384-pinned"):
+            content = self.client.get(url).content.decode()
+        self.assertIn(f'src="{settings.HLS_JS_URL}" integrity="sha384-pinned" crossorigin="anonymous"', content)
+        with override_settings(HLS_JS_INTEGRITY=""):
+            content = self.client.get(url).content.decode()
+        self.assertIn('data-hls="', content)
+        self.assertNotIn(settings.HLS_JS_URL, content)
+
+    def make_unrendered_video(self) -> UploadedFile:
+        UploadedFile.objects.bulk_create([
+            UploadedFile(slug="h0000004", file="API/VIDEO/h0000004.mp4", file_path="API/VIDEO/h0000004.mp4", expiration_date=timezone.localdate() + timezone.timedelta(days=1),
+                         upload_type=UploadedFile.UploadType.API, file_type=UploadedFile.FileType.VIDEO, mime_type="video/mp4", uploader=self.uploader_user, size=5)
+        ])
+        with open(os.path.join(settings.MEDIA_ROOT, "API", "VIDEO", "h0000004.mp4"), "wb") as f:
+            f.write(b"video")
+        uploaded_file = UploadedFile.objects.get(slug="h0000004")
+        self.addCleanup(renditions.delete_renditions, uploaded_file)
+        return uploaded_file
+
+    def test_pending_marker_outlives_a_transcode(self):
+        """
+        test that a ladder is not queued again while its transcode could still be running, only once the marker is older than HLS_TIMEOUT
+        """
+        from filehost import negotiation
+        uploaded_file = self.make_unrendered_video()
+        pending_path = f"{renditions.renditions_directory(uploaded_file)}.pending"
+        with mock.patch.object(tasks.create_hls_renditions, "delay") as delay:
+            self.assertFalse(renditions.request_renditions(uploaded_file))
+            self.assertEqual(delay.call_count, 1)
+
+            aged = time.time() - negotiation.PENDING_TIMEOUT - 60
+            os.utime(pending_path, (aged, aged))
+            renditions.request_renditions(uploaded_file)
+            self.assertEqual(delay.call_count, 1)
+
+            aged = time.time() - settings.HLS_TIMEOUT - negotiation.PENDING_TIMEOUT - 60
+            os.utime(pending_path, (aged, aged))
+            renditions.request_renditions(uploaded_file)
+            self.assertEqual(delay.call_count, 2)
+
+    def test_transcode_attempts_use_their_own_directory(self):
+        """
+        test that each transcode writes to its own temporary directory and only removes that one, so a duplicate task cannot pull a ladder out from under another
+        """
+        uploaded_file = self.make_unrendered_video()
+        directory = renditions.renditions_directory(uploaded_file)
+        other_attempt = f"{directory}.tmp-other"
+        os.makedirs(other_attempt)
+        used = []
+
+        def transcode(source_path, output_directory):
+            used.append(output_directory)
+            os.makedirs(output_directory)
+            with open(os.path.join(output_directory, renditions.MASTER_PLAYLIST), "w") as f:
+                f.write("#EXTM3U\n")
+            return {"renditions": ["360p"], "timings": {"probe": 0.0, "transcode": 0.0}}
+
+        with mock.patch.object(renditions, "transcode_sandboxed", side_effect=transcode):
+            self.assertTrue(tasks.create_hls_renditions("h0000004"))
+        self.assertTrue(used[0].startswith(f"{directory}.tmp-") and used[0] != other_attempt)
+        self.assertFalse(os.path.exists(used[0]))
+        self.assertTrue(renditions.has_renditions(uploaded_file))
+        self.assertTrue(os.path.isdir(other_attempt))
+
+        # Archiving or deleting the original removes every attempt along with the ladder
+        renditions.delete_renditions(uploaded_file)
+        self.assertFalse(os.path.exists(directory))
+        self.assertFalse(os.path.exists(other_attempt))
+
+
+
+
+
+
+
+
+
+
+
+######################################################################################################################
+# ------------------------------------------------------------------------------------------------------------------ #
+#                                           Import Budget Tests                                                      #
+# ------------------------------------------------------------------------------------------------------------------ #
+######################################################################################################################
+
+# Modules that are only needed by tasks and must not be loaded by a web worker before it serves its first request
+WEB_EXCLUDED_MODULES = ["paramiko", "PIL", "preview_generator", "ffmpeg", "numpy", "zstandard", "wand", "cairosvg"]
+# Longest time (seconds) a web worker may take to load the wsgi application and url conf. The time depends on the machine so it is only
+# checked when a budget has been set from a baseline measured on the same machine, eg: LFS_WEB_IMPORT_BUDGET=1.5
+WEB_IMPORT_BUDGET = os.environ.get("LFS_WEB_IMPORT_BUDGET")
+
+# Run in a fresh interpreter so that nothing the test runner has already imported is counted
+WEB_IMPORT_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'LFS.settings')
+from django.core.wsgi import get_wsgi_application
+from django.conf import settings
+from importlib import import_module
+get_wsgi_application()
+import_module(settings.ROOT_URLCONF)
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": sorted(set(name.split('.')[0] for name in sys.modules))}))
+"""
+
+class ImportBudgetTests(SimpleTestCase):
+
+    def test_web_worker_cold_start(self):
+        """
+        test that loading the web application does not import the thumbnailing or NAS toolchains, and stays within its time budget when one is set
+        """
+        import subprocess, sys, json
+        result = subprocess.run([sys.executable, "-c", WEB_IMPORT_SCRIPT], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True)
+        measured = json.loads(result.stdout.strip().splitlines()[-1])
+        for module in WEB_EXCLUDED_MODULES:
+            self.assertNotIn(module, measured["modules"])
+        if WEB_IMPORT_BUDGET is not None:
+            self.assertLess(measured["seconds"], float(WEB_IMPORT_BUDGET), f"Web worker cold start took {measured['seconds']:.3f}s, its budget is {WEB_IMPORT_BUDGET}s")
@@ -0,0 +1,97 @@
+from django.conf import settings
+from filehost.models import UploadedFile
+from filehost import sandbox
+import os, shutil, time
+
+# Thumbnail previews are rendered in a sandboxed child process (see filehost/sandbox.py) limited by THUMBNAIL_MEMORY_LIMIT,
+# THUMBNAIL_CPU_LIMIT and THUMBNAIL_TIMEOUT. Files that fail or hit a limit get the SVG placeholder instead (see tasks.create_thumbnail).
+
+# Thumbnails fit within a square of this many pixels
+THUMBNAIL_SIZE = 512
+# Raster images decoded by Pillow are reduced to fit within this before preview_generator sees them, leaving enough detail for the final resize
+PRESHRINK_SIZE = THUMBNAIL_SIZE * 2
+PRESHRINK_MIMETYPES = ["image/jpeg", "image/png", "image/webp", "image/bmp", "image/x-ms-bmp", "image/tiff"]
+
+
+def shrink_image(path: str):
+    '''
+        Resizes the image at path in place so that it fits within THUMBNAIL_SIZE, decoding as little of it as possible
+    '''
+    from PIL import Image
+    with Image.open(path) as img:
+        # Let the decoder drop detail that would be thrown away anyway (JPEGs are decoded at 1/2, 1/4 or 1/8 scale)
+        img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        if img.width > THUMBNAIL_SIZE or img.height > THUMBNAIL_SIZE:
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), reducing_gap=2.0)
+        # Save the thumbnail image regardless of whether we resized it or not as we still opened the image file
+        img.save(path)
+
+def preshrink_image(source_path: str, destination_path: str):
+    '''
+        Decodes a large raster image at reduced scale and writes a copy that fits within PRESHRINK_SIZE next to destination_path,
+        so that preview_generator never decodes or resizes the full size original.\n
+        returns: the path of the reduced copy, or None if the image is already small enough to be previewed as it is
+    '''
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as img:
+        if img.width <= PRESHRINK_SIZE and img.height <= PRESHRINK_SIZE:
+            return None
+        # JPEGs are decoded at 1/2, 1/4 or 1/8 scale, the rest are reduced by whole factors while resizing
+        img.draft("RGB", (PRESHRINK_SIZE, PRESHRINK_SIZE))
+        # The copy has no EXIF so the orientation is applied to the pixels
+        reduced = ImageOps.exif_transpose(img)
+        reduced.thumbnail((PRESHRINK_SIZE, PRESHRINK_SIZE), reducing_gap=2.0)
+        if reduced.mode not in ("RGB", "RGBA", "L", "LA"):
+            reduced = reduced.convert("RGBA" if "A" in reduced.getbands() or "transparency" in reduced.info else "RGB")
+        reduced_path = f"{destination_path}.source.png"
+        reduced.save(reduced_path, format="PNG", compress_level=1)
+    return reduced_path
+
+def render_preview(manager, mime_type: str, source_path: str, destination_path: str) -> dict:
+    '''
+        Runs inside the sandbox. Creates a JPEG preview with preview_generator, copies it to destination_path and shrinks it to THUMBNAIL_SIZE.\n
+        Large raster images are reduced first, see preshrink_image.\n
+        returns: the seconds spent in each stage
+    '''
+    from PIL import Image
+    import warnings
+    # Images over the limit raise rather than warn so that decompression bombs get the placeholder
+    Image.MAX_IMAGE_PIXELS = settings.THUMBNAIL_MAX_IMAGE_PIXELS
+    warnings.simplefilter("error", Image.DecompressionBombWarning)
+    timings = {}
+
+    reduced_path = None
+    try:
+        if mime_type in PRESHRINK_MIMETYPES:
+            start = time.perf_counter()
+            reduced_path = preshrink_image(source_path, destination_path)
+            timings["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if mime_type in UploadedFile.FileType.SUPPORTED_ARCHIVE_MIMETYPES:
+            # Archives are previewed as a JPEG of their text preview (the list of files they contain)
+            archive_text_preview = manager.get_text_preview(file_path=source_path)
+            preview_path = manager.get_jpeg_preview(file_path=archive_text_preview, height=THUMBNAIL_SIZE, width=THUMBNAIL_SIZE)
+        else:
+            preview_path = manager.get_jpeg_preview(file_path=reduced_path or source_path, height=THUMBNAIL_SIZE, width=THUMBNAIL_SIZE)
+        timings["preview"] = time.perf_counter() - start
+    finally:
+        if reduced_path is not None and os.path.isfile(reduced_path):
+            os.remove(reduced_path)
+
+    start = time.perf_counter()
+    shutil.copy2(preview_path, destination_path)
+    timings["copy"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    shrink_image(destination_path)
+    timings["resize"] = time.perf_counter() - start
+    return timings
+
+def render_sandboxed(manager, mime_type: str, source_path: str, destination_path: str) -> dict:
+    '''
+        Renders the preview of source_path to destination_path in a sandboxed child process.\n
+        returns: the seconds spent in each stage, raises sandbox.SandboxError if rendering failed or passed a limit
+    '''
+    return sandbox.run_limited(render_preview, manager, mime_type, source_path, destination_path,
+                               memory_limit=settings.THUMBNAIL_MEMORY_LIMIT, cpu_limit=settings.THUMBNAIL_CPU_LIMIT, timeout=settings.THUMBNAIL_TIMEOUT)
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from . import views
+from . import views, metrics, profiling
 
 app_name = "filehost"
 
@@ -11,6 +11,7 @@ urlpatterns = [
     path("uploads/", views.list_uploads, name="list-uploads"),
     path("uploads/<slug:slug>/delete/", views.DeleteUploadClass.as_view(), name="delete-upload"),
     path("uploads/<slug:slug>/update/", views.UpdateUploadClass.as_view(), name="update-upload"),
+    path("usage/", views.storage_usage, name="storage-usage"),
     # TODO Archive/Localise upload view?
 
     
@@ -22,6 +23,10 @@ urlpatterns = [
     ##### Oembed Integration #####
     path("oembed", views.handle_oembed, name="oembed"),
 
+    ##### Monitoring #####
+    path("metrics", metrics.scrape, name="metrics"),
+    path("profiles/<str:name>", profiling.download_report, name="profile-report"),
+
     #####  Fetching Files  #####
     path("<slug:slug>/", views.fetch_file, name="fetch-file"),
     path("<slug:slug>/v/", views.fetch_file_formatted, name="fetch-file-formatted"),
@@ -30,6 +35,9 @@ urlpatterns = [
     path("<slug:slug>/dl-raw/", views.download_file_raw, name="download-file-raw"),
     path("<slug:slug>/raw/", views.fetch_file_raw, name="fetch-file-raw"),
     path("<slug:slug>/thmb/", views.fetch_file_thumbnail, name="fetch-file-thumbnail"),
+    path("<slug:slug>/waveform/", views.fetch_file_waveform, name="fetch-file-waveform"),
+    path("<slug:slug>/hls/<path:name>", views.fetch_file_hls, name="fetch-file-hls"),
+    path("<slug:slug>/status/", views.fetch_file_status, name="fetch-file-status"),
 
 
 ]
\ No newline at end of file
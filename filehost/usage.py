@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, Count
+from filehost.models import UploadedFile, StorageUsage, UserQuota
+from i54m_apiuser.models import ApiUser
+import os
+
+# Storage usage is read from the StorageUsage counters, which are kept up to date as files are saved and deleted,
+# so none of these reports need to stat files or scan the uploaded files table.
+
+# Uploaded files are backfilled and counters rebuilt this many at a time when recalculating
+RECALCULATE_BATCH_SIZE = 1000
+
+
+def rollup(counters, field: str) -> dict:
+    '''
+        Totals the counters grouped by one of the key fields, eg: file_type -> {"files": 10, "bytes": 1024}
+    '''
+    return {row[field]: {"files": row['total_files'] or 0, "bytes": row['total_bytes'] or 0} for row in counters.values(field).annotate(total_files=Sum('files'), total_bytes=Sum('bytes')).order_by(field)}
+
+def totals(counters) -> dict:
+    total = counters.aggregate(total_files=Sum('files'), total_bytes=Sum('bytes'))
+    return {"files": total['total_files'] or 0, "bytes": total['total_bytes'] or 0}
+
+def summary(counters) -> dict:
+    return {
+        "total": totals(counters),
+        "by_state": rollup(counters, 'state'),
+        "by_file_type": rollup(counters, 'file_type'),
+        "by_upload_type": rollup(counters, 'upload_type'),
+    }
+
+def site_summary() -> dict:
+    site = summary(StorageUsage.objects.all())
+    site["by_uploader"] = rollup(StorageUsage.objects.all(), 'uploader__username')
+    return site
+
+def user_summary(user: ApiUser) -> dict:
+    usage = summary(StorageUsage.objects.filter(uploader=user))
+    quota = UserQuota.objects.filter(uploader=user).first()
+    usage["quota"] = {"max_bytes": quota.max_bytes, "max_files": quota.max_files} if quota is not None else None
+    return usage
+
+def check_quota(user: ApiUser, size: int):
+    '''
+        Checks whether the user can upload another file of the given size.\n
+        returns: None if the upload is allowed, otherwise a message explaining which limit it would go over
+    '''
+    quota = UserQuota.objects.filter(uploader=user).first()
+    if quota is None:
+        return None
+    used = totals(StorageUsage.objects.filter(uploader=user))
+    if quota.max_files is not None and used["files"] + 1 > quota.max_files:
+        return f"You have reached your limit of {quota.max_files} stored files, delete some of your uploads and try again."
+    if quota.max_bytes is not None and used["bytes"] + size > quota.max_bytes:
+        return f"This upload would take you over your storage limit of {quota.max_bytes} bytes, you are currently using {used['bytes']} bytes."
+    return None
+
+def recalculate() -> dict:
+    '''
+        Backfills the size of local files uploaded before sizes were recorded then rebuilds every counter from the uploaded files table.\n
+        Sizes of archived files uploaded before then cannot be recovered without de-archiving them so they are counted as 0 bytes
+    '''
+    backfilled = []
+    for uploaded_file in UploadedFile.objects.filter(size=0, state=UploadedFile.State.LOCAL).only('slug', 'file_path').iterator(chunk_size=RECALCULATE_BATCH_SIZE):
+        try:
+            uploaded_file.size = os.path.getsize(os.path.join(settings.MEDIA_ROOT, uploaded_file.file_path))
+        except OSError:
+            continue
+        backfilled.append(uploaded_file)
+        if len(backfilled) >= RECALCULATE_BATCH_SIZE:
+            UploadedFile.objects.bulk_update(backfilled, ['size'])
+            backfilled = []
+    UploadedFile.objects.bulk_update(backfilled, ['size'])
+
+    with transaction.atomic():
+        # Lock the counters so that saves made while rebuilding wait and are then applied to the rebuilt counters
+        list(StorageUsage.objects.select_for_update().values_list('pk', flat=True))
+        rows = UploadedFile.objects.values('uploader', 'file_type', 'upload_type', 'state').annotate(total_files=Count('pk'), total_bytes=Sum('size')).order_by()
+        counters = [StorageUsage(uploader_id=row['uploader'], file_type=row['file_type'], upload_type=row['upload_type'], state=row['state'], files=row['total_files'], bytes=row['total_bytes'] or 0) for row in rows]
+        StorageUsage.objects.all().delete()
+        StorageUsage.objects.bulk_create(counters, batch_size=RECALCULATE_BATCH_SIZE)
+    return {"counters": len(counters), "total": totals(StorageUsage.objects.all())}
@@ -4,23 +4,25 @@ from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.http import  JsonResponse, HttpResponse, FileResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotAllowed, HttpRequest, HttpResponseForbidden
+from django.http import  JsonResponse, HttpResponse, FileResponse, StreamingHttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseNotAllowed, HttpRequest, HttpResponseForbidden
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
+from django.utils.cache import patch_vary_headers
 from .models import UploadedFile
 from .forms import UploadedFileForm
-from filehost import tasks, oembed
+from filehost import tasks, oembed, negotiation, readthrough, usage, metrics, waveforms, renditions
 from i54m_apiuser.models import ApiKey, ApiUser
-import os
+import os, json, time
 
 from django.views.generic import DeleteView, UpdateView
 
 ##### Home/Landing Page #####
 def homepage(request: HttpRequest):
-    recent_image_uploads = UploadedFile.objects.filter(featured=True, state=UploadedFile.State.LOCAL, file_type=UploadedFile.FileType.IMAGE, access=UploadedFile.Access.PUBLIC).order_by('-uploaded_at')[:10]
+    recent_image_uploads = UploadedFile.objects.filter(featured=True, state=UploadedFile.State.LOCAL, file_type=UploadedFile.FileType.IMAGE, access=UploadedFile.Access.PUBLIC).select_related('uploader').order_by('-uploaded_at')[:10]
     return render(request=request, template_name="filehost/index.html", context={'recent_image_uploads': recent_image_uploads,}) # 200 OK
 
 ##### Fetch Uploaded File or 404 #####
+@metrics.timed("check_uploaded_file")
 def check_uploaded_file(slug: str, request: HttpRequest, localise=True, display_messages=True):
     '''
         Attempts to fetch the uploaded file and performs various checks needed before returning the file.\n
@@ -40,7 +42,8 @@ def check_uploaded_file(slug: str, request: HttpRequest, localise=True, display_
         case UploadedFile.State.ARCHIVED:
             if localise:
                 # File is Archived, we will need to fetch it before serving the file, in the mean time the thumbnail will be shown
-                tasks.localise_file.delay(uploadedfile.slug)
+                # Only the first request claims the file and queues the de-archive, later requests see it moving
+                uploadedfile.request_localisation()
                 if display_messages:
                     messages.warning(request, "This file is archived and is now being de-archived for viewing, please try again shortly for the full version.")
             elif display_messages:
@@ -50,15 +53,16 @@ def check_uploaded_file(slug: str, request: HttpRequest, localise=True, display_
         case UploadedFile.State.LOCAL:
             if not os.path.exists(uploadedfile.file.path):
                 # File is local check it actually exists before continuing
-                # Actual file no longer exists, remove persistence and delete model then return Not found response (check failed)
-                uploadedfile.persistent = False
-                uploadedfile.save()
-                uploadedfile.delete()
+                # Actual file no longer exists, delete the model in the background then return Not found response (check failed)
+                uploadedfile.mark_for_deletion()
                 # Indicate file deletion as the check failed
                 return HttpResponseNotFound("We don't have that file anymore. It may have been moved or deleted! We have removed all traces of it from our system so it will now have to be reuploaded!"), None # 404 Not Found
         
         case UploadedFile.State.MOVING:
             # File is currently being moved (either to or from Archives) and we will not be able to show the full version
+            if localise:
+                # Takes over the move if it has been running for so long that whatever was moving the file must have died
+                uploadedfile.request_localisation()
             if display_messages:
                     messages.warning(request, "This file is archived and is currently being moved, please try again shortly for the full version.")
 
@@ -76,7 +80,7 @@ def check_uploaded_file(slug: str, request: HttpRequest, localise=True, display_
         return None, uploadedfile
     
     if uploadedfile.access == UploadedFile.Access.PRIVATE:
-        if user == uploadedfile.uploader:
+        if user.pk == uploadedfile.uploader_id:
             # File is private, user is the uploader of the file, return the uploadedfile object
             return None, uploadedfile
         elif user.is_superuser:
@@ -106,6 +110,12 @@ class DeleteUploadClass(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     def get_success_url(self):
         messages.success(self.request, f"Successfully deleted: {self.object.slug}")
         return reverse('filehost:list-uploads')
+
+    def form_valid(self, form):
+        # Deleting only marks the file, it is hidden straight away and its stored files are removed by the reaper, see filehost/deletion.py
+        success_url = self.get_success_url()
+        self.object.mark_for_deletion()
+        return redirect(success_url)
     
     def test_func(self):
         return self.get_object().can_be_managed_by(self.request.user)
@@ -137,12 +147,29 @@ class UpdateUploadClass(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
         return super().dispatch(request, *args, **kwargs)
 
 
+@login_required
+def storage_usage(request: HttpRequest):
+    '''
+        Storage used by the logged in user, superusers can see another user's usage with ?user=<username> or the whole site with ?all=true
+    '''
+    if request.user.is_superuser and request.GET.get('all', '').lower() == 'true':
+        return JsonResponse(usage.site_summary()) # 200 OK
+    user = request.user
+    if request.user.is_superuser and request.GET.get('user'):
+        try:
+            user = ApiUser.objects.get(username=request.GET.get('user'))
+        except ObjectDoesNotExist:
+            return HttpResponseNotFound("That user does not exist!") # 404 Not Found
+    return JsonResponse(usage.user_summary(user)) # 200 OK
+
+
 ##################################################
 #                File Uploading                  #
 ##################################################
 
 
 @csrf_exempt
+@metrics.timed("handle_api_upload")
 def handle_api_upload(request: HttpRequest):
     if request.method != 'POST':
         return JsonResponse({
@@ -214,6 +241,14 @@ def handle_api_upload(request: HttpRequest):
     
     file = request.FILES.get('uploaded_file') or request.FILES.get('file')
     if file:
+        quota_error = usage.check_quota(user, file.size)
+        if quota_error is not None:
+            return JsonResponse({
+                "status": 507,
+                "data": {
+                    "error": f'507 - Insufficient Storage. {quota_error}',
+                }
+            }, status=507) # 507 Insufficient Storage
         try:
             # Get persistent and featured flags from headers or post data or to none when not provided
             persistent = str.lower(request.META.get('HTTP_PERSISTENT') or request.POST.get('persistent') or "none")
@@ -303,6 +338,10 @@ def handle_manual_upload(request: HttpRequest):
     # Handle manual file upload
     if request.method == 'POST':
         form = UploadedFileForm(request.POST, request.FILES)
+        quota_error = usage.check_quota(user, request.FILES['file'].size) if form.is_valid() else None
+        if quota_error is not None:
+            messages.error(request, quota_error)
+            return render(request=request, template_name="filehost/manual_upload.html", context={'form': form, }) # 200 OK
         if form.is_valid():
             uploaded_file = UploadedFile(file=request.FILES['file'], upload_type=UploadedFile.UploadType.MANUAL, uploader=user)
             if form.data.get('expiration'):
@@ -337,6 +376,7 @@ def handle_manual_upload(request: HttpRequest):
 ##################################################
 
 
+@metrics.timed("fetch_file")
 def fetch_file(request: HttpRequest, slug):
     # Redirects to formatted view, this helps to make link shorter but also add the /v/ on the end for viewing
 
@@ -362,6 +402,13 @@ def fetch_file_formatted(request: HttpRequest, slug):
         if uploaded_file.file.size >= 512000:
             messages.warning(request, "This file is larger than 5MB. The preview has been limited.")
         context['text_file_lines'] = lines
+    if uploaded_file.file_type == UploadedFile.FileType.VIDEO and renditions.request_renditions(uploaded_file):
+        # The player streams the HLS ladder once it has been made, until then it plays the original
+        context['hls_url'] = reverse('filehost:fetch-file-hls', kwargs={'slug': slug, 'name': renditions.MASTER_PLAYLIST})
+        if settings.HLS_JS_INTEGRITY:
+            # hls.js is only loaded from the CDN when the browser can check it against its pinned hash
+            context['hls_js_url'] = settings.HLS_JS_URL
+            context['hls_js_integrity'] = settings.HLS_JS_INTEGRITY
     if uploaded_file.can_be_managed_by(request.user):
         context['authorized'] = True
     else:
@@ -389,20 +436,38 @@ def fetch_file_download(request: HttpRequest, slug):
         context['text_file_lines'] = lines
     return render(request=request, template_name="filehost/download.html", context=context) # 200 OK
 
+@metrics.timed("download_file_raw")
 def download_file_raw(request: HttpRequest, slug):
-    status, uploaded_file = check_uploaded_file(slug, request)
+    status, uploaded_file = check_uploaded_file(slug, request, localise=not settings.READ_THROUGH_ARCHIVE, display_messages=not settings.READ_THROUGH_ARCHIVE)
     if status is not None:
         return status
+    if settings.READ_THROUGH_ARCHIVE and uploaded_file.state != UploadedFile.State.LOCAL:
+        # Stream the file from the archive while it is de-archived rather than making the client try again later
+        return readthrough.serve_archived_file(uploaded_file, as_attachment=True)
     return FileResponse(open(uploaded_file.file.path, "rb"), as_attachment=True) # 200 OK
 
 
 
+@metrics.timed("fetch_file_raw")
 def fetch_file_raw(request: HttpRequest, slug):
-    status, uploaded_file = check_uploaded_file(slug, request, display_messages=False)
+    status, uploaded_file = check_uploaded_file(slug, request, localise=not settings.READ_THROUGH_ARCHIVE, display_messages=False)
     if status is not None:
         return status
+    if settings.READ_THROUGH_ARCHIVE and uploaded_file.state != UploadedFile.State.LOCAL:
+        # Stream the file from the archive while it is de-archived rather than making the client try again later
+        return readthrough.serve_archived_file(uploaded_file, as_attachment=False)
+    if settings.NEGOTIATE_IMAGE_FORMATS and uploaded_file.mime_type in negotiation.SOURCE_MIMETYPES:
+        # Serve the best image format the client accepts, the original is served until the variant has been created
+        variant_path, variant_mime_type = negotiation.negotiated_variant(request, uploaded_file)
+        if variant_path is not None:
+            response = FileResponse(open(variant_path, "rb"), as_attachment=False, content_type=variant_mime_type) # 200 OK
+        else:
+            response = FileResponse(open(uploaded_file.file.path, "rb"), as_attachment=False) # 200 OK
+        patch_vary_headers(response, ('Accept',))
+        return response
     return FileResponse(open(uploaded_file.file.path, "rb"), as_attachment=False) # 200 OK
 
+@metrics.timed("fetch_file_thumbnail")
 def fetch_file_thumbnail(request: HttpRequest, slug):
     status, uploaded_file = check_uploaded_file(slug, request, localise=False, display_messages=False)
     if status is not None:
@@ -412,12 +477,134 @@ def fetch_file_thumbnail(request: HttpRequest, slug):
     else:
         return HttpResponseNotFound("This Uploaded File does not have a thumbnail associated with it!") # 302 Found
 
+@metrics.timed("fetch_file_waveform")
+def fetch_file_waveform(request: HttpRequest, slug):
+    '''
+        Serves the precomputed waveform peaks of an audio file, archived files included as the peaks are kept with the thumbnail.\n
+        ?buckets= picks the stored resolution closest to that many buckets, ?format=dat returns audiowaveform's binary layout rather than JSON
+    '''
+    status, uploaded_file = check_uploaded_file(slug, request, localise=False, display_messages=False)
+    if status is not None:
+        return status
+    try:
+        buckets = int(request.GET.get("buckets", waveforms.DEFAULT_WAVEFORM_BUCKETS))
+    except ValueError:
+        return HttpResponseBadRequest("buckets must be a whole number!") # 400 Bad Request
+    if buckets < 1:
+        return HttpResponseBadRequest("buckets must be at least 1!") # 400 Bad Request
+
+    waveform = None
+    if uploaded_file.file_type == UploadedFile.FileType.AUDIO:
+        waveform = waveforms.read_peaks(waveforms.peaks_path(uploaded_file), buckets)
+    if waveform is None:
+        return HttpResponseNotFound("This Uploaded File does not have a waveform associated with it!") # 404 Not Found
+    if request.GET.get("format") == "dat":
+        return HttpResponse(waveform.as_dat(), content_type="application/octet-stream") # 200 OK
+    return JsonResponse(waveform.as_json()) # 200 OK
+
+@metrics.timed("fetch_file_hls")
+def fetch_file_hls(request: HttpRequest, slug, name):
+    '''
+        Serves the playlists and segments of a video's HLS ladder with the same access checks as the original, see filehost/renditions.py
+    '''
+    status, uploaded_file = check_uploaded_file(slug, request, localise=False, display_messages=False)
+    if status is not None:
+        return status
+    # The ladder is removed when the original is archived
+    if uploaded_file.state != UploadedFile.State.LOCAL or uploaded_file.file_type != UploadedFile.FileType.VIDEO:
+        return HttpResponseNotFound("This Uploaded File does not have any renditions available!") # 404 Not Found
+    path, content_type = renditions.rendition_file(uploaded_file, name)
+    if path is None:
+        return HttpResponseNotFound("That rendition does not exist!") # 404 Not Found
+    return FileResponse(open(path, "rb"), as_attachment=False, content_type=content_type) # 200 OK
+
+
+##################################################
+#                  File Status                   #
+##################################################
+
+# A waiting client holds a web worker for up to FILE_STATUS_MAX_WAIT, which is kept short so that sync workers are not tied up
+# for the length of a de-archive, clients poll again rather than being held until the file is ready. See README.md
+
+# How often (seconds) the state of a file is checked while a client is waiting for it to change
+STATUS_POLL_INTERVAL = 1
+# How long (seconds) clients are told to wait before asking again when the file is not ready yet
+STATUS_RETRY_AFTER = 2
+
+def file_status(request: HttpRequest, slug: str, state: str) -> dict:
+    status = {
+        "slug": slug,
+        "state": state,
+        "ready": state == UploadedFile.State.LOCAL,
+        "url": request.build_absolute_uri(reverse('filehost:fetch-file-raw', kwargs={'slug': slug})),
+    }
+    if state is not None and not status["ready"]:
+        status["retry_after"] = STATUS_RETRY_AFTER
+    return status
+
+def wait_for_state_change(slug: str, state: str, timeout: int):
+    '''
+        Polls the state of a file until it changes or the timeout is reached, files that are already local are returned straight away.\n
+        returns: the latest state of the file, or None if it has been deleted
+    '''
+    deadline = time.monotonic() + timeout
+    while state == UploadedFile.State.MOVING or state == UploadedFile.State.ARCHIVED:
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(STATUS_POLL_INTERVAL)
+        latest = UploadedFile.objects.filter(slug=slug).values_list('state', flat=True).first()
+        if latest != state:
+            return latest
+    return state
+
+def status_events(request: HttpRequest, slug: str, state: str):
+    '''
+        Server-sent events stream of the state of a file, sent as it changes until the file is local, deleted or the timeout is reached.\n
+        The retry field has EventSource reconnect STATUS_RETRY_AFTER seconds after a stream that timed out, so clients close it once the file is ready
+    '''
+    deadline = time.monotonic() + settings.FILE_STATUS_MAX_WAIT
+    while True:
+        yield f"retry: {STATUS_RETRY_AFTER * 1000}\nevent: state\ndata: {json.dumps(file_status(request, slug, state))}\n\n"
+        if state is None or state == UploadedFile.State.LOCAL or time.monotonic() >= deadline:
+            return
+        state = wait_for_state_change(slug, state, min(settings.FILE_STATUS_MAX_WAIT, deadline - time.monotonic()))
+
+def fetch_file_status(request: HttpRequest, slug):
+    '''
+        Reports whether a file is ready to be served in full, archived files are queued for de-archiving.\n
+        Clients can long-poll with ?wait=<seconds> (at most FILE_STATUS_MAX_WAIT) to be answered as soon as the state changes,
+        or send Accept: text/event-stream to be sent every state change for up to FILE_STATUS_MAX_WAIT.\n
+        Either way files that are not ready yet include retry_after, the seconds to wait before asking again
+    '''
+    status, uploaded_file = check_uploaded_file(slug, request, display_messages=False)
+    if status is not None:
+        return status
+
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = StreamingHttpResponse(status_events(request, uploaded_file.slug, uploaded_file.state), content_type='text/event-stream') # 200 OK
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    try:
+        wait = int(request.GET.get('wait', 0))
+    except ValueError:
+        return HttpResponseBadRequest("wait is not a valid integer!") # 400 Bad Request
+    wait = min(max(wait, 0), settings.FILE_STATUS_MAX_WAIT)
+
+    state = wait_for_state_change(uploaded_file.slug, uploaded_file.state, wait)
+    if state is None:
+        return HttpResponseNotFound("That file does not exist on our system, if this is a mistake then it may have been moved or deleted.") # 404 Not Found
+    return JsonResponse(file_status(request, uploaded_file.slug, state)) # 200 OK
+
 
 ##################################################
 #                   Oembed API                   #
 ##################################################
 
 # http://flickr.com/services/oembed?url=http%3A//flickr.com/photos/bees/2362225867/&maxwidth=300&maxheight=400&format=json
+@metrics.timed("handle_oembed")
 def handle_oembed(request: HttpRequest):
     if not request.method == 'GET':
         return HttpResponseNotAllowed("GET is the only supported method for the oembed handler!")  # 405 Not Allowed
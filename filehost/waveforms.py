@@ -0,0 +1,228 @@
+from django.conf import settings
+from filehost.models import UploadedFile
+from filehost import sandbox
+import math, os, struct, time
+
+# Audio uploads are decoded once (by ffmpeg, in the thumbnail sandbox) to mono 16 bit PCM and reduced to the min/max peak
+# of each bucket of samples at several resolutions. The peaks are kept next to the thumbnail, eg: API/AUDIO/THUMBNAIL/gZ8tMsnP.mp3.peaks,
+# so that they outlive archiving the original, and the thumbnail itself is a rendering of them. Players fetch the peaks from the
+# waveform view in the JSON or binary (.dat) layouts of audiowaveform, which waveform players such as peaks.js read directly.
+#
+# Peaks file layout (little endian): a header of magic, version, sample rate, sample count and resolution count, then the
+# samples per bucket and bucket count of each resolution, then each resolution's peaks as signed 8 bit min, max pairs.
+# numpy and ffmpeg are only imported while extracting so that reading peaks in the web workers does not load them.
+
+PEAKS_MAGIC = b"LFSW"
+PEAKS_VERSION = 1
+PEAKS_HEADER = struct.Struct("<4sHIQH")
+PEAKS_RESOLUTION = struct.Struct("<II")
+
+# Audio is decoded at this rate, more than enough for peaks and keeps the decoded samples of long files small
+WAVEFORM_SAMPLE_RATE = 8000
+# Number of buckets the audio is split into at each resolution, finest first. Each is a quarter of the one before
+# so the coarser resolutions are reduced from the finer peaks rather than from the samples again
+WAVEFORM_RESOLUTIONS = (8192, 2048, 512)
+# Resolution served when the player does not ask for one
+DEFAULT_WAVEFORM_BUCKETS = 2048
+
+# Waveform thumbnails are drawn THUMBNAIL_SIZE wide in this colour on a transparent background
+WAVEFORM_COLOUR = (13, 110, 253, 255)
+WAVEFORM_HEIGHT = 256
+
+
+def peaks_path(uploaded_file: UploadedFile) -> str:
+    '''
+        Peaks are kept with the thumbnails, eg: API/AUDIO/THUMBNAIL/gZ8tMsnP.mp3.peaks
+    '''
+    filename = os.path.basename(uploaded_file.file_path)
+    return os.path.join(settings.MEDIA_ROOT, uploaded_file.upload_type, uploaded_file.file_type, "THUMBNAIL", f"{filename}.peaks")
+
+def delete_peaks(uploaded_file: UploadedFile):
+    '''
+        Removes the peaks of the uploaded file, this needs to be done when the file is deleted
+    '''
+    # file_path is only set to a relative path once the file has been uploaded
+    if not uploaded_file.file_path or os.path.isabs(uploaded_file.file_path):
+        return
+    path = peaks_path(uploaded_file)
+    for peaks_file in (path, f"{path}.pending"):
+        if os.path.isfile(peaks_file):
+            os.remove(peaks_file)
+
+
+##################################################
+#                   Extraction                   #
+##################################################
+
+def decode_samples(source_path: str):
+    '''
+        Decodes the whole of an audio file with ffmpeg in a single pass.\n
+        returns: a numpy int16 array of mono samples at WAVEFORM_SAMPLE_RATE
+    '''
+    import ffmpeg
+    import numpy
+    output, _ = (
+        ffmpeg.input(source_path)
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=WAVEFORM_SAMPLE_RATE, vn=None)
+        .global_args("-nostdin")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return numpy.frombuffer(output, dtype=numpy.int16)
+
+def reduce_peaks(minimums, maximums, factor: int):
+    '''
+        Combines every factor neighbouring buckets into one, the last bucket is padded with silence.\n
+        returns: the (minimums, maximums) of the coarser buckets
+    '''
+    import numpy
+    length = math.ceil(len(minimums) / factor)
+    padding = length * factor - len(minimums)
+    minimums = numpy.pad(minimums, (0, padding)).reshape(length, factor).min(axis=1)
+    maximums = numpy.pad(maximums, (0, padding)).reshape(length, factor).max(axis=1)
+    return minimums, maximums
+
+def compute_peaks(samples, resolutions=WAVEFORM_RESOLUTIONS) -> list:
+    '''
+        Splits the samples into whole numbers of samples per bucket so that each resolution has at most its number of buckets.\n
+        returns: a list of (samples per bucket, int8 array of interleaved min, max pairs) finest first
+    '''
+    import numpy
+    samples_per_bucket = max(1, math.ceil(len(samples) / resolutions[0]))
+    length = math.ceil(len(samples) / samples_per_bucket)
+    buckets = numpy.pad(samples, (0, length * samples_per_bucket - len(samples))).reshape(length, samples_per_bucket)
+    minimums, maximums = buckets.min(axis=1), buckets.max(axis=1)
+
+    peaks = []
+    for index, resolution in enumerate(resolutions):
+        if index:
+            factor = resolutions[index - 1] // resolution
+            minimums, maximums = reduce_peaks(minimums, maximums, factor)
+            samples_per_bucket *= factor
+        # 16 bit samples are kept as their top 8 bits, plenty for drawing
+        interleaved = numpy.empty(len(minimums) * 2, dtype=numpy.int8)
+        interleaved[0::2] = minimums >> 8
+        interleaved[1::2] = maximums >> 8
+        peaks.append((samples_per_bucket, interleaved))
+    return peaks
+
+def write_peaks(path: str, sample_count: int, peaks: list):
+    # Written under a temporary name so that the waveform view never reads half a file
+    with open(f"{path}.pending", "wb") as f:
+        f.write(PEAKS_HEADER.pack(PEAKS_MAGIC, PEAKS_VERSION, WAVEFORM_SAMPLE_RATE, sample_count, len(peaks)))
+        for samples_per_bucket, interleaved in peaks:
+            f.write(PEAKS_RESOLUTION.pack(samples_per_bucket, len(interleaved) // 2))
+        for samples_per_bucket, interleaved in peaks:
+            f.write(interleaved.tobytes())
+    os.replace(f"{path}.pending", path)
+
+def render_waveform(interleaved, destination_path: str, width: int, height=WAVEFORM_HEIGHT):
+    '''
+        Draws one column per bucket of interleaved min, max peaks scaled to width as a PNG
+    '''
+    from PIL import Image, ImageDraw
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    middle = height / 2
+    count = len(interleaved) // 2
+    for column in range(width):
+        if not count:
+            break
+        index = min(count - 1, column * count // width)
+        minimum, maximum = int(interleaved[index * 2]), int(interleaved[index * 2 + 1])
+        # Quiet buckets still get a one pixel line so that silence reads as part of the waveform
+        top = middle - max(maximum, 1) * middle / 128
+        bottom = middle - min(minimum, -1) * middle / 128
+        draw.line([(column, top), (column, bottom)], fill=WAVEFORM_COLOUR)
+    image.save(destination_path, format="PNG")
+
+def extract_waveform(source_path: str, peaks_destination: str, thumbnail_destination: str, thumbnail_width: int) -> dict:
+    '''
+        Runs inside the sandbox. Decodes the audio, writes its peaks to peaks_destination and renders the coarsest resolution to thumbnail_destination.\n
+        returns: the seconds spent in each stage
+    '''
+    timings = {}
+
+    start = time.perf_counter()
+    samples = decode_samples(source_path)
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    peaks = compute_peaks(samples)
+    write_peaks(peaks_destination, len(samples), peaks)
+    timings["peaks"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    render_waveform(peaks[-1][1], thumbnail_destination, thumbnail_width)
+    timings["render"] = time.perf_counter() - start
+    return timings
+
+def extract_sandboxed(source_path: str, peaks_destination: str, thumbnail_destination: str, thumbnail_width: int) -> dict:
+    '''
+        Extracts the waveform of source_path in a sandboxed child process with the same limits as thumbnail previews.\n
+        returns: the seconds spent in each stage, raises sandbox.SandboxError if decoding failed or passed a limit
+    '''
+    return sandbox.run_limited(extract_waveform, source_path, peaks_destination, thumbnail_destination, thumbnail_width,
+                               memory_limit=settings.THUMBNAIL_MEMORY_LIMIT, cpu_limit=settings.THUMBNAIL_CPU_LIMIT, timeout=settings.THUMBNAIL_TIMEOUT)
+
+
+##################################################
+#                    Reading                     #
+##################################################
+
+class Waveform():
+    '''
+        One resolution of the peaks of an uploaded file, read without numpy
+    '''
+
+    def __init__(self, sample_rate: int, sample_count: int, samples_per_bucket: int, length: int, data: bytes):
+        self.sample_rate = sample_rate
+        self.sample_count = sample_count
+        self.samples_per_bucket = samples_per_bucket
+        self.length = length
+        self.data = data
+
+    def as_json(self) -> dict:
+        # Same layout as audiowaveform's JSON output
+        return {
+            "version": 2,
+            "channels": 1,
+            "sample_rate": self.sample_rate,
+            "samples_per_pixel": self.samples_per_bucket,
+            "bits": 8,
+            "length": self.length,
+            "duration": self.sample_count / self.sample_rate if self.sample_rate else 0,
+            "data": list(struct.unpack(f"<{len(self.data)}b", self.data)),
+        }
+
+    def as_dat(self) -> bytes:
+        # Same layout as audiowaveform's binary output (version 1, flags bit 0 set for 8 bit peaks)
+        return struct.pack("<iIiiI", 1, 1, self.sample_rate, self.samples_per_bucket, self.length) + self.data
+
+
+def read_peaks(path: str, buckets: int = DEFAULT_WAVEFORM_BUCKETS):
+    '''
+        Reads the stored resolution whose number of buckets is closest to buckets.\n
+        returns: a Waveform, or None if there are no peaks at path or they are not in a layout we know
+    '''
+    try:
+        with open(path, "rb") as f:
+            header = f.read(PEAKS_HEADER.size)
+            if len(header) != PEAKS_HEADER.size:
+                return None
+            magic, version, sample_rate, sample_count, count = PEAKS_HEADER.unpack(header)
+            if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+                return None
+            resolutions = [PEAKS_RESOLUTION.unpack(f.read(PEAKS_RESOLUTION.size)) for i in range(count)]
+            if not resolutions:
+                return None
+
+            # Bucket counts are rounded down by whole samples per bucket, so pick the nearest rather than an exact match
+            chosen = min(range(count), key=lambda index: abs(math.log(max(resolutions[index][1], 1) / buckets)))
+            f.seek(sum(length * 2 for samples_per_bucket, length in resolutions[:chosen]), os.SEEK_CUR)
+            samples_per_bucket, length = resolutions[chosen]
+            data = f.read(length * 2)
+    except (FileNotFoundError, struct.error):
+        return None
+    if len(data) != length * 2:
+        return None
+    return Waveform(sample_rate, sample_count, samples_per_bucket, length, data)